@@ -134,3 +134,9 @@ cdef extern from "sparsity_utils.h":
                                       int **, int **, int **, int * )
     void build_sparsity_pattern_mpi ( int, int, int, int, op_map *, op_map *,
                                       int **, int **, int *, int * )
+    void build_sparsity_rowptr_seq ( int, int, int, int, op_map *, op_map *,
+                                     int *, int * ) nogil
+    void build_sparsity_colidx_seq ( int, int, int, int, op_map *, op_map *,
+                                     int *, int * ) nogil
+    void build_sparsity_nnz_mpi ( int, int, int, int, op_map *, op_map *,
+                                  int *, int *, int *, int * ) nogil
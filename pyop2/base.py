@@ -40,6 +40,10 @@ subclass these as required to implement backend-specific features.
 
 import numpy as np
 import operator
+import os
+import shutil
+import tempfile
+import weakref
 from hashlib import md5
 from decorator import decorator
 
@@ -51,6 +55,207 @@ from mpi import MPI, _MPI, _check_comm
 import configuration as cfg
 import op_lib_core as core
 
+# Lazy evaluation support
+
+class LazyComputation(object):
+    """Helper class holding computation to be carried later on. A
+    ``LazyComputation`` records the data it reads and the data it writes so
+    that the :class:`ExecutionTrace` can work out which delayed computations
+    need to be carried out before a given piece of data can be accessed."""
+
+    def __init__(self, reads, writes):
+        self.reads = set(reads)
+        self.writes = set(writes)
+
+    def enqueue(self):
+        """Add this computation to the execution trace. The computation is
+        carried out immediately unless lazy evaluation is enabled."""
+        _trace.append(self)
+        return self
+
+    def _run(self):
+        raise NotImplementedError("_run must be implemented by subclass")
+
+    def _fusable_with(self, other):
+        """Can this computation be fused with the ``other`` computation
+        following it? No fusion is possible by default."""
+        return False
+
+class ExecutionTrace(object):
+    """Container maintaining delayed computation in the order it was
+    enqueued."""
+
+    def __init__(self):
+        self._trace = list()
+        # Currently open LoopChain collecting computation
+        self._chain = None
+
+    def __len__(self):
+        return len(self._trace)
+
+    def __iter__(self):
+        return iter(self._trace)
+
+    def append(self, computation):
+        """Append ``computation`` to the trace or run it straight away if
+        lazy evaluation is disabled. Computation enqueued while a
+        :class:`LoopChain` is open is handed to the chain instead."""
+        if self._chain is not None:
+            self._chain.append(computation)
+        elif not cfg['lazy_evaluation']:
+            # Flush anything left over from a time lazy evaluation was on
+            self.evaluate_all()
+            computation._run()
+        else:
+            self._trace.append(computation)
+
+    def in_queue(self, computation):
+        """Is ``computation`` still waiting to be executed?"""
+        return computation in self._trace
+
+    def clear(self):
+        """Forcefully drop the trace without executing it."""
+        self._trace = list()
+
+    def evaluate_all(self):
+        """Execute all delayed computation in order."""
+        trace, self._trace = self._trace, list()
+        self._run(trace)
+
+    def evaluate(self, reads, writes):
+        """Force the evaluation of the delayed computation on which ``reads``
+        and ``writes`` depend.
+
+        :arg reads: the data about to be read; every pending computation
+            writing to any of it has to run first (read after write).
+        :arg writes: the data about to be written; every pending computation
+            reading or writing any of it has to run first (write after read
+            and write after write).
+
+        Dependencies are followed transitively backwards through the trace,
+        any computation not required is kept in the trace in its original
+        order."""
+        chain = self._chain
+        if chain is not None and (chain.writes & reads or chain.writes & writes
+                                  or chain.reads & writes):
+            raise RuntimeError("Cannot access data used by a LoopChain before the chain is closed")
+        if not self._trace:
+            return
+        reads = set(reads)
+        writes = set(writes)
+        required = []
+        remaining = []
+        for comp in reversed(self._trace):
+            if comp.writes & reads or comp.writes & writes or comp.reads & writes:
+                required.append(comp)
+                reads |= comp.reads
+                writes |= comp.writes
+            else:
+                remaining.append(comp)
+        self._trace = list(reversed(remaining))
+        self._run(list(reversed(required)))
+
+    def _run(self, comps):
+        """Run the computations ``comps`` in order, fusing consecutive
+        computations if loop fusion is enabled."""
+        if len(comps) > 1 and cfg['loop_fusion']:
+            comps = self._fuse(comps)
+        if len(comps) > 1 and cfg['halo_exchange_aggregate']:
+            self._exchange_halos(comps)
+        for comp in comps:
+            comp._run()
+
+    def _exchange_halos(self, comps):
+        """Exchange the halos of all Dats read by the indirect loops of
+        ``comps`` in a single aggregated exchange, except for those written by
+        an earlier computation, which are exchanged when they are read."""
+        loop_args = []
+        written = set()
+        for comp in comps:
+            for loop in getattr(comp, 'loops', [comp]):
+                if isinstance(loop, ParLoop) and not loop.is_direct:
+                    depth = loop.it_space.iterset.layers if loop.needs_exec_halo else 0
+                    loop_args.append((loop, [a for a in loop.args if a.data not in written],
+                                      depth))
+            written |= comp.writes
+        exchange = _halo_exchange_begin(loop_args)
+        if exchange:
+            exchange.end()
+
+    def _fuse(self, comps):
+        """Merge runs of consecutive computations which are pairwise fusable
+        into a single computation each."""
+        groups = []
+        for comp in comps:
+            if groups and all(c._fusable_with(comp) for c in groups[-1]):
+                groups[-1].append(comp)
+            else:
+                groups.append([comp])
+        return [g[0]._fuse(g[1:]) if len(g) > 1 else g[0] for g in groups]
+
+_trace = ExecutionTrace()
+
+class LoopChain(LazyComputation):
+    """A sequence of :func:`par_loop` calls executed as a unit. A
+    ``LoopChain`` is used as a context manager and collects all the loops
+    issued inside the ``with`` block, which are executed once the block is
+    left::
+
+      with op2.LoopChain(tile_size=512):
+          op2.par_loop(adt_calc, cells, ...)
+          op2.par_loop(res_calc, edges, ...)
+
+    Backends supporting sparse tiling execute the loops of the chain tile by
+    tile, such that the data of each tile stays in cache across loops. The
+    results are identical to executing the loops one after the other, except
+    for the order in which increments are summed. Other backends execute the
+    loops in order.
+
+    :arg tile_size: the number of elements of the first loop's iteration set
+        per tile.
+
+    .. warning :: Data written or read by the loops of a chain must not be
+        accessed before the chain is closed.
+    """
+
+    def __init__(self, tile_size):
+        LazyComputation.__init__(self, set(), set())
+        self._tile_size = tile_size
+        self._loops = []
+
+    def __enter__(self):
+        if _trace._chain is not None:
+            raise RuntimeError("LoopChains cannot be nested")
+        _trace._chain = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _trace._chain = None
+        # Don't execute an incomplete chain if an exception was raised
+        if exc_type is None and self._loops:
+            self.enqueue()
+
+    def append(self, loop):
+        """Add ``loop`` to the chain."""
+        self._loops.append(loop)
+        self.reads |= loop.reads
+        self.writes |= loop.writes
+
+    @property
+    def loops(self):
+        """The loops collected by this chain."""
+        return self._loops
+
+    @property
+    def tile_size(self):
+        """The number of elements of the first loop's iteration set per
+        tile."""
+        return self._tile_size
+
+    def _run(self):
+        for loop in self._loops:
+            loop._run()
+
 # Data API
 
 class Access(object):
@@ -194,16 +399,20 @@ class Arg(object):
     def _uses_itspace(self):
         return self._is_mat or isinstance(self.idx, IterationIndex)
 
-    def halo_exchange_begin(self):
+    def halo_exchange_begin(self, region=None):
         """Begin halo exchange for the argument if a halo update is required.
+        Only the out of date halo regions up to ``region``, the outermost
+        level of the :class:`Set` read (see :meth:`Set._region`), are
+        exchanged; the whole halo if ``region`` is not given.
         Doing halo exchanges only makes sense for :class:`Dat` objects."""
         assert self._is_dat, "Doing halo exchanges only makes sense for Dats"
         assert not self._in_flight, \
             "Halo exchange already in flight for Arg %s" % self
-        if self.access in [READ, RW] and self.data.needs_halo_update:
-            self.data.needs_halo_update = False
-            self._in_flight = True
-            self.data.halo_exchange_begin()
+        if self.access in [READ, RW]:
+            regions = self.data._stale_halo_regions(region)
+            if regions:
+                self._in_flight = True
+                self.data.halo_exchange_begin(regions)
 
     def halo_exchange_end(self):
         """End halo exchange if it is in flight.
@@ -213,40 +422,6 @@ class Arg(object):
             self._in_flight = False
             self.data.halo_exchange_end()
 
-    def reduction_begin(self):
-        """Begin reduction for the argument if its access is INC, MIN, or MAX.
-        Doing a reduction only makes sense for :class:`Global` objects."""
-        assert self._is_global, \
-            "Doing global reduction only makes sense for Globals"
-        assert not self._in_flight, \
-            "Reduction already in flight for Arg %s" % self
-        if self.access is not READ:
-            self._in_flight = True
-            if self.access is INC:
-                op = _MPI.SUM
-            elif self.access is MIN:
-                op = _MPI.MIN
-            elif self.access is MAX:
-                op = _MPI.MAX
-            # If the MPI supports MPI-3, this could be MPI_Iallreduce
-            # instead, to allow overlapping comp and comms.
-            # We must reduce into a temporary buffer so that when
-            # executing over the halo region, which occurs after we've
-            # called this reduction, we don't subsequently overwrite
-            # the result.
-            MPI.comm.Allreduce(self.data._data, self.data._buf, op=op)
-
-    def reduction_end(self):
-        """End reduction for the argument if it is in flight.
-        Doing a reduction only makes sense for :class:`Global` objects."""
-        assert self._is_global, \
-            "Doing global reduction only makes sense for Globals"
-        if self.access is not READ and self._in_flight:
-            self._in_flight = False
-            # Must have a copy here, because otherwise we just grab a
-            # pointer.
-            self.data._data = np.copy(self.data._buf)
-
     @property
     def _c_handle(self):
         if self._lib_handle is None:
@@ -293,6 +468,17 @@ class Set(object):
     [OWNED, EXECUTE HALO)
     [EXECUTE HALO, NON EXECUTE HALO).
 
+    The execute halo may consist of several layers, in which case the
+    list of sizes gives the end of each layer in turn::
+
+      [CORE, OWNED, LAYER 1, ..., LAYER k, NON EXECUTE HALO]
+
+    Layer ``j`` holds the elements which are needed to redundantly compute
+    the values of layer ``j-1``, the owned elements being layer 0. A
+    sequence of indirect loops then needs only a single halo exchange for
+    every ``k`` loops, since each loop can execute one layer less than the
+    one before it. See :mod:`pyop2.halos` for building layered halos.
+
     Halo send/receive data is stored on sets in a :class:`Halo`.
     """
 
@@ -302,19 +488,25 @@ class Set(object):
     OWNED_SIZE = 1
     IMPORT_EXEC_SIZE = 2
     IMPORT_NON_EXEC_SIZE = 3
+    # The regions of halo elements, given by the size index of their end
+    HALO_REGIONS = (IMPORT_EXEC_SIZE, IMPORT_NON_EXEC_SIZE)
+
     @validate_type(('size', (int, tuple, list), SizeTypeError),
                    ('name', str, NameTypeError))
     def __init__(self, size=None, dim=1, name=None, halo=None):
         if type(size) is int:
             size = [size]*4
-        size = as_tuple(size, int, 4)
-        assert size[Set.CORE_SIZE] <= size[Set.OWNED_SIZE] <= \
-                size[Set.IMPORT_EXEC_SIZE] <= size[Set.IMPORT_NON_EXEC_SIZE], \
-                "Set received invalid sizes: %s" % size
+        size = as_tuple(size, int)
+        if len(size) < 4:
+            raise ValueError("Tuple needs to be of length 4 or more")
+        assert all(a <= b for a, b in zip(size, size[1:])), \
+                "Set received invalid sizes: %s" % (size,)
         self._core_size = size[Set.CORE_SIZE]
         self._size = size[Set.OWNED_SIZE]
-        self._ieh_size = size[Set.IMPORT_EXEC_SIZE]
-        self._inh_size = size[Set.IMPORT_NON_EXEC_SIZE]
+        self._ieh_size = size[-2]
+        self._inh_size = size[-1]
+        # The end of each level: core, owned, each exec layer and non-exec
+        self._levels = size
         self._dim = as_tuple(dim, int)
         self._cdim = np.asscalar(np.prod(self._dim))
         self._name = name or "set_%d" % Set._globalcount
@@ -356,6 +548,37 @@ class Set(object):
         """Set sizes: core, owned, execute halo, total."""
         return self._core_size, self._size, self._ieh_size, self._inh_size
 
+    @property
+    def layers(self):
+        """Number of layers of the execute halo."""
+        return len(self._levels) - 3
+
+    def _depth_size(self, depth):
+        """Set size including the first ``depth`` execute halo layers."""
+        return self._levels[Set.OWNED_SIZE + depth]
+
+    def _region(self, end):
+        """The innermost level, an index into the list of sizes the Set was
+        created with, which contains all elements below ``end``. For a Set
+        with a single execute halo layer, this is one of the size indices.
+        Core elements sent to other ranks by the :class:`Halo` count as
+        owned elements."""
+        region = [end <= size for size in self._levels].index(True)
+        if region == Set.CORE_SIZE and self._halo is not None and \
+                any((sends < end).any() for sends in self._halo.sends):
+            region = Set.OWNED_SIZE
+        return region
+
+    def _level_regions(self, level):
+        """The halo regions, out of :attr:`HALO_REGIONS`, holding elements
+        up to the given ``level``."""
+        regions = ()
+        if level > Set.OWNED_SIZE:
+            regions += (Set.IMPORT_EXEC_SIZE,)
+        if level == len(self._levels) - 1:
+            regions += (Set.IMPORT_NON_EXEC_SIZE,)
+        return regions
+
     @property
     def dim(self):
         """The shape tuple of the values for each element of the set."""
@@ -426,6 +649,8 @@ class Halo(object):
         self._sends = tuple(np.asarray(x, dtype=np.int32) for x in sends)
         self._receives = tuple(np.asarray(x, dtype=np.int32) for x in receives)
         self._global_to_petsc_numbering = gnn2unn
+        # Which sends and receives are exec halo elements, see _exec_masks
+        self._masks = None
         self._comm = _check_comm(comm) if comm is not None else MPI.comm
         # FIXME: is this a necessity?
         assert self._comm == MPI.comm, "Halo communicator not COMM"
@@ -481,6 +706,33 @@ class Halo(object):
     should take place over"""
         return self._comm
 
+    def _exec_masks(self, s):
+        """Return boolean masks for each rank of the sends and receives
+        which are exec halo elements of the :class:`Set` ``s`` on the
+        receiving rank. The receiving ranks communicate their masks of the
+        receives on the first call."""
+        if self._masks is None:
+            receives = [ele < s.exec_size for ele in self._receives]
+            self._masks = (self._comm.alltoall(receives), receives)
+        return self._masks
+
+    def _region_elements(self, s, regions):
+        """Return the sends and receives for each rank of the elements in the
+        halo ``regions`` of the :class:`Set` ``s``, given by the size index
+        of their end."""
+        send_masks, recv_masks = self._exec_masks(s)
+        def select(elements, masks):
+            selected = []
+            for ele, is_exec in zip(elements, masks):
+                keep = np.zeros(ele.size, dtype=bool)
+                if Set.IMPORT_EXEC_SIZE in regions:
+                    keep |= is_exec
+                if Set.IMPORT_NON_EXEC_SIZE in regions:
+                    keep |= ~is_exec
+                selected.append(ele[keep])
+            return selected
+        return select(self._sends, send_masks), select(self._receives, recv_masks)
+
     def verify(self, s):
         """Verify that this :class:`Halo` is valid for a given
 :class:`Set`."""
@@ -504,6 +756,182 @@ class Halo(object):
         # FIXME: This will break for custom halo communicators
         self._comm = MPI.comm
 
+class _HaloExchange(object):
+    """Aggregated halo exchange of a group of :class:`Dat` objects, which
+    sends the halo data of all of them to each neighbouring rank in a single
+    message. The group is given as ``(dat, regions)`` pairs of the Dats and
+    the halo regions of each to exchange. The packed buffers and persistent
+    MPI requests are set up once per group and kept on the first Dat of the
+    group until any Dat of the group is deleted, which frees the requests.
+    All ranks have to exchange the same group of Dats in the same order."""
+
+    # Byte alignment of each Dat's segment of a packed buffer
+    _alignment = 16
+
+    @classmethod
+    def _lookup(cls, group):
+        """Return the exchange of ``group``, setting it up on first use."""
+        owner = group[0][0]
+        key = tuple((dat._id, regions) for dat, regions in group)
+        if key not in owner._halo_exchanges:
+            owner._halo_exchanges[key] = cls(group, key)
+        return owner._halo_exchanges[key]
+
+    def __init__(self, group, key):
+        comm = MPI.comm
+        dats = [dat for dat, _ in group]
+        elements = [dat.dataset.halo._region_elements(dat.dataset, regions)
+                    for dat, regions in group]
+        # Drop the exchange from the first Dat once any Dat of the group dies
+        owner = weakref.ref(dats[0])
+        def discard(ref):
+            if owner() is not None:
+                owner()._halo_exchanges.pop(key, None)
+        self._refs = [weakref.ref(dat, discard) for dat in dats[1:]]
+        self._reqs = []
+        self._pack = []
+        self._unpack = []
+        for rank in range(comm.size):
+            buf, segments = self._packed(dats, [sends[rank] for sends, _ in elements])
+            if segments:
+                self._pack += segments
+                self._reqs.append(comm.Send_init(buf, dest=rank, tag=dats[0]._id))
+            buf, segments = self._packed(dats, [receives[rank] for _, receives in elements])
+            if segments:
+                self._unpack += segments
+                self._reqs.append(comm.Recv_init(buf, source=rank, tag=dats[0]._id))
+
+    def __del__(self):
+        if not _MPI.Is_finalized():
+            for req in self._reqs:
+                req.Free()
+
+    @classmethod
+    def _packed(cls, dats, elements):
+        """Allocate the buffer packing the ``elements`` of each of the
+        ``dats`` and return it with the ``(dat, elements, view)`` segments
+        viewing the part of the buffer holding each Dat's values. The Dats
+        are referenced weakly."""
+        offsets = []
+        nbytes = 0
+        for dat, ele in zip(dats, elements):
+            offsets.append(nbytes)
+            size = ele.size * dat._data[:1].nbytes
+            nbytes += -(-size // cls._alignment) * cls._alignment
+        buf = np.empty(nbytes, dtype=np.uint8)
+        segments = []
+        for dat, ele, offset in zip(dats, elements, offsets):
+            if ele.size > 0:
+                size = ele.size * dat._data[:1].nbytes
+                view = buf[offset:offset + size].view(dat.dtype)
+                segments.append((weakref.ref(dat), ele,
+                                 view.reshape((ele.size,) + dat._data.shape[1:])))
+        return buf, segments
+
+    def begin(self):
+        """Pack the halo data of all Dats and start sending and receiving."""
+        for dat, ele, view in self._pack:
+            np.take(dat()._data, ele, axis=0, out=view)
+        _MPI.Prequest.Startall(self._reqs)
+
+    def end(self):
+        """Wait for the exchange to complete and unpack the received halo
+        data of all Dats."""
+        _MPI.Request.Waitall(self._reqs)
+        for dat, ele, view in self._unpack:
+            data = dat()._data
+            # data is read-only in a ParLoop, make it temporarily writable
+            maybe_setflags(data, write=True)
+            data[ele] = view
+            maybe_setflags(data, write=False)
+
+def _halo_exchange_begin(loop_args):
+    """Start an aggregated halo exchange of the Dats of all arguments read by
+    the ``(loop, args, depth)`` triples, exchanging the out of date halo
+    regions each loop reads when executing ``depth`` exec halo layers.
+    Return the exchange to complete with its ``end`` method, or ``None`` if
+    there is nothing to exchange."""
+    dats = []
+    read = {}
+    for loop, args, depth in loop_args:
+        for arg in args:
+            if arg._is_dat and arg.access in [READ, RW] \
+                    and arg.data.dataset.halo is not None:
+                if arg.data not in read:
+                    dats.append(arg.data)
+                    read[arg.data] = Set.OWNED_SIZE
+                read[arg.data] = max(read[arg.data], loop._halo_region(arg, depth))
+    group = []
+    for dat in dats:
+        regions = dat._stale_halo_regions(read[dat])
+        if regions:
+            dat._halo_exchanged(regions)
+            group.append((dat, regions))
+    if not group:
+        return None
+    exchange = _HaloExchange._lookup(tuple(group))
+    exchange.begin()
+    return exchange
+
+class _GlobalReduction(object):
+    """Reduction over all ranks of the :class:`Global` arguments of a
+    :class:`ParLoop` accessed via INC, MIN or MAX. The values of all Globals
+    reduced with the same operation and of the same type are packed into one
+    buffer and reduced by a single non-blocking collective. Completion is
+    deferred until the value of one of the Globals is needed."""
+
+    _ops = {INC: _MPI.SUM, MIN: _MPI.MIN, MAX: _MPI.MAX}
+
+    def __init__(self, args):
+        # Group in order of appearance, which is the same on all ranks
+        keys = []
+        groups = {}
+        for arg in args:
+            if arg._is_global_reduction:
+                key = (arg.access, arg.data.dtype)
+                if key not in groups:
+                    keys.append(key)
+                    groups[key] = []
+                if arg.data not in groups[key]:
+                    groups[key].append(arg.data)
+        self._groups = []
+        for access, dtype in keys:
+            globs = groups[(access, dtype)]
+            offsets = np.cumsum([0] + [g.cdim for g in globs])
+            self._groups.append((self._ops[access], globs, offsets,
+                                 np.empty(offsets[-1], dtype=dtype),
+                                 np.empty(offsets[-1], dtype=dtype)))
+        self._reqs = None
+
+    def begin(self):
+        """Pack the local values of the Globals and start reducing them. Until
+        the reduction is completed, the values of the Globals must not be
+        used, except by computation whose contributions are to be dropped."""
+        assert self._reqs is None, "Reduction already in flight"
+        comm = MPI.comm
+        self._reqs = []
+        for op, globs, offsets, sendbuf, recvbuf in self._groups:
+            for g, start, end in zip(globs, offsets, offsets[1:]):
+                sendbuf[start:end] = g._data.ravel()
+                g._reduction = self
+            try:
+                self._reqs.append(comm.Iallreduce(sendbuf, recvbuf, op=op))
+            except NotImplementedError:
+                # mpi4py built against MPI-2 has no non-blocking collectives
+                comm.Allreduce(sendbuf, recvbuf, op=op)
+
+    def end(self):
+        """Wait for the reduction to complete and unpack the reduced values
+        into the Globals."""
+        if self._reqs is None:
+            return
+        _MPI.Request.Waitall(self._reqs)
+        self._reqs = None
+        for op, globs, offsets, sendbuf, recvbuf in self._groups:
+            for g, start, end in zip(globs, offsets, offsets[1:]):
+                g._data[...] = recvbuf[start:end].reshape(g._data.shape)
+                g._reduction = None
+
 class IterationSpace(object):
     """OP2 iteration space type.
 
@@ -569,11 +997,32 @@ class DataCarrier(object):
     :class:`Global`), rank 1 (:class:`Dat`), or rank 2
     (:class:`Mat`)"""
 
+    # Incremented on every write access to the data, see :attr:`version`
+    _version = 0
+
+    @property
+    def version(self):
+        """Counter incremented on every write access to the data, either by
+        a :func:`par_loop` or by accessing the data for writing from Python.
+        Equal versions mean the data has not been modified in between. The
+        data of a :class:`Const` or :class:`Global` is only written from
+        Python by assigning to its ``data`` property."""
+        return self._version
+
     @property
     def dtype(self):
         """The Python type of the data."""
         return self._data.dtype
 
+    def _force_evaluation(self, read=True, write=True):
+        """Force the evaluation of any delayed computation this object
+        depends on before its data is accessed.
+
+        :arg read: the data is about to be read.
+        :arg write: the data is about to be written."""
+        _trace.evaluate(set([self]) if read else set(),
+                        set([self]) if write else set())
+
     @property
     def ctype(self):
         """The c type of the data."""
@@ -644,7 +1093,13 @@ class Dat(DataCarrier):
         # Are these data to be treated as SoA on the device?
         self._soa = bool(soa)
         self._lib_handle = None
-        self._needs_halo_update = False
+        # Incremented whenever values visible to other ranks may change, and
+        # the value it had when each halo region was last exchanged
+        self._owned_version = 0
+        self._halo_versions = dict.fromkeys(Set.HALO_REGIONS, 0)
+        # Number of exec halo layers holding valid values computed
+        # redundantly since the owned values last changed
+        self._halo_depth = 0
         # If the uid is not passed in from outside, assume that Dats
         # have been declared in the same order everywhere.
         if uid is None:
@@ -653,12 +1108,12 @@ class Dat(DataCarrier):
         else:
             self._id = uid
         self._name = name or "dat_%d" % self._id
-        halo = dataset.halo
-        if halo is not None:
-            self._send_reqs = [None]*halo.comm.size
-            self._send_buf = [None]*halo.comm.size
-            self._recv_reqs = [None]*halo.comm.size
-            self._recv_buf = [None]*halo.comm.size
+        # Persistent halo exchange requests for each tuple of halo regions,
+        # set up on first exchange of those regions
+        self._halo_reqs = {}
+        self._halo_in_flight = None
+        # Aggregated exchanges of groups of Dats starting with this one
+        self._halo_exchanges = {}
 
     @validate_in(('access', _modes, ModeValueError))
     def __call__(self, path, access):
@@ -697,8 +1152,10 @@ class Dat(DataCarrier):
         """Numpy array containing the data values."""
         if self.dataset.total_size > 0 and self._data.size == 0:
             raise RuntimeError("Illegal access: no data associated with this Dat!")
+        self._force_evaluation()
         maybe_setflags(self._data, write=True)
         self.needs_halo_update = True
+        self._version += 1
         return self._data
 
     @property
@@ -706,17 +1163,45 @@ class Dat(DataCarrier):
         """Numpy array containing the data values.  Read-only"""
         if self.dataset.total_size > 0 and self._data.size == 0:
             raise RuntimeError("Illegal access: no data associated with this Dat!")
+        self._force_evaluation(write=False)
         maybe_setflags(self._data, write=False)
         return self._data
 
     @property
     def needs_halo_update(self):
         '''Has this Dat been written to since the last halo exchange?'''
-        return self._needs_halo_update
+        return bool(self._stale_halo_regions())
 
     @needs_halo_update.setter
     def needs_halo_update(self, val):
-        self._needs_halo_update = val
+        if val:
+            self._owned_version += 1
+            self._halo_depth = 0
+        else:
+            self._halo_exchanged(Set.HALO_REGIONS)
+
+    def _stale_halo_regions(self, region=None):
+        """The halo regions holding elements up to ``region``, a level of the
+        :class:`Set` (see :meth:`Set._region`), whose values are out of date,
+        i.e. whose owned values on another rank may have changed since they
+        were last exchanged and which have not been computed redundantly
+        since. All halo regions are considered if ``region`` is not given."""
+        if region is None:
+            region = len(self.dataset._levels) - 1
+        return tuple(r for r in self.dataset._level_regions(region)
+                     if self._halo_versions[r] != self._owned_version and not
+                     (r == Set.IMPORT_EXEC_SIZE and region <= Set.OWNED_SIZE + self._halo_depth))
+
+    def _valid_depth(self):
+        """Number of exec halo layers holding valid values."""
+        if self._halo_versions[Set.IMPORT_EXEC_SIZE] == self._owned_version:
+            return self.dataset.layers
+        return self._halo_depth
+
+    def _halo_exchanged(self, regions):
+        """Record the halo ``regions`` as up to date."""
+        for r in regions:
+            self._halo_versions[r] = self._owned_version
 
     @property
     def norm(self):
@@ -733,7 +1218,7 @@ class Dat(DataCarrier):
             }""" % { 't': self.ctype, 'dim' : self.cdim }
             self._zero_kernel = _make_object('Kernel', k, 'zero')
         _make_object('ParLoop', self._zero_kernel, self.dataset,
-                     self(IdentityMap, WRITE)).compute()
+                     self(IdentityMap, WRITE)).enqueue()
 
     def __str__(self):
         return "OP2 Dat: %s on (%s) with datatype %s" \
@@ -747,6 +1232,7 @@ class Dat(DataCarrier):
         pass
 
     def _op(self, other, op):
+        self._force_evaluation(write=False)
         if np.isscalar(other):
             return Dat(self.dataset,
                        op(self._data, as_type(other, self.dtype)), self.dtype)
@@ -756,10 +1242,10 @@ class Dat(DataCarrier):
 
     def _iop(self, other, op):
         if np.isscalar(other):
-            op(self._data, as_type(other, self.dtype))
+            op(self.data, as_type(other, self.dtype))
         else:
             self._check_shape(other)
-            op(self._data, as_type(other.data, self.dtype))
+            op(self.data, as_type(other.data, self.dtype))
         return self
 
     def __add__(self, other):
@@ -794,49 +1280,63 @@ class Dat(DataCarrier):
         """Pointwise division or scaling of fields."""
         return self._iop(other, operator.idiv)
 
-    def halo_exchange_begin(self):
-        """Begin halo exchange."""
+    def _init_halo_exchange(self, regions):
+        """Allocate the send and receive buffers of the exchange of the halo
+        ``regions`` and set up persistent MPI requests communicating them.
+        Ranks with no elements to exchange, including this rank, get no
+        request."""
+        halo = self.dataset.halo
+        sends, receives = halo._region_elements(self.dataset, regions)
+        shape = self._data.shape[1:]
+        send_buf = []
+        recv_buf = []
+        reqs = []
+        for dest, ele in enumerate(sends):
+            if ele.size > 0:
+                buf = np.empty((ele.size,) + shape, dtype=self.dtype)
+                send_buf.append((ele, buf))
+                reqs.append(halo.comm.Send_init(buf, dest=dest, tag=self._id))
+        for source, ele in enumerate(receives):
+            if ele.size > 0:
+                buf = np.empty((ele.size,) + shape, dtype=self.dtype)
+                recv_buf.append((ele, buf))
+                reqs.append(halo.comm.Recv_init(buf, source=source, tag=self._id))
+        self._halo_reqs[regions] = (reqs, send_buf, recv_buf)
+
+    def halo_exchange_begin(self, regions=Set.HALO_REGIONS):
+        """Begin halo exchange of the halo ``regions``, given by the
+        :class:`Set` size index of their end, and record them as up to
+        date."""
         halo = self.dataset.halo
         if halo is None:
             return
-        for dest,ele in enumerate(halo.sends):
-            if ele.size == 0:
-                # Don't send to self (we've asserted that ele.size ==
-                # 0 previously) or if there are no elements to send
-                self._send_reqs[dest] = _MPI.REQUEST_NULL
-                continue
-            self._send_buf[dest] = self._data[ele]
-            self._send_reqs[dest] = halo.comm.Isend(self._send_buf[dest],
-                                                    dest=dest, tag=self._id)
-        for source,ele in enumerate(halo.receives):
-            if ele.size == 0:
-                # Don't receive from self or if there are no elements
-                # to receive
-                self._recv_reqs[source] = _MPI.REQUEST_NULL
-                continue
-            self._recv_buf[source] = self._data[ele]
-            self._recv_reqs[source] = halo.comm.Irecv(self._recv_buf[source],
-                                                      source=source, tag=self._id)
+        if regions not in self._halo_reqs:
+            self._init_halo_exchange(regions)
+        reqs, send_buf, _ = self._halo_reqs[regions]
+        for ele, buf in send_buf:
+            np.take(self._data, ele, axis=0, out=buf)
+        _MPI.Prequest.Startall(reqs)
+        self._halo_exchanged(regions)
+        self._halo_in_flight = regions
 
     def halo_exchange_end(self):
         """End halo exchange. Waits on MPI recv."""
         halo = self.dataset.halo
         if halo is None:
             return
-        _MPI.Request.Waitall(self._recv_reqs)
-        _MPI.Request.Waitall(self._send_reqs)
-        self._send_buf = [None]*len(self._send_buf)
+        reqs, _, recv_buf = self._halo_reqs[self._halo_in_flight]
+        self._halo_in_flight = None
+        _MPI.Request.Waitall(reqs)
         # data is read-only in a ParLoop, make it temporarily writable
         maybe_setflags(self._data, write=True)
-        for source, buf in enumerate(self._recv_buf):
-            if buf is not None:
-                self._data[halo.receives[source]] = buf
+        for ele, buf in recv_buf:
+            self._data[ele] = buf
         maybe_setflags(self._data, write=False)
-        self._recv_buf = [None]*len(self._recv_buf)
 
     @property
     def norm(self):
         """The L2-norm on the flattened vector."""
+        self._force_evaluation(write=False)
         return np.linalg.norm(self._data)
 
     @classmethod
@@ -878,14 +1378,17 @@ class Const(DataCarrier):
 
     @property
     def data(self):
-        """Data array."""
+        """Data array. Modifying the values requires assigning to
+        :attr:`data` for the change to be noticed (see :attr:`version`)."""
         if len(self._data) is 0:
             raise RuntimeError("Illegal access: No data associated with this Const!")
         return self._data
 
     @data.setter
     def data(self, value):
+        self._force_evaluation(read=False)
         self._data = verify_reshape(value, self.dtype, self.dim)
+        self._version += 1
 
     def __str__(self):
         return "OP2 Const: %s of dim %s and type %s with value %s" \
@@ -903,6 +1406,7 @@ class Const(DataCarrier):
         """Remove this Const object from the namespace
 
         This allows the same name to be redeclared with a different shape."""
+        self._force_evaluation(read=False)
         Const._defs.discard(self)
 
     def _format_declaration(self):
@@ -938,13 +1442,14 @@ class Global(DataCarrier):
 
     _globalcount = 0
     _modes = [READ, INC, MIN, MAX]
+    # Reduction over all ranks in flight, completed when the value is needed
+    _reduction = None
 
     @validate_type(('name', str, NameTypeError))
     def __init__(self, dim, data=None, dtype=None, name=None):
         self._dim = as_tuple(dim, int)
         self._cdim = np.asscalar(np.prod(self._dim))
         self._data = verify_reshape(data, dtype, self._dim, allow_none=True)
-        self._buf = np.empty_like(self._data)
         self._name = name or "global_%d" % Global._globalcount
         Global._globalcount += 1
 
@@ -961,14 +1466,28 @@ class Global(DataCarrier):
 
     @property
     def data(self):
-        """Data array."""
+        """Data array. Modifying the values requires assigning to
+        :attr:`data` for the change to be noticed (see :attr:`version`)."""
         if len(self._data) is 0:
             raise RuntimeError("Illegal access: No data associated with this Global!")
+        self._force_evaluation()
         return self._data
 
     @data.setter
     def data(self, value):
+        self._force_evaluation()
         self._data = verify_reshape(value, self.dtype, self.dim)
+        self._version += 1
+
+    def _force_evaluation(self, read=True, write=True):
+        super(Global, self)._force_evaluation(read, write)
+        self._reduction_wait()
+
+    def _reduction_wait(self):
+        """Complete the pending reduction over all ranks of the value of this
+        :class:`Global`, if there is any."""
+        if self._reduction is not None:
+            self._reduction.end()
 
     @property
     def soa(self):
@@ -1045,6 +1564,8 @@ class Map(object):
                                       allow_none=True)
         self._name = name or "map_%d" % Map._globalcount
         self._lib_handle = None
+        self._values_hash = None
+        self._halo_regions = {}
         Map._globalcount += 1
 
     @validate_type(('index', (int, IterationIndex), IndexTypeError))
@@ -1082,8 +1603,48 @@ class Map(object):
 
     @property
     def values(self):
-        """Mapping array."""
-        return self._values
+        """Mapping array. This is a read-only view, the values are modified
+        by assigning to :attr:`values`, which invalidates anything derived
+        from them, such as plans and sparsity patterns."""
+        values = self._values.view()
+        values.setflags(write=False)
+        return values
+
+    @values.setter
+    def values(self, values):
+        self._values[:] = verify_reshape(values, np.int32, self._values.shape)
+        self._values_changed()
+
+    @property
+    def _content_hash(self):
+        """md5 hex digest of the values of this Map, identifying Maps with the
+        same connectivity in cache keys. It is computed on first access and
+        stored until the :attr:`values` are assigned to."""
+        if self._values_hash is None:
+            h = md5(str((self._iterset.total_size, self._dataset.total_size, self._dim)))
+            h.update(np.ascontiguousarray(self._values))
+            self._values_hash = h.hexdigest()
+        return self._values_hash
+
+    # Incremented whenever the values are assigned to
+    _version = 0
+
+    def _values_changed(self):
+        """Invalidate the state derived from the values of this Map."""
+        self._values_hash = None
+        self._version += 1
+
+    def _halo_region(self, region):
+        """The outermost level of the dataset (see :meth:`Set._region`)
+        accessed through this Map from the elements of the iterset up to
+        level ``region`` on any rank. It is agreed on by all ranks once per
+        version of the values."""
+        key = (region, self._version)
+        if key not in self._halo_regions:
+            values = self._values[:self._iterset._levels[region]]
+            local = self._dataset._region(values.max() + 1 if values.size > 0 else 0)
+            self._halo_regions[key] = MPI.comm.allreduce(local, op=_MPI.MAX)
+        return self._halo_regions[key]
 
     @property
     def name(self):
@@ -1127,6 +1688,15 @@ class Map(object):
 IdentityMap = Map(Set(0), Set(0), 1, [], 'identity')
 """The identity map.  Used to indicate direct access to a :class:`Dat`."""
 
+class _SparsityPattern(object):
+    """CSR pattern shared by the :class:`Sparsity` objects built from maps
+    with the same contents, which keep it alive."""
+
+    __slots__ = ('arrays', '__weakref__')
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+
 class Sparsity(Cached):
     """OP2 Sparsity, a matrix structure derived from the union of the outer
     product of pairs of :class:`Map` objects.
@@ -1146,7 +1716,12 @@ class Sparsity(Cached):
     """
 
     _cache = {}
+    # CSR patterns shared by all sparsities with the same map contents, as
+    # long as any of them is alive
+    _patterns = weakref.WeakValueDictionary()
     _globalcount = 0
+    # Whether the backend assembles vector fields into blocked matrices
+    _blocked = False
 
     @classmethod
     @validate_type(('maps', (Map, tuple), MapTypeError),)
@@ -1200,13 +1775,85 @@ class Sparsity(Cached):
         self._nrows = self._rmaps[0].dataset.size
         self._ncols = self._cmaps[0].dataset.size
         self._dims = (self._rmaps[0].dataset.cdim, self._cmaps[0].dataset.cdim)
+        # Square blocks are stored once per pair of set elements rather than
+        # expanded by the dimensions
+        self._block_sparse = self._blocked and self._dims[0] == self._dims[1] > 1
 
         self._name = name or "sparsity_%d" % Sparsity._globalcount
         self._lib_handle = None
         Sparsity._globalcount += 1
-        core.build_sparsity(self, parallel=MPI.parallel)
+
+        key = self._pattern_key()
+        pattern = Sparsity._patterns.get(key)
+        if pattern is None:
+            arrays = self._read_pattern(key)
+            if arrays is None:
+                core.build_sparsity(self, parallel=MPI.parallel)
+                arrays = (self._d_nnz, self._o_nnz, self._rowptr, self._colidx,
+                          self._d_nz, self._o_nz)
+                self._write_pattern(key, arrays)
+            pattern = _SparsityPattern(arrays)
+            Sparsity._patterns[key] = pattern
+        self._pattern = pattern
+        self._d_nnz, self._o_nnz, self._rowptr, self._colidx, \
+            self._d_nz, self._o_nz = pattern.arrays
         self._initialized = True
 
+    _pattern_arrays = ('nnz', 'onnz', 'rowptr', 'colidx')
+
+    def _pattern_key(self):
+        """md5 hex digest identifying the CSR pattern by the contents of the
+        maps, rather than the maps themselves, such that connectivity loaded
+        again from disk or in another process reuses the pattern."""
+        pairs = tuple(sorted((r._content_hash, c._content_hash, r.iterset.size,
+                              r.iterset.exec_size)
+                             for r, c in zip(self._rmaps, self._cmaps)))
+        return md5(str((pairs, self._nrows, self._ncols, self._dims,
+                        self._block_sparse, MPI.parallel))).hexdigest()
+
+    @staticmethod
+    def _read_pattern(key):
+        """Read the CSR pattern with ``key`` from the ``sparsity_cache_dir``,
+        memory mapping the arrays. Returns ``None`` if it is not found."""
+        cachedir = cfg['sparsity_cache_dir']
+        if not cachedir:
+            return None
+        path = os.path.join(cachedir, key)
+        try:
+            nz = np.load(os.path.join(path, 'nz.npy'))
+            arrays = []
+            for name in Sparsity._pattern_arrays:
+                f = os.path.join(path, name + '.npy')
+                arrays.append(np.load(f, mmap_mode='r') if os.path.exists(f) else [])
+        except (IOError, ValueError):
+            return None
+        return tuple(arrays) + (int(nz[0]), int(nz[1]))
+
+    @staticmethod
+    def _write_pattern(key, pattern):
+        """Store the CSR pattern with ``key`` as raw NumPy files in the
+        ``sparsity_cache_dir``, if one is configured. The pattern is written
+        under a temporary name and renamed into place, such that concurrent
+        writers never expose a partial pattern."""
+        cachedir = cfg['sparsity_cache_dir']
+        if not cachedir:
+            return
+        try:
+            if not os.path.exists(cachedir):
+                os.makedirs(cachedir)
+            tmp = tempfile.mkdtemp(dir=cachedir)
+        except OSError:
+            return
+        try:
+            for name, a in zip(Sparsity._pattern_arrays, pattern):
+                if len(a):
+                    np.save(os.path.join(tmp, name + '.npy'), a)
+            np.save(os.path.join(tmp, 'nz.npy'), np.array(pattern[4:], dtype=np.int64))
+            os.rename(tmp, os.path.join(cachedir, key))
+        except (IOError, OSError):
+            # Another process stored the same pattern first
+            shutil.rmtree(tmp, ignore_errors=True)
+
     @property
     def _nmaps(self):
         return len(self._rmaps)
@@ -1240,6 +1887,17 @@ class Sparsity(Cached):
         :class:`Set` of the ``Sparsity``."""
         return self._dims
 
+    @property
+    def block_sparse(self):
+        """Whether the ``Sparsity`` holds one entry per block of
+        :attr:`dims` rather than one entry per scalar."""
+        return self._block_sparse
+
+    @property
+    def _block_dims(self):
+        """The dimensions each entry of the pattern is expanded by."""
+        return (1, 1) if self._block_sparse else self._dims
+
     @property
     def nrows(self):
         """The number of rows in the ``Sparsity``."""
@@ -1262,9 +1920,6 @@ class Sparsity(Cached):
     def __repr__(self):
         return "Sparsity(%r, %r)" % (tuple(self.maps), self.name)
 
-    def __del__(self):
-        core.free_sparsity(self)
-
     @property
     def rowptr(self):
         """Row pointer array of CSR data structure."""
@@ -1315,6 +1970,14 @@ class Mat(DataCarrier):
     """OP2 matrix data. A ``Mat`` is defined on a sparsity pattern and holds a value
     for each element in the :class:`Sparsity`.
 
+    :param sparsity: :class:`Sparsity` the ``Mat`` is defined on
+    :param dtype: numpy data type of the values
+    :param string name: user-defined label (optional)
+    :param string format: storage format on the host backends, either
+        ``'csr'`` (the default) for an assembled sparse matrix or ``'lma'`` to
+        keep the dense element matrices of the local matrix assembly, which
+        is converted to ``'csr'`` only when required
+
     When a ``Mat`` is passed to :func:`par_loop`, the maps via which
     indirection occurs for the row and column space, and the access
     descriptor are passed by `calling` the ``Mat``. For instance, if a
@@ -1329,14 +1992,25 @@ class Mat(DataCarrier):
 
     _globalcount = 0
     _modes = [WRITE, INC]
+    _formats = ['csr', 'lma']
+    # Whether the backend skips assembling unchanged values, see zero()
+    _cache_assembly = False
 
     @validate_type(('sparsity', Sparsity, SparsityTypeError), \
                    ('name', str, NameTypeError))
-    def __init__(self, sparsity, dtype=None, name=None):
+    def __init__(self, sparsity, dtype=None, name=None, format=None):
         self._sparsity = sparsity
         self._datatype = np.dtype(dtype)
         self._name = name or "mat_%d" % Mat._globalcount
         self._lib_handle = None
+        self._format = format or 'csr'
+        if self._format not in self._formats:
+            raise ValueError("Unknown matrix format %s, must be one of %s" \
+                    % (self._format, self._formats))
+        # Signature of the par_loop which assembled the values starting from
+        # zero, () if the Mat is zero and None if the values are unknown
+        self._assembly = ()
+        self._zero_pending = False
         Mat._globalcount += 1
 
     @validate_in(('access', _modes, ModeValueError))
@@ -1361,6 +2035,63 @@ class Mat(DataCarrier):
         """:class:`Sparsity` on which the ``Mat`` is defined."""
         return self._sparsity
 
+    @property
+    def format(self):
+        """The storage format of the ``Mat``, ``'csr'`` or ``'lma'``."""
+        return self._format
+
+    def zero(self):
+        """Zero the matrix.
+
+        If the values were assembled by a single :func:`par_loop` after the
+        matrix was last zeroed, zeroing is deferred. Issuing the same loop
+        again while none of the data, :class:`Const` objects and maps it
+        reads has been written to since then (see :attr:`DataCarrier.version`)
+        leaves the values as they are and skips the loop. In parallel the
+        loop is only skipped if this holds on every process, since assembly
+        is collective."""
+        if self._cache_assembly and self._assembly:
+            self._zero_pending = True
+        else:
+            self._zero()
+            self._assembly = ()
+            self._version += 1
+
+    def _zero(self):
+        raise NotImplementedError("Abstract base Mat does not implement zero()")
+
+    def _flush_zero(self):
+        """Carry out a deferred :meth:`zero`."""
+        if self._zero_pending:
+            self._zero_pending = False
+            self._zero()
+            self._assembly = ()
+            self._version += 1
+
+    def _skip_assembly(self, loop):
+        """Note ``loop`` assembling into this Mat is issued and return whether
+        it can be skipped, because it assembles the values the Mat still
+        holds after a deferred :meth:`zero`. The versions of the data read
+        are local to each process, hence the decision is agreed on by all
+        processes, which issue the loop collectively."""
+        if not self._cache_assembly:
+            return False
+        sig = loop._assembly_signature()
+        if self._zero_pending:
+            skip = sig is not None and sig == self._assembly
+            if MPI.comm.size > 1:
+                skip = bool(MPI.comm.allreduce(int(skip), op=_MPI.MIN))
+            if skip:
+                self._zero_pending = False
+                return True
+            self._flush_zero()
+        self._assembly = sig if sig is not None and self._assembly == () else None
+        return False
+
+    @property
+    def _is_lma(self):
+        return self._format == 'lma'
+
     @property
     def _is_scalar_field(self):
         return np.prod(self.dims) == 1
@@ -1394,6 +2125,78 @@ class Mat(DataCarrier):
         return "Mat(%r, '%s', '%s')" \
                % (self._sparsity, self._datatype, self._name)
 
+class MatrixFree(object):
+    """OP2 matrix-free linear operator. The action ``y = A x`` of the operator
+    is computed by a :func:`par_loop` rather than by a :class:`Mat`, such that
+    it can be passed to :func:`solve` without building a :class:`Sparsity` and
+    storing assembled values.
+
+    :param kernel: :class:`Kernel` computing the action of the operator
+    :param it_space: :class:`Set` or :class:`IterationSpace` to iterate over
+    :param x: :class:`Arg` reading the :class:`Dat` the operator is applied to
+    :param y: :class:`Arg` incrementing the :class:`Dat` receiving the result
+    :param args: further :class:`Arg` objects passed to the kernel, such as
+        coefficients the operator depends on
+    :param string name: user-defined label (optional)
+
+    The :class:`Dat` objects of ``x`` and ``y`` are the workspace the action is
+    computed in and are overwritten whenever the operator is applied. For
+    instance, a Laplace operator is applied with a kernel reading the
+    coordinates::
+
+        A = op2.MatrixFree(laplace, elements, u(elem_node, op2.READ),
+                           v(elem_node, op2.INC), coords(elem_vnode, op2.READ))
+        op2.solve(A, x, b)
+
+    Matrix-free systems are solved without preconditioner."""
+
+    _globalcount = 0
+
+    def __init__(self, kernel, it_space, x, y, *args, **kwargs):
+        if not (isinstance(x, Arg) and x._is_dat):
+            raise DatTypeError("Operand must be a Dat argument, not %r" % x)
+        if not (isinstance(y, Arg) and y._is_dat):
+            raise DatTypeError("Result must be a Dat argument, not %r" % y)
+        if x.access is not READ:
+            raise ModeValueError("Operand must be accessed via READ, not %s" % x.access)
+        if y.access is not INC:
+            raise ModeValueError("Result must be accessed via INC, not %s" % y.access)
+        name = kwargs.get('name')
+        assert not name or isinstance(name, str), "Name must be of type str"
+        self._kernel = kernel
+        self._it_space = it_space
+        self._x = x
+        self._y = y
+        self._args = args
+        self._name = name or "matrixfree_%d" % MatrixFree._globalcount
+        MatrixFree._globalcount += 1
+
+    def _apply(self):
+        """Compute the action of the operator on the :class:`Dat` of ``x``
+        into the :class:`Dat` of ``y``."""
+        self._y.data.zero()
+        _make_object('ParLoop', self._kernel, self._it_space,
+                     self._x, self._y, *self._args).enqueue()
+
+    @property
+    def dims(self):
+        """A pair of integers giving the number of rows and columns of the
+        operator for each member of the row :class:`Set` and column
+        :class:`Set` respectively."""
+        return (self._y.data.cdim, self._x.data.cdim)
+
+    @property
+    def name(self):
+        """A user-defined label."""
+        return self._name
+
+    def __str__(self):
+        return "OP2 MatrixFree: %s, kernel %s" % (self._name, self._kernel.name)
+
+    def __repr__(self):
+        return "MatrixFree(%r, %r, %r, %r, '%s')" \
+               % (self._kernel, self._it_space, self._x, self._y, self._name)
+
 # Kernel API
 
 class Kernel(Cached):
@@ -1470,14 +2273,26 @@ class JITModule(Cached):
 
         return key
 
-class ParLoop(object):
+class ParLoop(LazyComputation):
     """Represents the kernel, iteration space and arguments of a parallel loop
     invocation.
 
     .. note:: Users should not directly construct :class:`ParLoop` objects, but
     use ``op2.par_loop()`` instead."""
 
+    # Reduction of the Global arguments, set up on first execution
+    _reduction = None
+    # Number of exec halo layers executed, chosen on every execution
+    _depth = 0
+
     def __init__(self, kernel, itspace, *args):
+        # Record the data read and written by this loop for lazy evaluation.
+        # Accessing a Dat, Global or Mat via INC, MIN or MAX reads its
+        # previous value. The currently defined Consts are read as well.
+        reads = [a.data for a in args if a.access is not WRITE]
+        reads += Const._definitions()
+        writes = [a.data for a in args if a.access is not READ]
+        LazyComputation.__init__(self, reads, writes)
         # Always use the current arguments, also when we hit cache
         self._actual_args = args
         self._kernel = kernel
@@ -1485,45 +2300,144 @@ class ParLoop(object):
 
         self.check_args()
 
+    def __call__(self):
+        """Execute this parallel loop with the current data of its arguments.
+        This allows a loop returned by :func:`prepare_par_loop` to be run
+        repeatedly without validating its arguments again."""
+        return self.enqueue()
+
+    def enqueue(self):
+        for arg in self._actual_args:
+            if arg._is_mat and arg.data._skip_assembly(self):
+                return self
+        for data in self.writes:
+            data._version += 1
+        return super(ParLoop, self).enqueue()
+
+    def _assembly_signature(self):
+        """Signature of the values this loop assembles into a :class:`Mat`,
+        made up of the kernel, the iteration space, the arguments and the
+        versions of the data, maps and :class:`Const` objects they read.
+        ``None`` if the loop writes anything besides the :class:`Mat`."""
+        if len(self.writes) != 1:
+            return None
+        def index(idx):
+            if isinstance(idx, IterationIndex):
+                return (IterationIndex, idx.index)
+            return idx
+        sig = (self._kernel.cache_key, self._it_space.iterset, self._it_space.extents)
+        for arg in self._actual_args:
+            maps = arg.map if isinstance(arg.map, tuple) else (arg.map,)
+            idx = arg.idx
+            idx = tuple(index(i) for i in idx) if isinstance(idx, tuple) else index(idx)
+            sig += ((arg.data, None if arg._is_mat else arg.data.version, arg.access,
+                     tuple((m, None if m is None else m._version) for m in maps), idx),)
+        return sig + tuple((c, c.version) for c in Const._definitions())
+
+    def _run(self):
+        return self.compute()
+
     def compute(self):
         """Executes the kernel over all members of the iteration space."""
         raise RuntimeError('Must select a backend')
 
     def halo_exchange_begin(self):
-        """Start halo exchanges."""
+        """Choose the number of exec halo layers to execute and start halo
+        exchanges. If the ``halo_exchange_aggregate`` configuration option is
+        set, the halos of all Dats requiring an update are exchanged together
+        with one message per neighbour."""
+        self._depth = self._execution_depth()
         if self.is_direct:
             # No need for halo exchanges for a direct loop
             return
+        if cfg['halo_exchange_aggregate']:
+            self._halo_exchange = _halo_exchange_begin([(self, self.args, self._depth)])
+            return
+        # Exchange each Dat once, up to the outermost region any of its
+        # arguments reads
+        first = []
+        read = {}
         for arg in self.args:
-            if arg._is_dat:
-                arg.halo_exchange_begin()
+            if arg._is_dat and arg.access in [READ, RW]:
+                if arg.data not in read:
+                    first.append(arg)
+                    read[arg.data] = Set.OWNED_SIZE
+                read[arg.data] = max(read[arg.data], self._halo_region(arg))
+        for arg in first:
+            arg.halo_exchange_begin(read[arg.data])
 
     def halo_exchange_end(self):
         """Finish halo exchanges (wait on irecvs)"""
         if self.is_direct:
             return
+        if cfg['halo_exchange_aggregate']:
+            if self._halo_exchange:
+                self._halo_exchange.end()
+            self._halo_exchange = None
+            return
         for arg in self.args:
             if arg._is_dat:
                 arg.halo_exchange_end()
 
     def reduction_begin(self):
-        """Start reductions"""
-        for arg in self.args:
-            if arg._is_global_reduction:
-                arg.reduction_begin()
+        """Start reducing the :class:`Global` arguments over all ranks, with
+        one non-blocking collective per reduction operation and type."""
+        if not any(arg._is_global_reduction for arg in self.args):
+            return
+        if self._reduction is None:
+            self._reduction = _GlobalReduction(self.args)
+        self._reduction.begin()
 
     def reduction_end(self):
-        """End reductions"""
-        for arg in self.args:
-            if arg._is_global_reduction:
-                arg.reduction_end()
+        """End reductions. Completion is deferred until the value of one of
+        the reduced :class:`Global` arguments is accessed or used by another
+        loop, such that further computation overlaps with the reduction."""
+        pass
 
     def maybe_set_halo_update_needed(self):
         """Set halo update needed for :class:`Dat` arguments that are written to
-        in this parallel loop."""
+        in this parallel loop, unless only core elements not sent to other
+        ranks are written. Exec halo layers computed redundantly from valid
+        values remain valid: the executed layers of Dats written directly
+        and one layer less of Dats written indirectly, in both cases no more
+        layers than were valid before for increments."""
+        depths = {}
         for arg in self.args:
-            if arg._is_dat and arg.access in [INC, WRITE, RW]:
-                arg.data.needs_halo_update = True
+            if arg._is_dat and arg.access in [INC, WRITE, RW] and \
+                    self._halo_region(arg) > Set.CORE_SIZE:
+                depth = self._depth if arg._is_direct else max(self._depth - 1, 0)
+                if arg.access is INC:
+                    depth = min(depth, arg.data._valid_depth())
+                depths[arg.data] = min(depths.get(arg.data, depth), depth)
+        for dat, depth in depths.items():
+            dat.needs_halo_update = True
+            dat._halo_depth = depth
+
+    def _execution_depth(self):
+        """The number of exec halo layers to execute. A loop with indirect
+        arguments which are not only read executes as many layers as the
+        :class:`Dat` objects it reads hold valid values for, without any halo
+        exchange, or all layers following a halo exchange if not even the
+        first layer can be executed."""
+        if not self.needs_exec_halo:
+            return 0
+        layers = self.it_space.iterset.layers
+        reads = [arg for arg in self.args if arg._is_dat and arg.access in [READ, RW]]
+        for depth in range(layers, 0, -1):
+            if not any(arg.data._stale_halo_regions(self._halo_region(arg, depth))
+                       for arg in reads):
+                return depth
+        return layers
+
+    def _halo_region(self, arg, depth=None):
+        """The outermost level of the :class:`Set` of the :class:`Dat`
+        argument ``arg`` (see :meth:`Set._region`) accessed on any rank by
+        this loop executing ``depth`` exec halo layers, by default the number
+        of layers of its latest execution."""
+        region = Set.OWNED_SIZE + (self._depth if depth is None else depth)
+        if arg._is_direct:
+            return region
+        return arg.map._halo_region(region)
 
     def check_args(self):
         """Checks the following:
@@ -1588,6 +2502,9 @@ class ParLoop(object):
     def _has_soa(self):
         return any(a._is_soa for a in self._actual_args)
 
+def prepare_par_loop(kernel, it_space, *args):
+    raise NotImplementedError("Prepared par_loops are not supported by this backend")
+
 DEFAULT_SOLVER_PARAMETERS = {'linear_solver':      'cg',
                              'preconditioner':     'jacobi',
                              'relative_tolerance': 1.0e-7,
@@ -1598,7 +2515,8 @@ DEFAULT_SOLVER_PARAMETERS = {'linear_solver':      'cg',
                              'plot_convergence': False,
                              'plot_prefix': '',
                              'error_on_nonconvergence': True,
-                             'gmres_restart': 30}
+                             'gmres_restart': 30,
+                             'nonzero_initial_guess': False}
 
 """The default parameters for the solver are the same as those used in PETSc
 3.3. Note that the parameters accepted by :class:`op2.Solver` are only a subset
@@ -1628,7 +2546,12 @@ class Solver(object):
         solve has finished and save it to file (False, implies monitor_convergence)
     :arg plot_prefix: filename prefix for plot files ('')
     :arg gmres_restart: restart period when using GMRES
+    :arg nonzero_initial_guess: start the iteration from the values of the
+        solution :class:`Dat` instead of zero (False)
 
+    The parameters are only passed on when they have changed since the last
+    solve. Solving again with the same, unmodified :class:`Mat` reuses the
+    preconditioner set up by the previous solve.
     """
 
     def __init__(self, parameters=None, **kwargs):
@@ -349,6 +349,7 @@ class Global(DeviceDataMixin, op2.Global):
         self._data = verify_reshape(value, self.dtype, self.dim)
         if self.state is not DeviceDataMixin.DEVICE_UNALLOCATED:
             self.state = DeviceDataMixin.HOST
+        self._version += 1
 
     def _finalise_reduction_begin(self, grid_size, op):
         # Need to make sure the kernel launch finished
@@ -654,11 +655,23 @@ class JITModule(base.JITModule):
         self.compile().prepared_async_call(*args, **kwargs)
 
 def par_loop(kernel, it_space, *args):
-    ParLoop(kernel, it_space, *args).compute()
-    _stream.synchronize()
+    ParLoop(kernel, it_space, *args)()
+
+def prepare_par_loop(kernel, it_space, *args):
+    """Prepare an OP2 kernel invocation for repeated execution"""
+    return ParLoop(kernel, it_space, *args)
 
 class ParLoop(op2.ParLoop):
 
+    def __call__(self):
+        """Execute this parallel loop straight away, bumping the versions of
+        the data written like :meth:`base.ParLoop.enqueue`."""
+        for data in self.writes:
+            data._version += 1
+        self.compute()
+        _stream.synchronize()
+        return self
+
     def launch_configuration(self):
         if self._is_direct:
             max_smem = self._max_shared_memory_needed_per_set_element
@@ -37,10 +37,13 @@ try:
 # from PyPI
 except ImportError:
     from ordereddict import OrderedDict
+from hashlib import md5
+import os
 import numpy
 import op_lib_core as core
 import base
 from base import *
+import configuration as cfg
 
 class Arg(base.Arg):
 
@@ -131,6 +134,7 @@ class DeviceDataMixin(object):
         self._from_device()
         if self.state is not DeviceDataMixin.DEVICE_UNALLOCATED:
             self.state = DeviceDataMixin.HOST
+        self._version += 1
         return self._data
 
     @data.setter
@@ -139,6 +143,7 @@ class DeviceDataMixin(object):
         self._data = verify_reshape(value, self.dtype, self._data.shape)
         if self.state is not DeviceDataMixin.DEVICE_UNALLOCATED:
             self.state = DeviceDataMixin.HOST
+        self._version += 1
 
     @property
     def data_ro(self):
@@ -219,6 +224,7 @@ class Const(DeviceDataMixin, base.Const):
     def data(self, value):
         self._data = verify_reshape(value, self.dtype, self.dim)
         self.state = DeviceDataMixin.HOST
+        self._version += 1
 
     def _to_device(self):
         raise RuntimeError("Abstract device class can't do this")
@@ -242,6 +248,12 @@ class Map(base.Map):
             raise MapValueError("Map values must be populated.")
         base.Map.__init__(self, iterset, dataset, dim, values, name)
 
+    def _values_changed(self):
+        base.Map._values_changed(self)
+        # The new values are uploaded on next use
+        if hasattr(self, '_device_values'):
+            del self._device_values
+
     def _to_device(self):
         raise RuntimeError("Abstract device class can't do this")
 
@@ -249,8 +261,12 @@ class Map(base.Map):
         raise RuntimeError("Abstract device class can't do this")
 
 class Mat(base.Mat):
-    def __init__(self, datasets, dtype=None, name=None):
-        base.Mat.__init__(self, datasets, dtype, name)
+    # Device backends have their own matrix storage and ignore the format
+    _is_lma = False
+    _cache_assembly = False
+
+    def __init__(self, datasets, dtype=None, name=None, format=None):
+        base.Mat.__init__(self, datasets, dtype, name, format)
         self.state = DeviceDataMixin.DEVICE_UNALLOCATED
 
 
@@ -265,8 +281,13 @@ class _GenericPlan(base.Cached):
             return
         partition_size = kwargs.get('partition_size', 0)
         matrix_coloring = kwargs.get('matrix_coloring', False)
+        staging = kwargs.get('staging', True)
+        thread_coloring = kwargs.get('thread_coloring', True)
+        block_coloring = kwargs.get('block_coloring', 'greedy')
+        compact = kwargs.get('compact', False)
 
-        key = (iset.size, partition_size, matrix_coloring)
+        key = (iset.size, partition_size, matrix_coloring, staging, thread_coloring,
+               block_coloring, compact)
 
         # For each indirect arg, the map, the access type, and the
         # indices into the map are important
@@ -284,9 +305,16 @@ class _GenericPlan(base.Cached):
 
         # order of indices doesn't matter
         subkey = ('dats', )
+        # Number the dats in order of appearance: the plan colours arguments
+        # sharing a dat together, so which arguments alias matters
+        dats = {}
         for k,v in inds.iteritems():
-            # Only dimension of dat matters, but identity of map does
-            subkey += (k[0].cdim, k[1:],) + tuple(sorted(v))
+            # Only dimension and item size of dat and the values of the map
+            # matter, such that equivalent maps share plans and no map is
+            # kept alive by the cache
+            alias = dats.setdefault(k[0], len(dats))
+            subkey += (alias, k[0].cdim, k[0].dtype.itemsize, k[1]._content_hash, k[2]) \
+                + tuple(sorted(v))
         key += subkey
 
         # For each matrix arg, the maps and indices
@@ -297,7 +325,7 @@ class _GenericPlan(base.Cached):
                 # and the associated iteration index
                 idxs = (arg.idx[0].__class__,
                         arg.idx[0].index)
-                subkey += (as_tuple(arg.map[0]), idxs)
+                subkey += (arg.map[0]._content_hash, idxs)
         key += subkey
 
         return key
@@ -313,8 +341,32 @@ class PPlan(_GenericPlan, core.Plan):
     """
     PyOP2's cython plan function.
         Support matrix coloring, selective staging and thread color computation.
+        Plans are stored on disk if a plan_cache_dir is configured.
+        Compact plans drop the ind_map padding and narrow color arrays.
     """
-    pass
+
+    # Bump when the layout of the stored plan arrays changes
+    _disk_version = 1
+
+    @classmethod
+    def _process_args(cls, kernel, iset, *args, **kwargs):
+        kwargs.setdefault('block_coloring', cfg['plan_block_coloring'])
+        cachedir = cfg['plan_cache_dir']
+        if cachedir:
+            key = cls._cache_key(kernel, iset, *args, **kwargs)
+            # The in-memory key only contains sizes, flags and map content
+            # hashes, so its string representation is stable across runs
+            if key:
+                if not os.path.exists(cachedir):
+                    try:
+                        os.makedirs(cachedir)
+                    except OSError:
+                        # Another process may have created it in the meantime
+                        if not os.path.isdir(cachedir):
+                            raise
+                h = md5(str((cls._disk_version,) + key)).hexdigest()
+                kwargs['cache_path'] = os.path.join(cachedir, h)
+        return (kernel, iset) + args, kwargs
 
 # _GenericPlan, CPlan, and PPlan are not meant to be instantiated directly.
 # one should instead use Plan. The actual class that is instanciated is defined
@@ -59,6 +59,10 @@ class Mat(object):
     def __init__(self, *args):
         raise RuntimeError("op2.exit has been called")
 
+class MatrixFree(object):
+    def __init__(self, *args):
+        raise RuntimeError("op2.exit has been called")
+
 class Const(object):
     def __init__(self, *args):
         raise RuntimeError("op2.exit has been called")
@@ -71,5 +75,12 @@ class Map(object):
     def __init__(self, *args):
         raise RuntimeError("op2.exit has been called")
 
+class LoopChain(object):
+    def __init__(self, *args):
+        raise RuntimeError("op2.exit has been called")
+
 def par_loop(*args):
     raise RuntimeError("op2.exit has been called")
+
+def prepare_par_loop(*args):
+    raise RuntimeError("op2.exit has been called")
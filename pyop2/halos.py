@@ -0,0 +1,190 @@
+# This file is part of PyOP2
+#
+# PyOP2 is Copyright (c) 2012, Imperial College London and
+# others. Please see the AUTHORS file in the main source directory for
+# a full list of copyright holders.  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * The name of Imperial College London or that of other
+#       contributors may not be used to endorse or promote products
+#       derived from this software without specific prior written
+#       permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTERS
+# ''AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Construction of layered halos for distributed meshes.
+
+A mesh distributed over several ranks gives each rank the entities it owns
+together with copies of entities owned by other ranks which its computation
+touches. This module orders the elements of an iteration set and the
+entities a :class:`Map` maps them to into the core, owned, execute halo
+layers and non-execute halo levels expected by :class:`Set`, and builds the
+:class:`Halo` objects updating the copies. The halos carry the
+cross-process numbering :class:`Mat` objects on the sets are assembled
+with.
+
+With ``k`` layers, layer ``j`` of the iteration set holds the copied
+elements mapping to an entity of a layer below ``j`` of the dataset, and
+layer ``j`` of the dataset holds the copied entities first mapped to by an
+element of a layer up to ``j``. Executing a loop over ``j`` layers of
+elements therefore reads entities of no more than ``j`` layers and
+completes the increments of the entities of the first ``j-1`` layers.
+
+The sets and the map are created from the result, after permuting the data
+defined on the sets, for example::
+
+    (cperm, csizes, chalo), (nperm, nsizes, nhalo), values = \\
+        halos.build(cell_node, cell_owner, node_owner, cell_ids, node_ids, 2)
+    cells = op2.Set(csizes, 1, "cells", halo=chalo)
+    nodes = op2.Set(nsizes, 1, "nodes", halo=nhalo)
+    cell2node = op2.Map(cells, nodes, 3, values, "cell2node")
+    u = op2.Dat(nodes, node_values[nperm], numpy.float64, "u")
+
+Permutations are arrays ``perm`` such that the entity numbered ``i`` in
+the new numbering was numbered ``perm[i]`` before.
+"""
+
+import numpy as np
+
+from base import Halo
+from mpi import MPI
+
+def build(values, iterset_owner, dataset_owner, iterset_numbering,
+          dataset_numbering, layers=1):
+    """Order the local elements of an iteration set and the local entities
+    they map to and build the halos of both with ``layers`` layers of
+    execute halo.
+
+    :arg values: the map values, for each local element the local entities
+        it maps to
+    :arg iterset_owner: the rank owning each local element
+    :arg dataset_owner: the rank owning each local entity
+    :arg iterset_numbering: the global number of each local element
+    :arg dataset_numbering: the global number of each local entity
+    :arg layers: the number of execute halo layers; the local part of the
+        mesh needs to contain all elements and entities of these layers
+
+    :returns: a triple of a ``(perm, sizes, halo)`` triple for the iteration
+        set, one for the dataset and the map values in the new numbering,
+        where ``sizes`` is the list of sizes to create the :class:`Set`
+        with."""
+    comm = MPI.comm
+    iterset_owner = np.asarray(iterset_owner, dtype=np.int32)
+    dataset_owner = np.asarray(dataset_owner, dtype=np.int32)
+    values = np.asarray(values, dtype=np.int32).reshape(len(iterset_owner), -1)
+    ilayer, dlayer = _layers(values, iterset_owner == comm.rank,
+                             dataset_owner == comm.rank, layers)
+    isends, ireceives = _exchange_numbering(iterset_owner, iterset_numbering, comm)
+    dsends, dreceives = _exchange_numbering(dataset_owner, dataset_numbering, comm)
+
+    # Core entities are owned and not copied by another rank, core elements
+    # are owned and only map to owned entities
+    dcore = dlayer == 0
+    for sends in dsends:
+        dcore[sends] = False
+    icore = (ilayer == 0) & (dlayer[values] == 0).all(axis=1)
+
+    iperm, isizes = _order(ilayer, icore, layers)
+    dperm, dsizes = _order(dlayer, dcore, layers)
+    ihalo = _halo(_inverse(iperm), isizes, isends, ireceives, comm)
+    diperm = _inverse(dperm)
+    dhalo = _halo(diperm, dsizes, dsends, dreceives, comm)
+    return (iperm, isizes, ihalo), (dperm, dsizes, dhalo), diperm[values[iperm]]
+
+def _halo(iperm, sizes, sends, receives, comm):
+    """Return the :class:`Halo` of entities ordered by the inverse
+    permutation ``iperm`` into levels ending at ``sizes``."""
+    sends = [iperm[s] for s in sends]
+    receives = [iperm[r] for r in receives]
+    numbering = _petsc_numbering(sizes[1], sizes[-1], sends, receives, comm)
+    return Halo(sends, receives, gnn2unn=numbering)
+
+def _petsc_numbering(size, total_size, sends, receives, comm):
+    """Return the cross-process number of each of the ``total_size`` local
+    entities, of which the first ``size`` are owned. Owned entities are
+    numbered contiguously in order of the ranks, copies are given the number
+    their owner sends along."""
+    offset = comm.scan(size) - size
+    numbering = np.empty(total_size, dtype=np.int32)
+    numbering[:size] = np.arange(offset, offset + size, dtype=np.int32)
+    received = comm.alltoall([numbering[s] for s in sends])
+    for r, numbers in zip(receives, received):
+        numbering[r] = numbers
+    return numbering
+
+def _layers(values, iterset_owned, dataset_owned, layers):
+    """Return the execute halo layer of each element and entity, 0 for owned
+    ones and -1 for those in no layer."""
+    ilayer = np.where(iterset_owned, 0, -1)
+    dlayer = np.where(dataset_owned, 0, -1)
+    for j in range(1, layers + 1):
+        reached = (dlayer[values] >= 0).any(axis=1)
+        ilayer[(ilayer < 0) & reached] = j
+        touched = np.unique(values[ilayer >= 0])
+        dlayer[touched[dlayer[touched] < 0]] = j
+    return ilayer, dlayer
+
+def _exchange_numbering(owner, numbering, comm):
+    """Return the local entities each rank receives from this rank and the
+    local entities this rank receives from each rank, both sorted by their
+    global number such that the sends of one rank match the receives of the
+    other."""
+    numbering = np.asarray(numbering)
+    receives = []
+    for rank in range(comm.size):
+        if rank == comm.rank:
+            receives.append(np.zeros(0, dtype=np.int32))
+            continue
+        ele = np.flatnonzero(owner == rank)
+        receives.append(ele[np.argsort(numbering[ele], kind='mergesort')].astype(np.int32))
+    requested = comm.alltoall([numbering[ele] for ele in receives])
+
+    owned = np.flatnonzero(owner == comm.rank)
+    owned = owned[np.argsort(numbering[owned], kind='mergesort')]
+    owned_numbers = numbering[owned]
+    sends = []
+    for rank, numbers in enumerate(requested):
+        pos = np.searchsorted(owned_numbers, numbers)
+        found = pos < owned_numbers.size
+        found[found] = owned_numbers[pos[found]] == numbers[found]
+        if not found.all():
+            raise ValueError("Rank %d requested entities not owned by rank %d" \
+                    % (rank, comm.rank))
+        sends.append(owned[pos].astype(np.int32))
+    return sends, receives
+
+def _order(layer, core, layers):
+    """Return the permutation ordering the entities by level, core, owned,
+    each execute halo layer and non-execute halo, and the end of each
+    level."""
+    level = np.where(layer < 0, layers + 2, layer + 1)
+    level[core] = 0
+    perm = np.argsort(level, kind='mergesort').astype(np.int32)
+    sizes = np.cumsum(np.bincount(level, minlength=layers + 3))
+    return perm, [int(s) for s in sizes]
+
+def _inverse(perm):
+    """Return the inverse of the permutation ``perm``."""
+    iperm = np.empty_like(perm)
+    iperm[perm] = np.arange(len(perm), dtype=np.int32)
+    return iperm
@@ -35,12 +35,19 @@
 common to backends executing on the host."""
 
 from textwrap import dedent
+from hashlib import md5
+from distutils.spawn import find_executable
+import shutil
+import subprocess
+import tempfile
 
 import base
 from base import *
+from backends import _make_object
 from utils import as_tuple
 import configuration as cfg
 from find_op2 import *
+from logger import info
 
 class Arg(base.Arg):
 
@@ -57,12 +64,19 @@ class Arg(base.Arg):
         return self.c_arg_name() + "_map"
 
     def c_wrapper_arg(self):
-        val = "PyObject *_%(name)s" % {'name' : self.c_arg_name() }
+        if self._is_lma_mat:
+            # The element matrices are passed instead of the PETSc Mat
+            val = "PyObject *_%(name)s_vals" % {'name' : self.c_arg_name() }
+        else:
+            val = "PyObject *_%(name)s" % {'name' : self.c_arg_name() }
         if self._is_indirect or self._is_mat:
             val += ", PyObject *_%(name)s" % {'name' : self.c_map_name()}
             maps = as_tuple(self.map, Map)
             if len(maps) is 2:
                 val += ", PyObject *_%(name)s" % {'name' : self.c_map_name()+'2'}
+        if self._is_direct_mat:
+            val += ", PyObject *_%(name)s_vals, PyObject *_%(name)s_offsets" % \
+                   {'name' : self.c_arg_name()}
         return val
 
     def c_vec_dec(self):
@@ -72,7 +86,10 @@ class Arg(base.Arg):
                 'dim' : self.map.dim}
 
     def c_wrapper_dec(self):
-        if self._is_mat:
+        if self._is_lma_mat:
+            val = "%(type)s *%(name)s_vals = (%(type)s *)(((PyArrayObject *)_%(name)s_vals)->data)" % \
+                  {'name' : self.c_arg_name(), 'type' : self.ctype}
+        elif self._is_mat:
             val = "Mat %(name)s = (Mat)((uintptr_t)PyLong_AsUnsignedLong(_%(name)s))" % \
                  { "name": self.c_arg_name() }
         else:
@@ -84,6 +101,11 @@ class Arg(base.Arg):
         if self._is_mat:
             val += ";\nint *%(name)s2 = (int *)(((PyArrayObject *)_%(name)s2)->data)" % \
                        {'name' : self.c_map_name()}
+        if self._is_direct_mat:
+            val += ";\n%(type)s *%(name)s_vals = (%(type)s *)(((PyArrayObject *)_%(name)s_vals)->data)" % \
+                   {'name' : self.c_arg_name(), 'type' : self.ctype}
+            val += ";\nint *%(name)s_offsets = (int *)(((PyArrayObject *)_%(name)s_offsets)->data)" % \
+                   {'name' : self.c_arg_name()}
         if self._is_vec_map:
             val += self.c_vec_dec()
         return val
@@ -142,7 +164,47 @@ class Arg(base.Arg):
                         'data' : self.c_ind_data(i)} )
         return ";\n".join(val)
 
+    @property
+    def _is_direct_mat(self):
+        """Is the local tensor added straight into the values of the
+        matrix?"""
+        return self._is_mat and self.data._direct
+
+    @property
+    def _is_lma_mat(self):
+        """Is the local tensor stored as the element matrix of a matrix in
+        LMA format?"""
+        return self._is_mat and self.data._is_lma
+
+    def c_addto_direct(self):
+        """Add the local tensor into the matrix values at the offsets
+        precomputed for the element, see
+        :meth:`Sparsity._element_offsets`, or into the element matrix of a
+        matrix in LMA format."""
+        maps = as_tuple(self.map, Map)
+        rdim, cdim = self.data.sparsity.dims
+        size = rdim * cdim
+        if self.data._is_vector_field:
+            # The local tensor holds a single entry of the iteration space
+            offset = "((i * %d + i_0) * %d + i_1) * %d" % (maps[0].dim, maps[1].dim, size)
+        else:
+            size *= maps[0].dim * maps[1].dim
+            offset = "i * %d" % size
+        if self._is_lma_mat:
+            entry = "%s + n" % offset
+        else:
+            entry = "%s_offsets[%s + n]" % (self.c_arg_name(), offset)
+        return "for ( int n = 0; n < %(size)d; n++ ) %(name)s_vals[%(entry)s] %(op)s ((%(t)s *)%(vals)s)[n]" % \
+            {'size' : size,
+             'name' : self.c_arg_name(),
+             'entry' : entry,
+             'op' : '=' if self.access == WRITE else '+=',
+             't' : self.ctype,
+             'vals' : self.c_kernel_arg_name()}
+
     def c_addto_scalar_field(self):
+        if self._is_direct_mat or self._is_lma_mat:
+            return self.c_addto_direct()
         maps = as_tuple(self.map, Map)
         nrows = maps[0].dim
         ncols = maps[1].dim
@@ -157,9 +219,19 @@ class Arg(base.Arg):
              'insert' : self.access == WRITE }
 
     def c_addto_vector_field(self):
+        if self._is_direct_mat or self._is_lma_mat:
+            return self.c_addto_direct()
         maps = as_tuple(self.map, Map)
         nrows = maps[0].dim
         ncols = maps[1].dim
+        if self.data.sparsity.block_sparse:
+            # The local tensor is a single block of the matrix
+            return 'addto_block(%(mat)s, %(vals)s, 1, %(rows)s, 1, %(cols)s, %(insert)d)' % \
+                {'mat' : self.c_arg_name(),
+                 'vals' : self.c_kernel_arg_name(),
+                 'rows' : "%s + i * %s + i_0" % (self.c_map_name(), nrows),
+                 'cols' : "%s2 + i * %s + i_1" % (self.c_map_name(), ncols),
+                 'insert' : self.access == WRITE }
         dims = self.data.sparsity.dims
         rmult = dims[0]
         cmult = dims[1]
@@ -206,11 +278,112 @@ class Arg(base.Arg):
         else:
             raise RuntimeError("Don't know how to zero temp array for %s" % self)
 
+# Compiler flags each kernel has been built with
+_compiler_flags = {}
+
+def compiler_flags():
+    """Return a dictionary mapping the name of each kernel compiled so far to
+    the list of compiler flags it was built with."""
+    return dict(_compiler_flags)
+
+def _profile_flags(kernel_name):
+    """Return the compiler flags the kernel ``kernel_name`` is built with.
+
+    These are taken from the ``compiler_profile`` selected in the
+    configuration, updated with any entry for the kernel in
+    ``compiler_kernel_overrides``. An override is either the name of another
+    profile or a dictionary of profile entries. A debug build always uses
+    ``-O0 -g``."""
+    if cfg.debug:
+        return ['-O0', '-g']
+    profiles = cfg['compiler_profiles']
+    def get_profile(name):
+        try:
+            return profiles[name]
+        except KeyError:
+            raise ValueError("Unknown compiler profile %s, must be one of %s" \
+                    % (name, profiles.keys()))
+    profile = dict(get_profile(cfg['compiler_profile']))
+    override = (cfg['compiler_kernel_overrides'] or {}).get(kernel_name)
+    if isinstance(override, basestring):
+        profile = dict(get_profile(override))
+    elif override:
+        profile.update(override)
+
+    flags = ['-O%s' % profile.get('opt_level', 2)]
+    if profile.get('debug_symbols'):
+        flags.append('-g')
+    if profile.get('march'):
+        flags.append('-march=%s' % profile['march'])
+    if profile.get('fast_math'):
+        flags.append('-ffast-math')
+    if profile.get('vectorize'):
+        flags.append('-ftree-vectorize')
+    flags += profile.get('extra_flags') or []
+    return flags
+
+_compilers = {}
+
+def _compiler_identity(cc):
+    """Resolved path and version banner of the compiler ``cc``, such that
+    modules built by a different or upgraded compiler are told apart. This is
+    only determined once per process."""
+    if cc not in _compilers:
+        path = find_executable(cc)
+        path = os.path.realpath(path) if path else cc
+        try:
+            version = subprocess.Popen([path, '--version'], stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT).communicate()[0]
+        except OSError:
+            version = ''
+        _compilers[cc] = (path, version)
+    return _compilers[cc]
+
+def _prune_disk_cache(cachedir, max_size):
+    """Remove the oldest compiled modules from ``cachedir`` until the total
+    size of the cache is below ``max_size`` MB. The most recently built
+    module is always kept. Modules removed concurrently by another process are
+    silently skipped. A module is only removed while holding the lock instant
+    takes to build or load it, such that no other process is using it."""
+    from instant.locking import get_lock, release_lock
+    entries = []
+    for name in os.listdir(cachedir):
+        path = os.path.join(cachedir, name)
+        if not os.path.isdir(path):
+            continue
+        try:
+            size = sum(os.path.getsize(os.path.join(root, f))
+                       for root, _, files in os.walk(path) for f in files)
+            entries.append((os.path.getmtime(path), size, path))
+        except OSError:
+            continue
+    entries.sort()
+    total = sum(e[1] for e in entries)
+    for _, size, path in entries[:-1]:
+        if total <= max_size * 1024 * 1024:
+            break
+        lock = get_lock(cachedir, os.path.basename(path))
+        try:
+            shutil.rmtree(path, ignore_errors=True)
+        finally:
+            release_lock(lock)
+        total -= size
+
 class JITModule(base.JITModule):
 
     _cppargs = []
     _system_headers = []
     _libraries = []
+    _cachedir = os.path.join(tempfile.gettempdir(),
+                             'pyop2-jit-cache-uid%d' % os.getuid())
+
+    @classmethod
+    def _cache_key(cls, kernel, itspace_extents, *args, **kwargs):
+        # The compiler flags are part of the key such that changing the
+        # compiler profile leads to a rebuild
+        return super(JITModule, cls)._cache_key(kernel, itspace_extents, *args, **kwargs) \
+                + (tuple(_profile_flags(kernel.name)),) \
+                + tuple((arg._is_direct_mat, arg._is_lma_mat) for arg in args if arg._is_mat)
 
     def __init__(self, kernel, itspace_extents, *args):
         # No need to protect against re-initialization since these attributes
@@ -241,23 +414,59 @@ class JITModule(base.JITModule):
 
         _const_decs = '\n'.join([const._format_declaration() for const in Const._definitions()]) + '\n'
 
+        cppargs = self._cppargs + _profile_flags(self._kernel.name)
+        _compiler_flags[self._kernel.name] = cppargs
+        include_dirs = [OP2_INC, get_petsc_dir()+'/include']
+        library_dirs = [OP2_LIB, get_petsc_dir()+'/lib']
+        libraries = ['op2_seq', 'petsc'] + self._libraries
+        source_directory = os.path.dirname(os.path.abspath(__file__))
+
+        # Compiled modules are cached on disk, keyed on everything that goes
+        # into building them. Instant looks up the module by this signature
+        # and serialises concurrent builds into the cache with a file lock.
+        cachedir = cfg['jit_cache_dir'] or self._cachedir
+        if not os.path.exists(cachedir):
+            try:
+                os.makedirs(cachedir)
+            except OSError:
+                # Another process may have created it in the meantime
+                if not os.path.isdir(cachedir):
+                    raise
+        key = md5(code_to_compile + kernel_code + _const_decs)
+        for f in ["mat_utils.h", "mat_utils.cxx"]:
+            with open(os.path.join(source_directory, f)) as src:
+                key.update(src.read())
+        key.update(str((_compiler_identity('mpicc'), cppargs, include_dirs,
+                        library_dirs, libraries, self._system_headers,
+                        get_petsc_dir())))
+        cached = set(os.listdir(cachedir))
+
         # We need to build with mpicc since that's required by PETSc
         cc = os.environ.get('CC')
         os.environ['CC'] = 'mpicc'
         self._fun = inline_with_numpy(code_to_compile, additional_declarations = kernel_code,
                                  additional_definitions = _const_decs + kernel_code,
-                                 cppargs=self._cppargs + ['-O0', '-g'] if cfg.debug else [],
-                                 include_dirs=[OP2_INC, get_petsc_dir()+'/include'],
-                                 source_directory=os.path.dirname(os.path.abspath(__file__)),
+                                 cppargs=cppargs,
+                                 include_dirs=include_dirs,
+                                 source_directory=source_directory,
                                  wrap_headers=["mat_utils.h"],
                                  system_headers=self._system_headers,
-                                 library_dirs=[OP2_LIB, get_petsc_dir()+'/lib'],
-                                 libraries=['op2_seq', 'petsc'] + self._libraries,
-                                 sources=["mat_utils.cxx"])
+                                 library_dirs=library_dirs,
+                                 libraries=libraries,
+                                 sources=["mat_utils.cxx"],
+                                 signature='pyop2_' + key.hexdigest(),
+                                 cache_dir=cachedir)
         if cc:
             os.environ['CC'] = cc
         else:
             os.environ.pop('CC')
+        built = [n for n in set(os.listdir(cachedir)) - cached
+                 if os.path.isdir(os.path.join(cachedir, n))]
+        if built:
+            info("Compiled kernel %s with flags %s" % (self._kernel.name, ' '.join(cppargs)))
+        # Only prune the cache if we had to build a new module
+        if cfg['jit_cache_max_size'] and built:
+            _prune_disk_cache(cachedir, cfg['jit_cache_max_size'])
         return self._fun
 
     def generate_code(self):
@@ -320,3 +529,127 @@ class JITModule(base.JITModule):
                 'kernel_args': _kernel_args,
                 'addtos_vector_field': indent(_addtos_vector_field, 2 + nloops),
                 'addtos_scalar_field': indent(_addtos_scalar_field, 2)}
+
+class ParLoop(base.ParLoop):
+
+    # Compiled wrapper and marshaled arguments, built on first execution
+    _prepared = None
+
+    def _jit_args(self):
+        """Return the compiled wrapper for this loop and the list of arguments
+        to call it with.
+
+        Both are built on the first execution only and reused by subsequent
+        executions, which merely refresh the data arrays of the arguments.
+        Declaring or removing a :class:`Const` or modifying the values of a
+        :class:`Map` of the arguments, which the plan and matrix offsets are
+        derived from, causes them to be rebuilt.
+        Pending reductions of :class:`Global` arguments are completed first."""
+        key = (Const._definitions(),
+               tuple(m._version for arg in self.args if arg.map is not None
+                     for m in as_tuple(arg.map, Map)))
+        if self._prepared is None or self._prepared[0] != key:
+            self._prepared = (key,) + self._build_jit_args()
+        _, fun, _args, refresh = self._prepared
+        for arg in self.args:
+            if arg._is_global:
+                arg.data._reduction_wait()
+        for i, data in refresh:
+            _args[i] = data._data
+        for arg in self.args:
+            if arg._is_dat:
+                maybe_setflags(arg.data._data, write=False)
+        return fun, _args
+
+    def _build_jit_args(self):
+        """Return the compiled wrapper for this loop, the list of arguments to
+        call it with and a list of (position, data carrier) pairs giving the
+        arguments to refresh on every execution."""
+        raise NotImplementedError("_build_jit_args must be implemented by backend")
+
+    def _marshal_args(self, prefix):
+        """Append the data, maps and Consts of this loop to the list of
+        wrapper arguments ``prefix``. Return the list of arguments and the
+        (position, data carrier) pairs of the data arguments."""
+        _args = list(prefix)
+        refresh = []
+        for arg in self.args:
+            if arg._is_lma_mat:
+                _args.append(arg.data._lmadat(*arg.map)._data)
+            elif arg._is_mat:
+                _args.append(arg.data._petsc_handle.handle)
+            else:
+                refresh.append((len(_args), arg.data))
+                _args.append(arg.data._data)
+
+            if arg._is_indirect or arg._is_mat:
+                maps = as_tuple(arg.map, Map)
+                for map in maps:
+                    _args.append(map._values)
+
+            if arg._is_direct_mat:
+                _args.append(arg.data._array)
+                _args.append(arg.data.sparsity._element_offsets(*arg.map))
+
+        for c in Const._definitions():
+            refresh.append((len(_args), c))
+            _args.append(c._data)
+        return _args, refresh
+
+    def _fusable_with(self, other):
+        """Can ``other`` be fused with this loop into a single generated
+        wrapper? This is the case for direct loops over the same iteration set
+        without a local iteration space, which do not share a :class:`Global`
+        other than for reading and do not call distinct kernels of the same
+        name."""
+        if not isinstance(other, ParLoop) or self.is_indirect or other.is_indirect:
+            return False
+        if self.it_space.iterset is not other.it_space.iterset or \
+           self.it_space.extents or other.it_space.extents:
+            return False
+        if self.kernel.name == other.kernel.name and self.kernel is not other.kernel:
+            return False
+        for a in self.args:
+            for b in other.args:
+                if a._is_global and a.data is b.data and \
+                   (a.access is not READ or b.access is not READ):
+                    return False
+        return True
+
+    def _fuse(self, loops):
+        """Fuse this loop with the direct ``loops`` following it. The fused
+        loop calls each kernel in turn for every element of the iteration set,
+        such that data touched by several of the kernels is only streamed
+        once."""
+        loops = [self] + list(loops)
+        args = []
+        kernels = []
+        calls = []
+        for loop in loops:
+            if loop.kernel not in kernels:
+                kernels.append(loop.kernel)
+            params = []
+            for arg in loop.args:
+                for i, a in enumerate(args):
+                    if a.data is arg.data:
+                        # Data accessed by several loops is both read and written
+                        if a.access is not arg.access:
+                            args[i] = arg.data(IdentityMap, RW)
+                        break
+                else:
+                    i = len(args)
+                    args.append(arg)
+                params.append("arg%d" % i)
+            calls.append("%s(%s);" % (loop.kernel.name, ', '.join(params)))
+        name = "fused_" + "_".join(loop.kernel.name for loop in loops)
+        code = """
+%(kernels)s
+inline void %(name)s(%(params)s) {
+  %(calls)s
+}
+""" % {'kernels': '\ninline '.join(k.code for k in kernels),
+       'name': name,
+       'params': ', '.join("%s *arg%d" % (a.ctype, i) for i, a in enumerate(args)),
+       'calls': '\n  '.join(calls)}
+        return self.__class__(_make_object('Kernel', code, name),
+                              self.it_space, *args)
@@ -26,3 +26,16 @@ void addto_vector(Mat mat, const void *values,
                 (const PetscScalar *)values,
                 insert ? INSERT_VALUES : ADD_VALUES );
 }
+
+void addto_block(Mat mat, const void *values,
+                 int nrows, const int *irows,
+                 int ncols, const int *icols, int insert)
+{
+  assert( mat && values && irows && icols );
+  // FIMXE: this assumes we're getting a PetscScalar
+  MatSetValuesBlockedLocal( mat,
+                nrows, (const PetscInt *)irows,
+                ncols, (const PetscInt *)icols,
+                (const PetscScalar *)values,
+                insert ? INSERT_VALUES : ADD_VALUES );
+}
@@ -0,0 +1,11 @@
+#ifndef _OMP_COMPAT_H
+#define _OMP_COMPAT_H
+
+/* Allow building without OpenMP support, running on a single thread */
+#ifdef _OPENMP
+#include <omp.h>
+#else
+static inline int omp_get_max_threads(void) { return 1; }
+#endif
+
+#endif // _OMP_COMPAT_H
@@ -53,6 +53,22 @@ def init(**kwargs):
      are ``"sequential"``, ``"openmp"``, ``"opencl"`` and ``"cuda"``.
     :arg debug: The level of debugging output.
     :arg comm: The MPI communicator to use for parallel communication, defaults to `MPI_COMM_WORLD`
+    :arg lazy_evaluation: Delay the execution of :func:`par_loop` calls until
+     their results are required (sequential and openmp backends only).
+    :arg loop_fusion: Fuse consecutive direct :func:`par_loop` calls over the
+     same :class:`Set` into a single loop when lazy evaluation is enabled.
+    :arg halo_exchange_aggregate: Exchange the halos of all :class:`Dat`
+     arguments of a :func:`par_loop`, or of all loops evaluated together when
+     lazy evaluation is enabled, with one message per neighbouring rank
+     instead of one per :class:`Dat`.
+    :arg compiler_profile: The compiler profile to build generated host code
+     with, one of the ``compiler_profiles`` in the configuration
+     (``"debug"``, ``"default"`` or ``"production"`` by default).
+    :arg plan_cache_dir: Directory to store execution plans in, such that
+     later runs on the same mesh skip plan construction (device and openmp
+     backends only).
+    :arg sparsity_cache_dir: Directory to store sparsity patterns in, such
+     that later runs on the same mesh skip building them.
 
     .. note::
        Calling ``init`` again with a different backend raises an exception.
@@ -84,6 +100,8 @@ def init(**kwargs):
 @atexit.register
 def exit():
     """Exit OP2 and clean up"""
+    # Carry out any delayed computation before tearing down
+    base._trace.evaluate_all()
     cfg.reset()
     if backends.get_backend() != 'pyop2.void':
         core.op_exit()
@@ -107,6 +125,9 @@ class Dat(base.Dat):
 class Mat(base.Mat):
     __metaclass__ = backends._BackendSelector
 
+class MatrixFree(base.MatrixFree):
+    __metaclass__ = backends._BackendSelector
+
 class Const(base.Const):
     __metaclass__ = backends._BackendSelector
 
@@ -122,6 +143,9 @@ class Sparsity(base.Sparsity):
 class Solver(base.Solver):
     __metaclass__ = backends._BackendSelector
 
+class LoopChain(base.LoopChain):
+    __metaclass__ = backends._BackendSelector
+
 def par_loop(kernel, it_space, *args):
     """Invocation of an OP2 kernel
 
@@ -157,7 +181,26 @@ def par_loop(kernel, it_space, *args):
     """
     return backends._BackendSelector._backend.par_loop(kernel, it_space, *args)
 
-@validate_type(('M', base.Mat, MatTypeError),
+def prepare_par_loop(kernel, it_space, *args):
+    """Prepare a :func:`par_loop` for repeated execution.
+
+    Takes the same arguments as :func:`par_loop` and returns a callable
+    object executing the parallel loop with the current data of its
+    arguments every time it is called::
+
+      update = op2.prepare_par_loop(update_kernel, nodes,
+                                    x(op2.IdentityMap, op2.RW),
+                                    r(op2.IdentityMap, op2.READ))
+      for i in range(niter):
+          update()
+
+    The arguments are validated and the generated code is looked up once,
+    such that repeated execution only incurs the cost of passing the data to
+    the compiled code. Supported by the sequential and openmp backends.
+    """
+    return backends._BackendSelector._backend.prepare_par_loop(kernel, it_space, *args)
+
+@validate_type(('M', (base.Mat, base.MatrixFree), MatTypeError),
                ('x', base.Dat, DatTypeError),
                ('b', base.Dat, DatTypeError))
 def solve(M, x, b):
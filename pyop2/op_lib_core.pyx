@@ -532,67 +532,114 @@ device's "block" address plus an offset which is
         """Number of times this plan has been used"""
         return self._handle().count
 
-def free_sparsity(object sparsity):
-    cdef np.ndarray tmp
-    for attr in ['_rowptr', '_colidx', '_d_nnz', '_o_nnz']:
-        try:
-            tmp = getattr(sparsity, attr)
-            free(<void *>np.PyArray_DATA(tmp))
-        except:
-            pass
+cdef class _SparsityMaps:
+    """C handles of the row and column maps of a sparsity."""
+    cdef int nmaps
+    cdef core.op_map *rmaps
+    cdef core.op_map *cmaps
+
+    def __cinit__(self, object sparsity):
+        cdef op_map rmap, cmap
+        self.nmaps = len(sparsity._rmaps)
+        self.rmaps = <core.op_map *>malloc(self.nmaps * sizeof(core.op_map))
+        if self.rmaps is NULL:
+            raise MemoryError("Unable to allocate space for rmaps")
+        self.cmaps = <core.op_map *>malloc(self.nmaps * sizeof(core.op_map))
+        if self.cmaps is NULL:
+            raise MemoryError("Unable to allocate space for cmaps")
+        for i in range(self.nmaps):
+            rmap = sparsity._rmaps[i]._c_handle
+            cmap = sparsity._cmaps[i]._c_handle
+            self.rmaps[i] = rmap._handle
+            self.cmaps[i] = cmap._handle
+
+    def __dealloc__(self):
+        free(self.rmaps)
+        free(self.cmaps)
 
 def build_sparsity(object sparsity, bool parallel):
+    """Build the sparsity pattern of SPARSITY, writing the row pointer, column
+indices and numbers of nonzeros into NumPy arrays owned by SPARSITY.
+
+A block sparse SPARSITY gets one entry per block rather than per scalar."""
     cdef int rmult, cmult
-    rmult, cmult = sparsity._dims
+    rmult, cmult = sparsity._block_dims
     cdef int nrows = sparsity._nrows
     cdef int lsize = nrows*rmult
-    cdef op_map rmap, cmap
-    cdef int nmaps = len(sparsity._rmaps)
-    cdef int *d_nnz, *o_nnz, *rowptr, *colidx
+    cdef _SparsityMaps maps = _SparsityMaps(sparsity)
+    cdef np.ndarray d_nnz = np.empty(lsize, dtype=np.int32)
+    cdef np.ndarray o_nnz, rowptr, colidx
+    cdef int *d_nnz_p = <int *>np.PyArray_DATA(d_nnz)
+    cdef int *o_nnz_p, *rowptr_p, *colidx_p
     cdef int d_nz, o_nz
 
-    cdef core.op_map *rmaps = <core.op_map *>malloc(nmaps * sizeof(core.op_map))
-    if rmaps is NULL:
-        raise MemoryError("Unable to allocate space for rmaps")
-    cdef core.op_map *cmaps = <core.op_map *>malloc(nmaps * sizeof(core.op_map))
-    if cmaps is NULL:
-        raise MemoryError("Unable to allocate space for cmaps")
+    if parallel:
+        o_nnz = np.empty(lsize, dtype=np.int32)
+        o_nnz_p = <int *>np.PyArray_DATA(o_nnz)
+        with nogil:
+            core.build_sparsity_nnz_mpi(rmult, cmult, nrows, maps.nmaps,
+                                        maps.rmaps, maps.cmaps,
+                                        d_nnz_p, o_nnz_p, &d_nz, &o_nz)
+        sparsity._d_nnz = d_nnz
+        sparsity._o_nnz = o_nnz
+        sparsity._rowptr = []
+        sparsity._colidx = []
+        sparsity._d_nz = d_nz
+        sparsity._o_nz = o_nz
+    else:
+        rowptr = np.empty(lsize+1, dtype=np.int32)
+        rowptr_p = <int *>np.PyArray_DATA(rowptr)
+        with nogil:
+            core.build_sparsity_rowptr_seq(rmult, cmult, nrows, maps.nmaps,
+                                           maps.rmaps, maps.cmaps,
+                                           d_nnz_p, rowptr_p)
+        colidx = np.empty(rowptr_p[lsize], dtype=np.int32)
+        colidx_p = <int *>np.PyArray_DATA(colidx)
+        with nogil:
+            core.build_sparsity_colidx_seq(rmult, cmult, nrows, maps.nmaps,
+                                           maps.rmaps, maps.cmaps,
+                                           rowptr_p, colidx_p)
+        sparsity._d_nnz = d_nnz
+        sparsity._o_nnz = []
+        sparsity._rowptr = rowptr
+        sparsity._colidx = colidx
+        sparsity._d_nz = rowptr_p[lsize]
+        sparsity._o_nz = 0
+
+def build_sparsity_reference(object sparsity, bool parallel):
+    """Build the sparsity pattern of SPARSITY with the std::set based builder
+the sparsity used to be built with, for testing and benchmarking.
+
+Returns copies of the numbers of nonzeros per row of the diagonal and
+off-diagonal portion, the row pointer and the column indices."""
+    cdef int rmult, cmult
+    rmult, cmult = sparsity._block_dims
+    cdef int nrows = sparsity._nrows
+    cdef int lsize = nrows*rmult
+    cdef _SparsityMaps maps = _SparsityMaps(sparsity)
+    cdef int *d_nnz, *o_nnz, *rowptr, *colidx
+    cdef int d_nz, o_nz
 
-    try:
-        for i in range(nmaps):
-            rmap = sparsity._rmaps[i]._c_handle
-            cmap = sparsity._cmaps[i]._c_handle
-            rmaps[i] = rmap._handle
-            cmaps[i] = cmap._handle
-
-        if parallel:
-            core.build_sparsity_pattern_mpi(rmult, cmult, nrows, nmaps,
-                                            rmaps, cmaps, &d_nnz, &o_nnz,
-                                            &d_nz, &o_nz)
-            sparsity._d_nnz = data_to_numpy_array_with_spec(d_nnz, lsize,
-                                                            np.NPY_INT32)
-            sparsity._o_nnz = data_to_numpy_array_with_spec(o_nnz, lsize,
-                                                            np.NPY_INT32)
-            sparsity._rowptr = []
-            sparsity._colidx = []
-            sparsity._d_nz = d_nz
-            sparsity._o_nz = o_nz
-        else:
-            core.build_sparsity_pattern_seq(rmult, cmult, nrows, nmaps,
-                                            rmaps, cmaps,
-                                            &d_nnz, &rowptr, &colidx, &d_nz)
-            sparsity._d_nnz = data_to_numpy_array_with_spec(d_nnz, lsize,
-                                                            np.NPY_INT32)
-            sparsity._o_nnz = []
-            sparsity._rowptr = data_to_numpy_array_with_spec(rowptr, lsize+1,
-                                                            np.NPY_INT32)
-            sparsity._colidx = data_to_numpy_array_with_spec(colidx,
-                                                            rowptr[lsize],
-                                                            np.NPY_INT32)
-            sparsity._d_nz = d_nz
-            sparsity._o_nz = 0
-    finally:
-        free(rmaps)
-        free(cmaps)
+    if parallel:
+        core.build_sparsity_pattern_mpi(rmult, cmult, nrows, maps.nmaps,
+                                        maps.rmaps, maps.cmaps,
+                                        &d_nnz, &o_nnz, &d_nz, &o_nz)
+        result = (data_to_numpy_array_with_spec(d_nnz, lsize, np.NPY_INT32).copy(),
+                  data_to_numpy_array_with_spec(o_nnz, lsize, np.NPY_INT32).copy(),
+                  None, None)
+        free(d_nnz)
+        free(o_nnz)
+    else:
+        core.build_sparsity_pattern_seq(rmult, cmult, nrows, maps.nmaps,
+                                        maps.rmaps, maps.cmaps,
+                                        &d_nnz, &rowptr, &colidx, &d_nz)
+        result = (data_to_numpy_array_with_spec(d_nnz, lsize, np.NPY_INT32).copy(),
+                  None,
+                  data_to_numpy_array_with_spec(rowptr, lsize+1, np.NPY_INT32).copy(),
+                  data_to_numpy_array_with_spec(colidx, d_nz, np.NPY_INT32).copy())
+        free(d_nnz)
+        free(rowptr)
+        free(colidx)
+    return result
 
 include "plan.pyx"
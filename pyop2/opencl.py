@@ -292,6 +292,7 @@ class Global(device.Global, DeviceDataMixin):
         self._data = verify_reshape(value, self.dtype, self.dim)
         if self.state is not DeviceDataMixin.DEVICE_UNALLOCATED:
             self.state = DeviceDataMixin.HOST
+        self._version += 1
 
     def _post_kernel_reduction_task(self, nelems, reduction_operator):
         assert reduction_operator in [INC, MIN, MAX]
@@ -508,6 +509,15 @@ class JITModule(base.JITModule):
                                    (work_group_size,), g_times_l=False).wait()
 
 class ParLoop(device.ParLoop):
+
+    def __call__(self):
+        """Execute this parallel loop straight away, bumping the versions of
+        the data written like :meth:`base.ParLoop.enqueue`."""
+        for data in self.writes:
+            data._version += 1
+        self.compute()
+        return self
+
     @property
     def _matrix_args(self):
         return [a for a in self.args if a._is_mat]
@@ -683,7 +693,11 @@ class ParLoop(device.ParLoop):
             op2stride.remove_from_namespace()
 
 def par_loop(kernel, it_space, *args):
-    ParLoop(kernel, it_space, *args).compute()
+    ParLoop(kernel, it_space, *args)()
+
+def prepare_par_loop(kernel, it_space, *args):
+    """Prepare an OP2 kernel invocation for repeated execution"""
+    return ParLoop(kernel, it_space, *args)
 
 def _setup():
     global _ctx
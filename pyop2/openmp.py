@@ -118,7 +118,11 @@ class Arg(host.Arg):
 
 def par_loop(kernel, it_space, *args):
     """Invocation of an OP2 kernel with an access descriptor"""
-    ParLoop(kernel, it_space, *args).compute()
+    ParLoop(kernel, it_space, *args).enqueue()
+
+def prepare_par_loop(kernel, it_space, *args):
+    """Prepare an OP2 kernel invocation for repeated execution"""
+    return ParLoop(kernel, it_space, *args)
 
 class JITModule(host.JITModule):
 
@@ -202,25 +206,9 @@ void wrap_%(kernel_name)s__(PyObject *_end, %(wrapper_args)s %(const_args)s,
 
 class ParLoop(device.ParLoop, host.ParLoop):
 
-    def compute(self):
+    def _build_jit_args(self):
         fun = JITModule(self.kernel, self.it_space.extents, *self.args)
-        _args = [self._it_space.size]
-        for arg in self.args:
-            if arg._is_mat:
-                _args.append(arg.data.handle.handle)
-            else:
-                _args.append(arg.data._data)
-
-            if arg._is_dat:
-                maybe_setflags(arg.data._data, write=False)
-
-            if arg._is_indirect or arg._is_mat:
-                maps = as_tuple(arg.map, Map)
-                for map in maps:
-                    _args.append(map.values)
-
-        for c in Const._definitions():
-            _args.append(c.data)
+        _args, refresh = self._marshal_args([self._it_space.size])
 
         part_size = 1024  #TODO: compute partition size
 
@@ -231,7 +219,8 @@ class ParLoop(device.ParLoop, host.ParLoop):
                                partition_size=part_size,
                                matrix_coloring=True,
                                staging=False,
-                               thread_coloring=False)
+                               thread_coloring=False,
+                               compact=True)
 
         else:
             # Create a fake plan for direct loops.
@@ -254,6 +243,10 @@ class ParLoop(device.ParLoop, host.ParLoop):
         _args.append(plan.ncolblk)
         _args.append(plan.nelems)
 
+        return fun, _args, refresh
+
+    def compute(self):
+        fun, _args = self._jit_args()
         fun(*_args)
 
         for arg in self.args:
@@ -42,6 +42,7 @@ required to implement backend-specific features.
 from petsc4py import PETSc
 import base
 from base import *
+from backends import _make_object
 from logger import debug
 import mpi
 
@@ -62,48 +63,135 @@ MPI = MPIConfig()
 # Override MPI configuration
 mpi.MPI = MPI
 
+def _expand(indices, dim):
+    """Expand the numbering ``indices`` of set elements into the numbering
+    of their ``dim`` components."""
+    indices = np.asarray(indices, dtype=PETSc.IntType)
+    if dim == 1:
+        return indices
+    return (dim * indices[:, np.newaxis] + np.arange(dim, dtype=PETSc.IntType)).ravel()
+
 class Dat(base.Dat):
 
     @property
     def vec(self):
         """PETSc Vec appropriate for this Dat."""
+        self._force_evaluation()
         if not hasattr(self, '_vec'):
             size = (self.dataset.size * self.cdim, None)
             self._vec = PETSc.Vec().createWithArray(self._data, size=size)
+        # The Vec shares the data and may be written to
+        self._version += 1
         return self._vec
 
 
+class Sparsity(base.Sparsity):
+    """OP2 Sparsity. Vector fields with square blocks are assembled into
+    blocked PETSc matrices, so the pattern has one entry per block."""
+
+    _blocked = True
+
+    def _element_offsets(self, rmap, cmap):
+        """Offsets into the CSR values of the entries each element of the
+        iteration set of the pair (``rmap``, ``cmap``) assembles into, with
+        shape (elements, row arity, column arity, row dim, column dim).
+
+        Allows the host backends to add the local tensor of an element
+        straight into the values array rather than going through
+        ``MatSetValuesLocal``, which searches the row for every entry. Only
+        valid for the sequential, non-blocked pattern."""
+        if not hasattr(self, '_offsets'):
+            self._offsets = {}
+        key = (rmap, rmap._version, cmap, cmap._version)
+        if key not in self._offsets:
+            rdim, cdim = self._dims
+            ncols = self._ncols * cdim
+            # Since the column indices are sorted within each row, the
+            # (row, column) pairs of the nonzeros are sorted as well
+            nzrows = np.repeat(np.arange(self._nrows * rdim, dtype=np.int64),
+                               np.diff(self._rowptr))
+            keys = nzrows * ncols + self._colidx
+            rows = rdim * rmap.values.astype(np.int64)[:, :, None] + np.arange(rdim)
+            cols = cdim * cmap.values.astype(np.int64)[:, :, None] + np.arange(cdim)
+            entries = rows[:, :, None, :, None] * ncols + cols[:, None, :, None, :]
+            self._offsets[key] = np.searchsorted(keys, entries).astype(np.int32)
+        return self._offsets[key]
+
+
 class Mat(base.Mat):
     """OP2 matrix data. A Mat is defined on a sparsity pattern and holds a value
-    for each element in the :class:`Sparsity`."""
+    for each element in the :class:`Sparsity`.
+
+    A Mat in ``'lma'`` format keeps the dense element matrix of every element
+    of the iteration set. Its :attr:`handle` is a PETSc shell matrix whose
+    multiplication gathers, multiplies with the element matrices and scatters
+    element by element. The assembled AIJ matrix is only built when the values
+    or a preconditioner are asked for."""
+
+    _cache_assembly = True
+
+    def __init__(self, *args, **kwargs):
+        super(Mat, self).__init__(*args, **kwargs)
+        if self._is_lma and (MPI.comm.size > 1 or self.sparsity.block_sparse):
+            raise NotImplementedError("Matrices in LMA format are only supported in serial on non-blocked sparsities")
+
+    def __call__(self, path, access):
+        # Element matrices are summed on conversion, which cannot express
+        # overwriting entries shared by several elements
+        if self._is_lma and access is not INC:
+            raise ModeValueError("Matrices in LMA format only support INC access")
+        return super(Mat, self).__call__(path, access)
 
     def _init(self):
         if not self.dtype == PETSc.ScalarType:
             raise RuntimeError("Can only create a matrix of type %s, %s is not supported" \
                     % (PETSc.ScalarType, self.dtype))
+        if self._is_lma:
+            self._handle = self._create_shell()
+        else:
+            self._handle = self._create()
+
+    def _create(self):
+        """Create the assembled PETSc matrix on the sparsity."""
         mat = PETSc.Mat()
         row_lg = PETSc.LGMap()
         col_lg = PETSc.LGMap()
         rdim, cdim = self.sparsity.dims
         if MPI.comm.size == 1:
             # The PETSc local to global mapping is the identity in the sequential case
-            row_lg.create(indices=np.arange(self.sparsity.nrows * rdim, dtype=PETSc.IntType))
-            col_lg.create(indices=np.arange(self.sparsity.ncols * cdim, dtype=PETSc.IntType))
+            rows = np.arange(self.sparsity.nrows, dtype=PETSc.IntType)
+            cols = np.arange(self.sparsity.ncols, dtype=PETSc.IntType)
+        else:
+            # We get the PETSc local to global mapping from the halo
+            rows = self.sparsity.rmaps[0].dataset.halo.global_to_petsc_numbering
+            cols = self.sparsity.cmaps[0].dataset.halo.global_to_petsc_numbering
+        # Scalar rows and columns are numbered consecutively within each
+        # set element
+        row_lg.create(indices=_expand(rows, rdim))
+        col_lg.create(indices=_expand(cols, cdim))
+        size = ((self.sparsity.nrows*rdim, None), (self.sparsity.ncols*cdim, None))
+        if self.sparsity.block_sparse:
+            # Blocked matrix with one entry of the sparsity per rdim x cdim
+            # block, inserted into with block local indices
+            if MPI.comm.size == 1:
+                mat.createBAIJ(size, rdim, csr=(self.sparsity._rowptr,
+                                                self.sparsity._colidx))
+            else:
+                mat.createBAIJ(size, rdim, nnz=(self.sparsity.nnz, self.sparsity.onnz))
+            block_row_lg = PETSc.LGMap()
+            block_col_lg = PETSc.LGMap()
+            block_row_lg.create(indices=rows)
+            block_col_lg.create(indices=cols)
+            mat.setLGMapBlock(rmap=block_row_lg, cmap=block_col_lg)
+        elif MPI.comm.size == 1:
             self._array = np.zeros(self.sparsity.nz, dtype=PETSc.RealType)
-            # We're not currently building a blocked matrix, so need to scale the
+            # We're not building a blocked matrix, so need to scale the
             # number of rows and columns by the sparsity dimensions
-            # FIXME: This needs to change if we want to do blocked sparse
             # NOTE: using _rowptr and _colidx since we always want the host values
             mat.createAIJWithArrays((self.sparsity.nrows*rdim, self.sparsity.ncols*cdim),
                                     (self.sparsity._rowptr, self.sparsity._colidx, self._array))
         else:
-            # FIXME: probably not right for vector fields
-            # We get the PETSc local to global mapping from the halo
-            row_lg.create(indices=self.sparsity.rmaps[0].dataset.halo.global_to_petsc_numbering)
-            col_lg.create(indices=self.sparsity.cmaps[0].dataset.halo.global_to_petsc_numbering)
-            mat.createAIJ(size=((self.sparsity.nrows*rdim, None),
-                                (self.sparsity.ncols*cdim, None)),
-                          nnz=(self.sparsity.nnz, self.sparsity.onnz))
+            mat.createAIJ(size=size, nnz=(self.sparsity.nnz, self.sparsity.onnz))
         mat.setLGMap(rmap=row_lg, cmap=col_lg)
         # Do not stash entries destined for other processors, just drop them
         # (we take care of those in the halo)
@@ -117,44 +205,224 @@ class Mat(base.Mat):
         # the nonzero structure of the matrix. Otherwise PETSc would compact
         # the sparsity and render our sparsity caching useless.
         mat.setOption(mat.Option.KEEP_NONZERO_PATTERN, True)
-        self._handle = mat
+        return mat
+
+    def _create_shell(self):
+        """Create the PETSc shell matrix multiplying with the element
+        matrices."""
+        rdim, cdim = self.dims
+        mat = PETSc.Mat()
+        mat.createPython(((self.sparsity.nrows*rdim, None),
+                          (self.sparsity.ncols*cdim, None)), self)
+        mat.setUp()
+        return mat
+
+    @property
+    def _direct(self):
+        """Whether the matrix values live in a host array the generated code
+        can add into directly, which is the case for sequential AIJ
+        matrices."""
+        return MPI.comm.size == 1 and not self.sparsity.block_sparse and not self._is_lma
+
+    def _lmadat(self, rmap, cmap):
+        """:class:`Dat` on the iteration set of the pair (``rmap``, ``cmap``)
+        holding the element matrix of every element, laid out as (row arity,
+        column arity, row dim, column dim) like the local tensor."""
+        if not hasattr(self, '_lmadats'):
+            self._lmadats = {}
+        if (rmap, cmap) not in self._lmadats:
+            rdim, cdim = self.dims
+            elements = _make_object('Set', rmap.iterset.size,
+                                    rmap.dim * cmap.dim * rdim * cdim,
+                                    "%s_elements" % self.name)
+            self._lmadats[(rmap, cmap)] = _make_object('Dat', elements, None, self.dtype,
+                                                       "%s_lma" % self.name)
+        return self._lmadats[(rmap, cmap)]
+
+    def _lma_kernel(self, rmap, cmap):
+        """Kernel adding the product of an element matrix with the gathered
+        column values to the row values."""
+        rdim, cdim = self.dims
+        d = {'name' : "lma_mult_%d_%d_%d_%d" % (rmap.dim, cmap.dim, rdim, cdim),
+             't' : self.ctype,
+             'rarity' : rmap.dim,
+             'carity' : cmap.dim,
+             'rdim' : rdim,
+             'cdim' : cdim}
+        code = """
+void %(name)s(%(t)s *A, %(t)s *x[%(carity)d], %(t)s *y[%(rarity)d]) {
+  for ( int i = 0; i < %(rarity)d; i++ ) {
+    for ( int k = 0; k < %(rdim)d; k++ ) {
+      %(t)s s = 0;
+      for ( int j = 0; j < %(carity)d; j++ )
+        for ( int l = 0; l < %(cdim)d; l++ )
+          s += A[((i * %(carity)d + j) * %(rdim)d + k) * %(cdim)d + l] * x[j][l];
+      y[i][k] += s;
+    }
+  }
+}""" % d
+        return _make_object('Kernel', code, d['name'])
+
+    def mult(self, mat, x, y):
+        """Compute ``y = A x`` for the PETSc Vecs ``x`` and ``y`` from the
+        element matrices. Called by PETSc whenever the shell matrix of a Mat
+        in ``'lma'`` format is applied."""
+        if not hasattr(self, '_lma_work'):
+            self._lma_work = (_make_object('Dat', self.sparsity.cmaps[0].dataset, None,
+                                           self.dtype, "%s_x" % self.name),
+                              _make_object('Dat', self.sparsity.rmaps[0].dataset, None,
+                                           self.dtype, "%s_y" % self.name))
+        xdat, ydat = self._lma_work
+        xdat.data[:xdat.dataset.size] = x.array.reshape((xdat.dataset.size,) + xdat.dataset.dim)
+        ydat.zero()
+        for rmap, cmap in self.sparsity.maps:
+            if (rmap, cmap) in getattr(self, '_lmadats', {}):
+                _make_object('ParLoop', self._lma_kernel(rmap, cmap), rmap.iterset,
+                             self._lmadat(rmap, cmap)(IdentityMap, READ),
+                             xdat(cmap, READ), ydat(rmap, INC)).enqueue()
+        y.array[:] = ydat.data_ro[:ydat.dataset.size].reshape(-1)
+        for rows, diag_val in self._bcs:
+            y.array[rows] = diag_val * x.array[rows]
+
+    @property
+    def _bcs(self):
+        """Rows zeroed with :meth:`zero_rows` and their diagonal values."""
+        if not hasattr(self, '_zeroed_rows'):
+            self._zeroed_rows = []
+        return self._zeroed_rows
+
+    @property
+    def _csr(self):
+        """Assembled AIJ matrix of a Mat in ``'lma'`` format, converted from
+        the element matrices if they changed since the last conversion."""
+        self._force_evaluation()
+        self._flush_zero()
+        if not hasattr(self, '_csr_handle'):
+            self._csr_handle = self._create()
+            self._csr_valid = False
+        if not self._csr_valid:
+            self._array[:] = 0
+            for rmap, cmap in self.sparsity.maps:
+                if (rmap, cmap) in getattr(self, '_lmadats', {}):
+                    n = rmap.iterset.size
+                    offsets = self.sparsity._element_offsets(rmap, cmap)[:n]
+                    lma = self._lmadat(rmap, cmap).data_ro[:n]
+                    self._array += np.bincount(offsets.ravel(), weights=lma.ravel(),
+                                               minlength=len(self._array))
+            self._csr_handle.assemble()
+            for rows, diag_val in self._bcs:
+                self._csr_handle.zeroRowsLocal(rows, diag_val)
+            self._csr_valid = True
+        return self._csr_handle
 
     def dump(self, filename):
         """Dump the matrix to file ``filename`` in PETSc binary format."""
         vwr = PETSc.Viewer().createBinary(filename, PETSc.Viewer.Mode.WRITE)
-        self.handle.view(vwr)
+        (self._csr if self._is_lma else self._petsc_handle).view(vwr)
 
-    def zero(self):
-        """Zero the matrix."""
-        self.handle.zeroEntries()
+    def _zero(self):
+        if self._is_lma:
+            for lma in getattr(self, '_lmadats', {}).values():
+                lma.zero()
+            self._bcs[:] = []
+            self._csr_valid = False
+        else:
+            self._petsc_handle.zeroEntries()
 
     def zero_rows(self, rows, diag_val):
         """Zeroes the specified rows of the matrix, with the exception of the
         diagonal entry, which is set to diag_val. May be used for applying
         strong boundary conditions."""
-        self.handle.zeroRowsLocal(rows, diag_val)
+        if self._is_lma:
+            self._force_evaluation()
+            self._flush_zero()
+            self._bcs.append((np.asarray(rows, dtype=PETSc.IntType), diag_val))
+            self._csr_valid = False
+        else:
+            self._petsc_handle.zeroRowsLocal(rows, diag_val)
+        self._assembly = None
+        self._version += 1
 
     def _assemble(self):
-        self.handle.assemble()
+        if self._is_lma:
+            self._csr_valid = False
+        else:
+            self._petsc_handle.assemble()
 
     @property
     def array(self):
-        """Array of non-zero values."""
-        if not hasattr(self, '_array'):
-            self._init()
+        """Array of non-zero values.
+
+        For a block sparse matrix PETSc owns the values, hence this is a
+        read-only copy, which does not reflect subsequent modifications of
+        the matrix. Otherwise the values of the matrix may be modified in
+        place through the array."""
+        self._force_evaluation()
+        if self._is_lma:
+            self._csr
+            return self._array
+        handle = self._petsc_handle
+        if self.sparsity.block_sparse:
+            values = handle.getValuesCSR()[2]
+            values.setflags(write=False)
+            return values
+        # The values may be modified through the array
+        self._assembly = None
+        self._version += 1
         return self._array
 
     @property
     def values(self):
-        return self.handle[:,:]
+        if self._is_lma:
+            return self._csr[:,:]
+        return self._petsc_handle[:,:]
 
     @property
     def handle(self):
         """Petsc4py Mat holding matrix data."""
+        handle = self._petsc_handle
+        # The values may be modified through the handle
+        self._assembly = None
+        self._version += 1
+        return handle
+
+    @property
+    def _petsc_handle(self):
+        """Petsc4py Mat holding the current matrix data, for use by PyOP2
+        itself which does not modify the values behind the Mat's back."""
+        self._force_evaluation()
+        self._flush_zero()
         if not hasattr(self, '_handle'):
             self._init()
         return self._handle
 
+class MatrixFree(base.MatrixFree):
+    """OP2 matrix-free linear operator wrapped in a PETSc shell matrix, whose
+    multiplication applies the operator by executing a :func:`par_loop`."""
+
+    def mult(self, mat, x, y):
+        """Compute ``y = A x`` for the PETSc Vecs ``x`` and ``y``. Called by
+        PETSc whenever the shell matrix is applied."""
+        xdat = self._x.data
+        ydat = self._y.data
+        # The Vecs only hold the owned entries
+        xdat.data[:xdat.dataset.size] = x.array.reshape((xdat.dataset.size,) + xdat.dataset.dim)
+        self._apply()
+        y.array[:] = ydat.data_ro[:ydat.dataset.size].reshape(-1)
+
+    @property
+    def handle(self):
+        """Petsc4py shell Mat applying the operator."""
+        if not hasattr(self, '_handle'):
+            xdat = self._x.data
+            ydat = self._y.data
+            mat = PETSc.Mat()
+            mat.createPython(((ydat.dataset.size * ydat.cdim, None),
+                              (xdat.dataset.size * xdat.cdim, None)), self)
+            mat.setUp()
+            self._handle = mat
+        return self._handle
+
 # FIXME: Eventually (when we have a proper OpenCL solver) this wants to go in
 # sequential
 class Solver(base.Solver, PETSc.KSP):
@@ -164,25 +432,47 @@ class Solver(base.Solver, PETSc.KSP):
     def __init__(self, parameters=None, **kwargs):
         super(Solver, self).__init__(parameters, **kwargs)
         self.create(PETSc.COMM_WORLD)
+        # Parameters and operator the KSP was last set up with
+        self._applied = None
+        self._operator = None
         converged_reason = self.ConvergedReason()
         self._reasons = dict([(getattr(converged_reason,r), r) \
                               for r in dir(converged_reason) \
                               if not r.startswith('_')])
 
-    def _set_parameters(self):
+    def _set_parameters(self, matrix_free=False):
         self.setType(self.parameters['linear_solver'])
-        self.getPC().setType(self.parameters['preconditioner'])
+        # There are no matrix entries to build a preconditioner from
+        self.getPC().setType('none' if matrix_free else self.parameters['preconditioner'])
         self.rtol = self.parameters['relative_tolerance']
         self.atol = self.parameters['absolute_tolerance']
         self.divtol = self.parameters['divergence_tolerance']
         self.max_it = self.parameters['maximum_iterations']
+        self.setInitialGuessNonzero(self.parameters['nonzero_initial_guess'])
         if self.parameters['plot_convergence']:
             self.parameters['monitor_convergence'] = True
 
     def solve(self, A, x, b):
-        self._set_parameters()
-        self.setOperators(A.handle)
-        self.setFromOptions()
+        # Any delayed computation A and b depend on or that touches x has to
+        # be carried out before the solve
+        base._trace.evaluate(set([A, b]), set([x]))
+        matrix_free = isinstance(A, base.MatrixFree)
+        applied = (dict(self.parameters), matrix_free)
+        if applied != self._applied:
+            self._set_parameters(matrix_free)
+            self.setFromOptions()
+            self._applied = applied
+            self._operator = None
+        # The preconditioner is only set up again if the operator changed,
+        # a matrix-free operator has no values to build one from
+        operator = (A, None if matrix_free else A.version)
+        if operator != self._operator:
+            if isinstance(A, Mat) and A._is_lma and self.parameters['preconditioner'] != 'none':
+                # Only the preconditioner needs the assembled matrix
+                self.setOperators(A._petsc_handle, A._csr)
+            else:
+                self.setOperators(A._petsc_handle if isinstance(A, Mat) else A.handle)
+            self._operator = operator
         if self.parameters['monitor_convergence']:
             self.reshist = []
             def monitor(ksp, its, norm):
@@ -38,9 +38,16 @@ Cython implementation of the Plan construction.
 import base
 from utils import align
 import math
+import os
+import shutil
+import tempfile
+import time
 import numpy
 cimport numpy
+cimport cython
 from libc.stdlib cimport malloc, free
+from cython.parallel import prange, threadid
+from logger import debug
 try:
     from collections import OrderedDict
 # OrderedDict was added in Python 2.7. Earlier versions can use ordereddict
@@ -48,6 +55,9 @@ try:
 except ImportError:
     from ordereddict import OrderedDict
 
+cdef extern from "omp_compat.h":
+    int omp_get_max_threads() nogil
+
 # C type declarations
 ctypedef struct map_idx_t:
     # pointer to the raw numpy array containing the map values
@@ -59,12 +69,138 @@ ctypedef struct map_idx_t:
 ctypedef struct flat_race_args_t:
     # Dat size
     int size
-    # Temporary array for coloring purpose
-    unsigned int* tmp
+    # Offset of the Dat's entries in the working arrays for coloring purpose
+    Py_ssize_t offset
     # lenght of mip (ie, number of occurences of Dat in the access descriptors)
     int count
     map_idx_t * mip
 
+cdef inline Py_ssize_t _entry(flat_race_args_t* ra, int rai, int mi, int t) nogil:
+    return ra[rai].offset + ra[rai].mip[mi].map_base[t * ra[rai].mip[mi].dim + ra[rai].mip[mi].idx]
+
+cdef int _color_elements(flat_race_args_t* ra, int n_race_args, unsigned int* work,
+                         int start, int end, int* thrcol) nogil:
+    """Greedily color the elements [start, end) of a partition in rounds of
+    32 colors, returns the number of colors used."""
+    cdef int _t, _rai, _mi
+    cdef unsigned int _base_color = 0
+    cdef unsigned int _mask
+    cdef unsigned int _color
+    cdef int ncolors = 0
+    cdef bint terminated = False
+    while not terminated:
+        terminated = True
+
+        # zero out the working array entries touched by the partition
+        for _t in range(start, end):
+            for _rai in range(n_race_args):
+                for _mi in range(ra[_rai].count):
+                    work[_entry(ra, _rai, _mi, _t)] = 0
+
+        # color threads
+        for _t in range(start, end):
+            if thrcol[_t] == -1:
+                _mask = 0
+                for _rai in range(n_race_args):
+                    for _mi in range(ra[_rai].count):
+                        _mask |= work[_entry(ra, _rai, _mi, _t)]
+
+                if _mask == 0xffffffffu:
+                    terminated = False
+                else:
+                    _color = 0
+                    while _mask & 0x1:
+                        _mask = _mask >> 1
+                        _color += 1
+                    thrcol[_t] = _base_color + _color
+                    ncolors = max(ncolors, thrcol[_t] + 1)
+                    _mask = 1 << _color
+                    for _rai in range(n_race_args):
+                        for _mi in range(ra[_rai].count):
+                            work[_entry(ra, _rai, _mi, _t)] |= _mask
+
+        _base_color += 32
+    return ncolors
+
+cdef void _color_blocks_greedy(flat_race_args_t* ra, int n_race_args, unsigned int* work,
+                               int nblocks, int* starts, int* nelems, int* pcolors) nogil:
+    """Greedily color partitions in rounds of 32 colors."""
+    cdef int _p, _t, _rai, _mi
+    cdef unsigned int _base_color = 0
+    cdef unsigned int _mask
+    cdef unsigned int _color
+    cdef bint terminated = False
+    while not terminated:
+        terminated = True
+
+        # zero out the working array entries touched by uncolored partitions
+        for _p in range(nblocks):
+            if pcolors[_p] == -1:
+                for _t in range(starts[_p], starts[_p] + nelems[_p]):
+                    for _rai in range(n_race_args):
+                        for _mi in range(ra[_rai].count):
+                            work[_entry(ra, _rai, _mi, _t)] = 0
+
+        for _p in range(nblocks):
+            if pcolors[_p] == -1:
+                _mask = 0
+                for _t in range(starts[_p], starts[_p] + nelems[_p]):
+                    for _rai in range(n_race_args):
+                        for _mi in range(ra[_rai].count):
+                            _mask |= work[_entry(ra, _rai, _mi, _t)]
+
+                if _mask == 0xffffffffu:
+                    terminated = False
+                else:
+                    _color = 0
+                    while _mask & 0x1:
+                        _mask = _mask >> 1
+                        _color += 1
+                    pcolors[_p] = _base_color + _color
+
+                    _mask = 1 << _color
+                    for _t in range(starts[_p], starts[_p] + nelems[_p]):
+                        for _rai in range(n_race_args):
+                            for _mi in range(ra[_rai].count):
+                                work[_entry(ra, _rai, _mi, _t)] |= _mask
+
+        _base_color += 32
+
+@cython.cdivision(True)
+cdef int _stage_dat_map(int size, int l, int m, int ninds, int* vals, int* elem_block,
+                        numpy.npy_intp* order, int* cols, int* inverse,
+                        int* ind_map, short* loc_map, int* ind_sizes) nogil:
+    """Compute the staging information of a single dat-map pair.
+
+    ``order`` sorts the ``size`` x ``l`` map values ``vals`` by partition
+    first and value second, such that the values unique within each
+    partition come out in the order they are staged in. Returns the number
+    of staged values."""
+    cdef Py_ssize_t _q, _idx, _t
+    cdef int _k, _p, _v
+    cdef int _prev_p = -1
+    cdef int _prev_v = 0
+    cdef int _local = 0
+    cdef int _u = 0
+    for _q in range(<Py_ssize_t> size * l):
+        _idx = order[_q]
+        _p = elem_block[_idx // l]
+        _v = vals[_idx]
+        if _p != _prev_p or _v != _prev_v:
+            _local = 0 if _p != _prev_p else _local + 1
+            ind_map[_u] = _v
+            _u += 1
+            ind_sizes[_p * ninds + m] += 1
+        inverse[_idx] = _local
+        _prev_p = _p
+        _prev_v = _v
+
+    # local indices are laid out per map index, each covering the iteration set
+    for _k in range(l):
+        for _t in range(size):
+            loc_map[_k * size + _t] = <short> inverse[_t * l + cols[_k]]
+    return _u
+
 cdef class Plan:
     """Plan object contains necessary information for data staging and execution scheduling."""
 
@@ -89,27 +225,105 @@ cdef class Plan:
     cdef int _ninds
     cdef int _nshared
     cdef int _ncolors
+    cdef object _coloring_stats
 
     def __cinit__(self, kernel, iset, *args, **kwargs):
         ps = kwargs.get('partition_size', 1)
         mc = kwargs.get('matrix_coloring', False)
         st = kwargs.get('staging', True)
         tc = kwargs.get('thread_coloring', True)
+        bc = kwargs.get('block_coloring', 'greedy')
+        cp = kwargs.get('compact', False)
 
         assert ps > 0, "partition size must be strictly positive"
 
+        # Plans read from and written to the disk cache live in a directory
+        # given by the caller, which is responsible for keying it
+        cache_path = kwargs.get('cache_path')
+        if cache_path and self._load(cache_path):
+            return
+
         self._compute_partition_info(iset, ps, mc, args)
         if st:
-            self._compute_staging_info(iset, ps, mc, args)
-
-        self._compute_coloring(iset, ps, mc, tc, args)
+            self._compute_staging_info(iset, ps, mc, cp, args)
+
+        self._compute_coloring(iset, ps, mc, tc, bc, cp, args)
+
+        if cache_path:
+            self._save(cache_path)
+
+    def _arrays(self):
+        return {'nelems': self._nelems,
+                'ind_map': self._ind_map,
+                'loc_map': self._loc_map,
+                'ind_sizes': self._ind_sizes,
+                'nindirect': self._nindirect,
+                'ind_offs': self._ind_offs,
+                'offset': self._offset,
+                'thrcol': self._thrcol,
+                'nthrcol': self._nthrcol,
+                'ncolblk': self._ncolblk,
+                'blkmap': self._blkmap}
+
+    def _save(self, path):
+        """Store the plan as raw NumPy files in directory ``path``.
+
+        The directory is populated under a temporary name and renamed into
+        place, so concurrent writers never expose a partial plan. Failing to
+        store the plan is not an error."""
+        try:
+            tmp = tempfile.mkdtemp(dir=os.path.dirname(path))
+        except OSError:
+            return
+        try:
+            numpy.save(os.path.join(tmp, 'scalars.npy'),
+                       numpy.array([self._nblocks, self._nargs, self._ninds,
+                                    self._nshared, self._ncolors], dtype=numpy.int64))
+            for name, a in self._arrays().iteritems():
+                # Arrays not computed (no staging or thread coloring) are
+                # not stored
+                if a is not None:
+                    numpy.save(os.path.join(tmp, name + '.npy'), a)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            # Another process stored the same plan first
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def _load(self, path):
+        """Populate the plan from the NumPy files in directory ``path``.
+
+        :returns: ``False`` if there is no valid plan stored at ``path``."""
+        if not os.path.isdir(path):
+            return False
+        arrays = {}
+        try:
+            scalars = numpy.load(os.path.join(path, 'scalars.npy'))
+            for name in self._arrays().iterkeys():
+                f = os.path.join(path, name + '.npy')
+                arrays[name] = numpy.load(f) if os.path.exists(f) else None
+        except (IOError, ValueError):
+            return False
+        self._nblocks, self._nargs, self._ninds, self._nshared, self._ncolors = \
+            [int(x) for x in scalars]
+        self._nelems = arrays['nelems']
+        self._ind_map = arrays['ind_map']
+        self._loc_map = arrays['loc_map']
+        self._ind_sizes = arrays['ind_sizes']
+        self._nindirect = arrays['nindirect']
+        self._ind_offs = arrays['ind_offs']
+        self._offset = arrays['offset']
+        self._thrcol = arrays['thrcol']
+        self._nthrcol = arrays['nthrcol']
+        self._ncolblk = arrays['ncolblk']
+        self._blkmap = arrays['blkmap']
+        return True
 
     def _compute_partition_info(self, iset, ps, mc, args):
         self._nblocks = int(math.ceil(iset.size / float(ps)))
         self._nelems = numpy.array([min(ps, iset.size - i * ps) for i in range(self._nblocks)],
                                   dtype=numpy.int32)
 
-    def _compute_staging_info(self, iset, ps, mc, args):
+    def _compute_staging_info(self, iset, ps, mc, cp, args):
         """Constructs:
             - nindirect
             - ind_map
@@ -118,6 +332,10 @@ cdef class Plan:
             - ind_offs
             - offset
             - nshared
+
+        In compact mode, ind_map is not padded and the values staged for the
+        n-th dat-map pair start at the sum of the first n entries of
+        nindirect.
         """
         # indices referenced for this dat-map pair
         def indices(dat, map):
@@ -133,91 +351,84 @@ cdef class Plan:
                     d[k] = i
                     self._ninds += 1
 
-        inds = dict()
-        locs = dict()
-        sizes = dict()
-
-        for pi in range(self._nblocks):
-            start = pi * ps
-            end = start + self._nelems[pi]
-
-            for dat,map in d.iterkeys():
-                ii = indices(dat,map)
-                l = len(ii)
-
-                inds[(dat,map,pi)], inv = numpy.unique(map.values[start:end,ii], return_inverse=True)
-                sizes[(dat,map,pi)] = len(inds[(dat,map,pi)])
-
-                for i, ind in enumerate(sorted(ii)):
-                    locs[(dat,map,ind,pi)] = inv[i::l]
-
-        def ind_iter():
-            for dat,map in d.iterkeys():
-                cumsum = 0
-                for pi in range(self._nblocks):
-                    cumsum += len(inds[(dat,map,pi)])
-                    yield inds[(dat,map,pi)]
-                # creates a padding to conform with op2 plan objects
-                # fills with -1 for debugging
-                # this should be removed and generated code changed
-                # once we switch to python plan only
-                pad = numpy.empty(len(indices(dat,map)) * iset.size - cumsum, dtype=numpy.int32)
-                pad.fill(-1)
-                yield pad
-        t = tuple(ind_iter())
-        self._ind_map = numpy.concatenate(t) if t else numpy.array([], dtype=numpy.int32)
-
-        def size_iter():
-            for pi in range(self._nblocks):
-                for dat,map in d.iterkeys():
-                    yield sizes[(dat,map,pi)]
-        self._ind_sizes = numpy.fromiter(size_iter(), dtype=numpy.int32)
-
-        def nindirect_iter():
-            for dat,map in d.iterkeys():
-                yield sum(sizes[(dat,map,pi)] for pi in range(self._nblocks))
-        self._nindirect = numpy.fromiter(nindirect_iter(), dtype=numpy.int32)
-
-        def loc_iter():
-            for dat,map in d.iterkeys():
-                for i in indices(dat, map):
-                    for pi in range(self._nblocks):
-                        yield locs[(dat,map,i,pi)].astype(numpy.int16)
-        t = tuple(loc_iter())
-        self._loc_map = numpy.concatenate(t) if t else numpy.array([], dtype=numpy.int32)
-
-        def off_iter():
-            _off = dict()
-            for dat,map in d.iterkeys():
-                _off[(dat,map)] = 0
-            for pi in range(self._nblocks):
-                for dat,map in d.iterkeys():
-                    yield _off[(dat,map)]
-                    _off[(dat,map)] += sizes[(dat,map,pi)]
-        self._ind_offs = numpy.fromiter(off_iter(), dtype=numpy.int32)
-
-        def offset_iter():
-            _offset = 0
-            for pi in range(self._nblocks):
-                yield _offset
-                _offset += self._nelems[pi]
-        self._offset = numpy.fromiter(offset_iter(), dtype=numpy.int32)
+        cdef int size = iset.size
+        cdef int ninds = self._ninds
+        cdef int nblocks = self._nblocks
+        cdef int l, m
+        cdef Py_ssize_t seg = 0
+
+        offset = numpy.zeros(self._nblocks, dtype=numpy.int32)
+        offset[1:] = numpy.cumsum(self._nelems)[:-1]
+        self._offset = offset
+        elem_block = numpy.repeat(numpy.arange(self._nblocks, dtype=numpy.int32), self._nelems)
+
+        # every dat-map pair stages at most one value per map index and
+        # element, the remainder is padded with -1 to conform with op2 plan
+        # objects (this should be removed and generated code changed once we
+        # switch to python plan only)
+        nvals = sum(len(indices(dat, map)) for dat, map in d.iterkeys()) * size
+        self._ind_map = numpy.empty(nvals, dtype=numpy.int32)
+        self._ind_map.fill(-1)
+        self._loc_map = numpy.empty(nvals, dtype=numpy.int16) if d else numpy.array([], dtype=numpy.int32)
+        ind_sizes = numpy.zeros((self._nblocks, self._ninds), dtype=numpy.int32)
+        self._nindirect = numpy.zeros(self._ninds, dtype=numpy.int32)
+        inverse = numpy.empty(nvals, dtype=numpy.int32)
+
+        cdef int * _ind_map = <int *> numpy.PyArray_DATA(self._ind_map)
+        cdef short * _loc_map = <short *> numpy.PyArray_DATA(self._loc_map)
+        cdef int * _ind_sizes = <int *> numpy.PyArray_DATA(ind_sizes)
+        cdef int * _nindirect = <int *> numpy.PyArray_DATA(self._nindirect)
+        cdef int * _elem_block = <int *> numpy.PyArray_DATA(elem_block)
+        cdef int * _inverse = <int *> numpy.PyArray_DATA(inverse)
+        cdef int * _vals
+        cdef int * _cols
+        cdef numpy.npy_intp * _order
+
+        for m, (dat, map) in enumerate(d.iterkeys()):
+            ii = indices(dat, map)
+            l = len(ii)
+            vals = numpy.ascontiguousarray(map.values[:size, ii], dtype=numpy.int32)
+            order = numpy.lexsort((vals.ravel(), numpy.repeat(elem_block, l)))
+            # the local indices of the k-th map index are those of the column
+            # holding the k-th index in sorted order
+            pos = dict((ind, i) for i, ind in enumerate(sorted(ii)))
+            cols = numpy.array([pos[ind] for ind in ii], dtype=numpy.int32)
+            _vals = <int *> numpy.PyArray_DATA(vals)
+            _order = <numpy.npy_intp *> numpy.PyArray_DATA(order)
+            _cols = <int *> numpy.PyArray_DATA(cols)
+            with nogil:
+                _nindirect[m] = _stage_dat_map(size, l, m, ninds, _vals, _elem_block,
+                                               _order, _cols, _inverse,
+                                               _ind_map + seg, _loc_map + seg, _ind_sizes)
+            seg += <Py_ssize_t> l * size
+
+        if cp:
+            segs = numpy.cumsum([0] + [len(indices(dat, map)) * size for dat, map in d.iterkeys()])
+            self._ind_map = numpy.concatenate([self._ind_map[s:s + n] for s, n in
+                                               zip(segs, self._nindirect)] or [self._ind_map])
+
+        self._ind_sizes = ind_sizes.ravel()
+        ind_offs = numpy.zeros_like(ind_sizes)
+        ind_offs[1:] = numpy.cumsum(ind_sizes, axis=0)[:-1]
+        self._ind_offs = ind_offs.ravel()
 
         # max shared memory required by work groups
-        nshareds = [0] * self._nblocks
-        for pi in range(self._nblocks):
-            for k in d.iterkeys():
-                dat, map = k
-                nshareds[pi] += align(sizes[(dat,map,pi)] * dat.dtype.itemsize * dat.cdim)
-        self._nshared = max(nshareds)
-
-    def _compute_coloring(self, iset, ps, mc, tc, args):
+        if d:
+            itemsizes = numpy.array([dat.dtype.itemsize * dat.cdim for dat, map in d.iterkeys()])
+            self._nshared = int(align(ind_sizes * itemsizes).sum(axis=1).max())
+        else:
+            self._nshared = 0
+
+    def _compute_coloring(self, iset, ps, mc, tc, bc, cp, args):
         """Constructs:
             - thrcol
             - nthrcol
             - ncolors
             - blkmap
             - ncolblk
+
+        thrcol and nthrcol are only constructed with thread coloring. In
+        compact mode, they use the narrowest integer type holding all colors.
         """
         # args requiring coloring (ie, indirect reduction and matrix args)
         #  key: Dat
@@ -240,16 +451,16 @@ cdef class Plan:
         # convert 'OrderedDict race_args' into a flat array for performant access in cython
         cdef int n_race_args = len(race_args)
         cdef flat_race_args_t* flat_race_args = <flat_race_args_t*> malloc(n_race_args * sizeof(flat_race_args_t))
-        pcds = [None] * n_race_args
+        cdef Py_ssize_t total = 0
         for i, ra in enumerate(race_args.iterkeys()):
             if isinstance(ra, base.Dat):
                 s = ra.dataset.size
             elif isinstance(ra, base.Mat):
                 s = ra.sparsity.maps[0][0].dataset.size
 
-            pcds[i] = numpy.empty((s,), dtype=numpy.uint32)
             flat_race_args[i].size = s
-            flat_race_args[i].tmp = <unsigned int *> numpy.PyArray_DATA(pcds[i])
+            flat_race_args[i].offset = total
+            total += s
 
             flat_race_args[i].count = len(race_args[ra])
             flat_race_args[i].mip = <map_idx_t*> malloc(flat_race_args[i].count * sizeof(map_idx_t))
@@ -259,69 +470,39 @@ cdef class Plan:
                 flat_race_args[i].mip[j].dim = map.dim
                 flat_race_args[i].mip[j].idx = idx
 
+        # every thread colors in its own working array, holding one entry per
+        # element of each race arg
+        cdef int nthreads = omp_get_max_threads()
+        cdef unsigned int* work = <unsigned int*> malloc(max(nthreads * total, 1) * sizeof(unsigned int))
+
         # type constraining a few variables
-        cdef int _tid
         cdef int _p
-        cdef unsigned int _base_color
-        cdef int _t
-        cdef unsigned int _mask
-        cdef unsigned int _color
-        cdef int _rai
-        cdef int _mi
-        cdef int _i
+        cdef int nblocks = self._nblocks
 
-        # intra partition coloring
-        self._thrcol = numpy.empty((iset.size, ), dtype=numpy.int32)
-        self._thrcol.fill(-1)
-
-        # create direct reference to numpy array storage
-        cdef int * thrcol = <int *> numpy.PyArray_DATA(self._thrcol)
+        starts = numpy.zeros(self._nblocks, dtype=numpy.int32)
+        starts[1:] = numpy.cumsum(self._nelems)[:-1]
+        cdef int * _starts = <int *> numpy.PyArray_DATA(starts)
         cdef int * nelems = <int *> numpy.PyArray_DATA(self._nelems)
 
+        # intra partition coloring
+        cdef int * thrcol = NULL
+        cdef int * _nthrcol
 
+        t0 = time.time()
         if tc:
-            _tid = 0
-            for _p in range(self._nblocks):
-                _base_color = 0
-                terminated = False
-                while not terminated:
-                    terminated = True
-
-                    # zero out working array:
-                    for _rai in range(n_race_args):
-                        for _i in range(flat_race_args[_rai].size):
-                            flat_race_args[_rai].tmp[_i] = 0
-
-                    # color threads
-                    for _t in range(_tid, _tid + nelems[_p]):
-                        if thrcol[_t] == -1:
-                            _mask = 0
-
-                            for _rai in range(n_race_args):
-                                for _mi in range(flat_race_args[_rai].count):
-                                    _mask |= flat_race_args[_rai].tmp[flat_race_args[_rai].mip[_mi].map_base[_t * flat_race_args[_rai].mip[_mi].dim + flat_race_args[_rai].mip[_mi].idx]]
-
-                            if _mask == 0xffffffffu:
-                                terminated = False
-                            else:
-                                _color = 0
-                                while _mask & 0x1:
-                                    _mask = _mask >> 1
-                                    _color += 1
-                                thrcol[_t] = _base_color + _color
-                                _mask = 1 << _color
-                                for _rai in range(n_race_args):
-                                    for _mi in range(flat_race_args[_rai].count):
-                                        flat_race_args[_rai].tmp[flat_race_args[_rai].mip[_mi].map_base[_t * flat_race_args[_rai].mip[_mi].dim + flat_race_args[_rai].mip[_mi].idx]] |= _mask
-
-                    _base_color += 32
-                _tid += nelems[_p]
-
-            self._nthrcol = numpy.zeros(self._nblocks,dtype=numpy.int32)
-            _tid = 0
-            for _p in range(self._nblocks):
-                self._nthrcol[_p] = max(self._thrcol[_tid:(_tid + nelems[_p])]) + 1
-                _tid += nelems[_p]
+            self._thrcol = numpy.empty((iset.size, ), dtype=numpy.int32)
+            self._thrcol.fill(-1)
+            # create direct reference to numpy array storage
+            thrcol = <int *> numpy.PyArray_DATA(self._thrcol)
+
+            # partitions are colored independently of each other
+            self._nthrcol = numpy.zeros(self._nblocks, dtype=numpy.int32)
+            _nthrcol = <int *> numpy.PyArray_DATA(self._nthrcol)
+            for _p in prange(nblocks, nogil=True, schedule='dynamic', num_threads=nthreads):
+                _nthrcol[_p] = _color_elements(flat_race_args, n_race_args,
+                                               work + <Py_ssize_t> threadid() * total,
+                                               _starts[_p], _starts[_p] + nelems[_p], thrcol)
+        t1 = time.time()
 
         # partition coloring
         pcolors = numpy.empty(self._nblocks, dtype=numpy.int32)
@@ -329,51 +510,146 @@ cdef class Plan:
 
         cdef int * _pcolors = <int *> numpy.PyArray_DATA(pcolors)
 
-        _base_color = 0
-        terminated = False
-        while not terminated:
-            terminated = True
-
-            # zero out working array:
-            for _rai in range(n_race_args):
-                for _i in range(flat_race_args[_rai].size):
-                    flat_race_args[_rai].tmp[_i] = 0
-
-            _tid = 0
-            for _p in range(self._nblocks):
-                if _pcolors[_p] == -1:
-                    _mask = 0
-                    for _t in range(_tid, _tid + nelems[_p]):
-                        for _rai in range(n_race_args):
-                            for _mi in range(flat_race_args[_rai].count):
-                                _mask |= flat_race_args[_rai].tmp[flat_race_args[_rai].mip[_mi].map_base[_t * flat_race_args[_rai].mip[_mi].dim + flat_race_args[_rai].mip[_mi].idx]]
-
-                    if _mask == 0xffffffffu:
-                        terminated = False
-                    else:
-                        _color = 0
-                        while _mask & 0x1:
-                            _mask = _mask >> 1
-                            _color += 1
-                        _pcolors[_p] = _base_color + _color
-
-                        _mask = 1 << _color
-                        for _t in range(_tid, _tid + nelems[_p]):
-                            for _rai in range(n_race_args):
-                                for _mi in range(flat_race_args[_rai].count):
-                                    flat_race_args[_rai].tmp[flat_race_args[_rai].mip[_mi].map_base[_t * flat_race_args[_rai].mip[_mi].dim + flat_race_args[_rai].mip[_mi].idx]] |= _mask
-                _tid += nelems[_p]
-
-            _base_color += 32
+        if bc == 'greedy':
+            with nogil:
+                _color_blocks_greedy(flat_race_args, n_race_args, work,
+                                     nblocks, _starts, nelems, _pcolors)
+        elif bc == 'parallel':
+            indptr, indices = self._block_adjacency(race_args, iset)
+            self._color_blocks_jp(indptr, indices, pcolors, nthreads)
+        else:
+            raise ValueError("Unknown block coloring '%s'" % bc)
+        t2 = time.time()
 
         # memory free
         for i in range(n_race_args):
             free(flat_race_args[i].mip)
         free(flat_race_args)
+        free(work)
 
         self._ncolors = max(pcolors) + 1
         self._ncolblk = numpy.bincount(pcolors).astype(numpy.int32)
         self._blkmap = numpy.argsort(pcolors, kind='mergesort').astype(numpy.int32)
+        if cp and tc:
+            self._thrcol = self._thrcol.astype(numpy.min_scalar_type(self._thrcol.max()))
+            self._nthrcol = self._nthrcol.astype(numpy.min_scalar_type(self._nthrcol.max()))
+
+        self._coloring_stats = {'ncolors': self._ncolors,
+                                'max_thread_colors': int(self._nthrcol.max()) if tc else 0,
+                                'thread_coloring_time': t1 - t0,
+                                'block_coloring_time': t2 - t1,
+                                'nthreads': nthreads}
+        debug("Plan coloring: %(ncolors)d block colors in %(block_coloring_time).3fs, "
+              "at most %(max_thread_colors)d thread colors in %(thread_coloring_time).3fs "
+              "using %(nthreads)d threads" % self._coloring_stats)
+
+    def _block_adjacency(self, race_args, iset):
+        """Compute the partitions conflicting with each partition, i.e. those
+        touching a common race arg element, as a CSR graph."""
+        nblocks = self._nblocks
+        block = numpy.repeat(numpy.arange(nblocks, dtype=numpy.int64), self._nelems)
+        keys = []
+        offset = 0
+        for ra, l in race_args.iteritems():
+            for map, idx in l:
+                keys.append((offset + map.values[:iset.size, idx].astype(numpy.int64)) * nblocks + block)
+            if isinstance(ra, base.Dat):
+                offset += ra.dataset.size
+            else:
+                offset += ra.sparsity.maps[0][0].dataset.size
+        if not keys:
+            return numpy.zeros(nblocks + 1, dtype=numpy.int32), numpy.array([], dtype=numpy.int32)
+
+        # unique (element, partition) pairs, sorted by element
+        pairs = numpy.unique(numpy.concatenate(keys))
+        cdef numpy.ndarray[numpy.int64_t, ndim=1] pblock = pairs % nblocks
+        cdef numpy.ndarray[numpy.int64_t, ndim=1] bounds = \
+            numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(pairs // nblocks)) + 1, [len(pairs)]))
+
+        # all pairs of partitions touching the same element conflict
+        counts = numpy.diff(bounds)
+        cdef numpy.ndarray[numpy.int64_t, ndim=1] edges = \
+            numpy.empty(numpy.sum(counts * (counts - 1)), dtype=numpy.int64)
+        cdef Py_ssize_t g, a, b, e = 0
+        for g in range(len(bounds) - 1):
+            for a in range(bounds[g], bounds[g+1]):
+                for b in range(bounds[g], bounds[g+1]):
+                    if a != b:
+                        edges[e] = pblock[a] * nblocks + pblock[b]
+                        e += 1
+        edges = numpy.unique(edges)
+        indptr = numpy.zeros(nblocks + 1, dtype=numpy.int32)
+        indptr[1:] = numpy.cumsum(numpy.bincount(edges // nblocks, minlength=nblocks))
+        return indptr, (edges % nblocks).astype(numpy.int32)
+
+    def _color_blocks_jp(self, indptr, indices, pcolors, int nthreads):
+        """Color partitions in parallel with the Jones-Plassmann algorithm.
+
+        In each round, every uncolored partition with a higher priority than
+        all its uncolored neighbours takes the smallest color not used by its
+        neighbours. Priorities are a fixed pseudo-random permutation, so the
+        coloring does not depend on the number of threads."""
+        cdef int n = self._nblocks
+        cdef int * _indptr = <int *> numpy.PyArray_DATA(indptr)
+        cdef int * _indices = <int *> numpy.PyArray_DATA(indices)
+        cdef int * _pcolors = <int *> numpy.PyArray_DATA(pcolors)
+        prio = numpy.random.RandomState(0).permutation(n).astype(numpy.int32)
+        cdef int * _prio = <int *> numpy.PyArray_DATA(prio)
+        cand = numpy.zeros(n, dtype=numpy.int8)
+        cdef char * _cand = <char *> numpy.PyArray_DATA(cand)
+
+        # a partition never needs more colors than it has neighbours, colors
+        # used by neighbours are marked with the id of the partition
+        cdef Py_ssize_t stride = numpy.diff(indptr).max() + 1 if n else 1
+        marks = numpy.empty(nthreads * stride, dtype=numpy.int32)
+        marks.fill(-1)
+        cdef int * _marks = <int *> numpy.PyArray_DATA(marks)
+        cdef int * _m
+
+        cdef int _v, _j, _c
+        cdef int uncolored = n
+        cdef int done
+        with nogil:
+            while uncolored > 0:
+                for _v in prange(n, schedule='static', num_threads=nthreads):
+                    _cand[_v] = _pcolors[_v] == -1
+                    if _cand[_v]:
+                        for _j in range(_indptr[_v], _indptr[_v+1]):
+                            if _pcolors[_indices[_j]] == -1 and _prio[_indices[_j]] > _prio[_v]:
+                                _cand[_v] = 0
+                                break
+                # candidates are never adjacent, so they can be colored
+                # concurrently
+                done = 0
+                for _v in prange(n, schedule='static', num_threads=nthreads):
+                    if _cand[_v]:
+                        _m = _marks + <Py_ssize_t> threadid() * stride
+                        for _j in range(_indptr[_v], _indptr[_v+1]):
+                            _c = _pcolors[_indices[_j]]
+                            if _c != -1:
+                                _m[_c] = _v
+                        _c = 0
+                        while _m[_c] == _v:
+                            _c = _c + 1
+                        _pcolors[_v] = _c
+                        done += 1
+                uncolored = uncolored - done
+
+    def memory_usage(self):
+        """Return the memory used by each of the plan's arrays in bytes."""
+        return dict((name, a.nbytes if a is not None else 0)
+                    for name, a in self._arrays().iteritems())
+
+    @property
+    def nbytes(self):
+        """Total memory used by the plan's arrays in bytes."""
+        return sum(self.memory_usage().itervalues())
+
+    @property
+    def coloring_stats(self):
+        """Color counts and timings of the coloring, ``None`` if the plan
+        was loaded from disk."""
+        return self._coloring_stats
 
     @property
     def nargs(self):
@@ -0,0 +1,193 @@
+# This file is part of PyOP2
+#
+# PyOP2 is Copyright (c) 2012, Imperial College London and
+# others. Please see the AUTHORS file in the main source directory for
+# a full list of copyright holders.  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * The name of Imperial College London or that of other
+#       contributors may not be used to endorse or promote products
+#       derived from this software without specific prior written
+#       permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTERS
+# ''AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Mesh renumbering for improved data locality.
+
+Mesh data read from file keeps the numbering of the mesh generator, which is
+often hostile to caches when gathering data through a :class:`Map`. This
+module computes locality improving permutations of a :class:`Set` and applies
+them consistently to the :class:`Map` and :class:`Dat` objects defined on it.
+
+A typical use renumbers the nodes of a mesh following a reverse Cuthill-McKee
+ordering of the graph induced by the element-node map and then sorts the
+elements by their renumbered nodes::
+
+    node_perm = renumbering.rcm(elem_node)
+    renumbering.renumber(node_perm, (nodes, vnodes),
+                         maps=(elem_node, elem_vnode), dats=(coords,))
+    elem_perm = renumbering.iterset_order(elem_node)
+    renumbering.renumber(elem_perm, elements, maps=(elem_node, elem_vnode))
+
+Permutations are arrays ``perm`` such that the entity numbered ``i`` after
+renumbering was numbered ``perm[i]`` before.
+
+.. warning ::
+    Renumbering modifies the data in place and must happen before the data is
+    used in any :func:`~pyop2.op2.par_loop` or :class:`~pyop2.op2.Sparsity`,
+    since plans and sparsity patterns built for the old numbering are not
+    updated.
+"""
+
+from collections import deque
+import numpy as np
+
+from base import Dat, Map, Set
+from exceptions import MapValueError, SetValueError
+from utils import as_tuple
+
+def adjacency(maps):
+    """Return the adjacency graph of the entities the :class:`Map` objects
+    ``maps`` map to in CSR format as a pair of arrays ``(rowptr, colidx)``.
+    Two entities are adjacent if they are both mapped to by the same element
+    of one of the maps. All maps need to share the same dataset."""
+    maps = as_tuple(maps, Map)
+    n = maps[0].dataset.total_size
+    if any(m.dataset.total_size != n for m in maps):
+        raise MapValueError("All maps must map to sets of the same size")
+    rows = []
+    cols = []
+    for m in maps:
+        values = m.values.astype(np.int64)
+        for i in range(m.dim):
+            for j in range(m.dim):
+                if i != j:
+                    rows.append(values[:, i])
+                    cols.append(values[:, j])
+    if rows:
+        edges = np.unique(np.concatenate(rows) * n + np.concatenate(cols))
+    else:
+        edges = np.zeros(0, dtype=np.int64)
+    # Self loops arise from elements mapping to the same entity twice
+    edges = edges[edges // n != edges % n]
+    rowptr = np.zeros(n + 1, dtype=np.int32)
+    rowptr[1:] = np.cumsum(np.bincount(edges // n, minlength=n))
+    return rowptr, (edges % n).astype(np.int32)
+
+def rcm(maps):
+    """Return the reverse Cuthill-McKee permutation of the entities the
+    :class:`Map` objects ``maps`` map to, which reduces the bandwidth of the
+    induced adjacency graph. Every connected component is started from an
+    entity of lowest degree."""
+    rowptr, colidx = adjacency(maps)
+    n = len(rowptr) - 1
+    degree = np.diff(rowptr)
+    visited = np.zeros(n, dtype=bool)
+    order = []
+    for start in np.argsort(degree, kind='mergesort'):
+        if visited[start]:
+            continue
+        visited[start] = True
+        queue = deque([start])
+        while queue:
+            v = queue.popleft()
+            order.append(v)
+            nbrs = colidx[rowptr[v]:rowptr[v+1]]
+            nbrs = nbrs[~visited[nbrs]]
+            nbrs = nbrs[np.argsort(degree[nbrs], kind='mergesort')]
+            visited[nbrs] = True
+            queue.extend(nbrs)
+    return np.array(order[::-1], dtype=np.int32)
+
+def morton(coords, bits=16):
+    """Return the permutation ordering points along a Morton (Z-order) space
+    filling curve.
+
+    :arg coords: a :class:`Dat` or array of point coordinates of shape
+        ``(npoints, dim)``
+    :arg bits: the number of bits per coordinate direction the points are
+        quantised to"""
+    if isinstance(coords, Dat):
+        coords = coords.data_ro
+    coords = np.asarray(coords, dtype=np.float64)
+    coords = coords.reshape(coords.shape[0], -1)
+    if coords.shape[1] * bits > 63:
+        raise ValueError("Cannot interleave %d bits for %d dimensions" \
+                % (bits, coords.shape[1]))
+    lo = coords.min(axis=0)
+    extent = coords.max(axis=0) - lo
+    extent[extent == 0] = 1
+    grid = ((coords - lo) / extent * (2**bits - 1)).astype(np.uint64)
+    ndim = coords.shape[1]
+    key = np.zeros(coords.shape[0], dtype=np.uint64)
+    for b in range(bits):
+        for d in range(ndim):
+            bit = (grid[:, d] >> np.uint64(b)) & np.uint64(1)
+            key |= bit << np.uint64(b * ndim + d)
+    return np.argsort(key, kind='mergesort').astype(np.int32)
+
+def iterset_order(map):
+    """Return the permutation of the iteration set of ``map`` sorting its
+    elements lexicographically by the sorted entities they map to, such that
+    consecutive elements gather nearby data."""
+    values = np.sort(map.values, axis=1)
+    return np.lexsort(values.T[::-1]).astype(np.int32)
+
+def renumber(perm, sets, maps=(), dats=()):
+    """Renumber the entities of ``sets`` in place following the permutation
+    ``perm``.
+
+    :arg perm: the permutation; the entity numbered ``i`` after renumbering
+        was numbered ``perm[i]`` before
+    :arg sets: a :class:`Set` or tuple of sets all describing the same
+        entities (e.g. scalar and vector valued node sets)
+    :arg maps: the :class:`Map` objects to or from any of the ``sets``;
+        maps from the sets have their rows permuted, maps to the sets have
+        their values renumbered
+    :arg dats: the :class:`Dat` objects defined on any of the ``sets``"""
+    sets = as_tuple(sets, Set)
+    n = sets[0].total_size
+    for s in sets:
+        if s.halo is not None:
+            raise SetValueError("Cannot renumber Set %s with a halo" % s.name)
+        if s.total_size != n:
+            raise SetValueError("All sets must have the same size")
+    perm = np.asarray(perm, dtype=np.int32)
+    if perm.shape != (n,) or (np.bincount(perm, minlength=n) != 1).any():
+        raise ValueError("Not a permutation of %d entities" % n)
+    iperm = np.empty_like(perm)
+    iperm[perm] = np.arange(n, dtype=np.int32)
+
+    for m in as_tuple(maps, Map):
+        if m.iterset not in sets and m.dataset not in sets:
+            raise MapValueError("Map %s is not defined on the renumbered sets" % m.name)
+        values = m.values
+        if m.iterset in sets:
+            values = values[perm]
+        if m.dataset in sets:
+            values = iperm[values]
+        m.values = values
+    for d in as_tuple(dats, Dat):
+        if d.dataset not in sets:
+            raise SetValueError("Dat %s is not defined on the renumbered sets" % d.name)
+        d.data[:] = d.data[perm]
@@ -39,6 +39,7 @@ import numpy as np
 from exceptions import *
 from utils import as_tuple
 import op_lib_core as core
+import base
 import petsc_base
 from petsc_base import *
 import host
@@ -48,7 +49,11 @@ from host import Arg
 
 def par_loop(kernel, it_space, *args):
     """Invocation of an OP2 kernel with an access descriptor"""
-    ParLoop(kernel, it_space, *args).compute()
+    ParLoop(kernel, it_space, *args).enqueue()
+
+def prepare_par_loop(kernel, it_space, *args):
+    """Prepare an OP2 kernel invocation for repeated execution"""
+    return ParLoop(kernel, it_space, *args)
 
 class JITModule(host.JITModule):
 
@@ -73,25 +78,15 @@ void wrap_%(kernel_name)s__(PyObject *_start, PyObject *_end, %(wrapper_args)s %
 
 class ParLoop(host.ParLoop):
 
-    def compute(self):
+    def _build_jit_args(self):
+        # The first two arguments are the start and end of the range of
+        # elements to execute and need to be set by the caller
         fun = JITModule(self.kernel, self.it_space.extents, *self.args)
-        _args = [0, 0]          # start, stop
-        for arg in self.args:
-            if arg._is_mat:
-                _args.append(arg.data.handle.handle)
-            else:
-                _args.append(arg.data._data)
+        _args, refresh = self._marshal_args([0, 0])
+        return fun, _args, refresh
 
-            if arg._is_dat:
-                maybe_setflags(arg.data._data, write=False)
-
-            if arg._is_indirect or arg._is_mat:
-                maps = as_tuple(arg.map, Map)
-                for map in maps:
-                    _args.append(map.values)
-
-        for c in Const._definitions():
-            _args.append(c.data)
+    def compute(self):
+        fun, _args = self._jit_args()
 
         # kick off halo exchanges
         self.halo_exchange_begin()
@@ -107,12 +102,12 @@ class ParLoop(host.ParLoop):
         fun(*_args)
         # By splitting the reduction here we get two advantages:
         # - we don't double count contributions in halo elements
-        # - once our MPI supports the asynchronous collectives in
-        #   MPI-3, we can do more comp/comms overlap
+        # - the non-blocking reduction overlaps with the computation over
+        #   the exec halo and anything up to the next use of the Globals
         self.reduction_begin()
-        if self.needs_exec_halo:
+        if self._depth > 0:
             _args[0] = self.it_space.size
-            _args[1] = self.it_space.exec_size
+            _args[1] = self.it_space.iterset._depth_size(self._depth)
             fun(*_args)
         self.reduction_end()
         self.maybe_set_halo_update_needed()
@@ -120,5 +115,113 @@ class ParLoop(host.ParLoop):
             if arg._is_mat:
                 arg.data._assemble()
 
+class LoopChain(base.LoopChain):
+    """A chain of :func:`par_loop` calls executed with sparse tiling.
+
+    The inspector partitions the iteration set of the first loop into
+    contiguous tiles of ``tile_size`` elements, as the plan partitions an
+    iteration set into blocks. Every element of a subsequent loop is assigned
+    the highest tile of any element of an earlier loop touching the same
+    :class:`Set` entries. Tiles are then executed in order, running the
+    elements of each loop assigned to the tile in turn, which satisfies all
+    dependencies between the loops of the chain. Tile assignments are made
+    monotonic over each iteration set so that the elements of a loop within a
+    tile form a contiguous range.
+
+    Chains containing matrices, :class:`Global` reductions shared between
+    loops or data with halos are executed loop by loop."""
+
+    # Cache of inspected chains keyed on the chain's structure
+    _inspections = {}
+
+    def _tileable(self):
+        if len(self._loops) < 2:
+            return False
+        reduced = set()
+        accessed = set()
+        for loop in self._loops:
+            if loop.it_space.iterset.halo is not None:
+                return False
+            for arg in loop.args:
+                if arg._is_mat:
+                    return False
+                if arg._is_dat and arg.data.dataset.halo is not None:
+                    return False
+                if arg._is_global:
+                    if arg.data in reduced or \
+                       (arg._is_global_reduction and arg.data in accessed):
+                        return False
+                    accessed.add(arg.data)
+                    if arg._is_global_reduction:
+                        reduced.add(arg.data)
+        return True
+
+    @property
+    def _inspection_key(self):
+        key = (self._tile_size,)
+        for loop in self._loops:
+            key += (loop.it_space.iterset,)
+            # Maps modified in place change the tiling, hence their version
+            key += tuple((arg.data.dataset, arg.map, arg.map._version)
+                         for arg in loop.args if arg._is_dat)
+        return key
+
+    def _inspect(self):
+        """Compute the range of elements of every loop for every tile."""
+        stamps = {}
+        tiles = []
+        ntiles = max(1, -(-self._loops[0].it_space.size // self._tile_size))
+        for k, loop in enumerate(self._loops):
+            size = loop.it_space.size
+            accesses = []
+            for arg in loop.args:
+                if not arg._is_dat:
+                    continue
+                if arg._is_direct:
+                    idx = np.arange(size, dtype=np.int32).reshape(size, 1)
+                else:
+                    idx = arg.map.values[:size]
+                accesses.append((arg.data.dataset, idx))
+            if k == 0:
+                tile = np.arange(size, dtype=np.int32) // self._tile_size
+            else:
+                tile = np.zeros(size, dtype=np.int32)
+                for s, idx in accesses:
+                    if s in stamps and size > 0:
+                        tile = np.maximum(tile, stamps[s][idx].max(axis=1))
+                tile = np.maximum.accumulate(tile)
+            for s, idx in accesses:
+                stamp = stamps.setdefault(s, np.zeros(s.total_size, dtype=np.int32))
+                # Tiles are increasing with the element number and no lower
+                # than any stamp of the data touched, so the last element
+                # touching an entry determines its stamp
+                flat = idx.ravel()
+                vals = np.repeat(tile, idx.shape[1])
+                order = np.argsort(flat, kind='mergesort')
+                flat = flat[order]
+                last = np.append(flat[1:] != flat[:-1], True)
+                stamp[flat[last]] = vals[order][last]
+            tiles.append(np.searchsorted(tile, np.arange(ntiles + 1), side='left'))
+        return ntiles, tiles
+
+    def _run(self):
+        if not self._tileable():
+            return super(LoopChain, self)._run()
+        key = self._inspection_key
+        if key not in LoopChain._inspections:
+            LoopChain._inspections[key] = self._inspect()
+        ntiles, tiles = LoopChain._inspections[key]
+        jit_args = [loop._jit_args() for loop in self._loops]
+        for t in range(ntiles):
+            for (fun, _args), bounds in zip(jit_args, tiles):
+                if bounds[t] < bounds[t + 1]:
+                    _args[0] = int(bounds[t])
+                    _args[1] = int(bounds[t + 1])
+                    fun(*_args)
+        for loop in self._loops:
+            loop.reduction_begin()
+            loop.reduction_end()
+            loop.maybe_set_halo_update_needed()
+
 def _setup():
     pass
@@ -1,5 +1,6 @@
 #include <vector>
 #include <set>
+#include <algorithm>
 #include "sparsity_utils.h"
 
 void build_sparsity_pattern_seq ( int rmult, int cmult, int nrows, int nmaps,
@@ -103,3 +104,167 @@ void build_sparsity_pattern_mpi ( int rmult, int cmult, int nrows, int nmaps,
   *_d_nz = d_nz;
   *_o_nz = o_nz;
 }
+
+namespace {
+
+// Elements incident to each row node, across all maps, in CSR layout
+struct incidence {
+  std::vector<int> offsets;
+  std::vector<int> elems;
+  std::vector<int> maps;
+  // One more than the largest column node referenced
+  int ncols;
+};
+
+void build_incidence ( int nrows, int nmaps, op_map * rowmaps,
+                       op_map * colmaps, bool halo, incidence & inc )
+{
+  inc.offsets.assign(nrows + 1, 0);
+  inc.ncols = 0;
+  for ( int m = 0; m < nmaps; m++ ) {
+    op_map rowmap = rowmaps[m];
+    op_map colmap = colmaps[m];
+    int rsize = rowmap->from->size + (halo ? rowmap->from->exec_size : 0);
+    for ( int e = 0; e < rsize; ++e ) {
+      for ( int i = 0; i < rowmap->dim; ++i ) {
+        int n = rowmap->map[i + e*rowmap->dim];
+        // ignore rows inside the MPI halo region
+        if ( n < nrows ) inc.offsets[n+1]++;
+      }
+      for ( int d = 0; d < colmap->dim; d++ ) {
+        inc.ncols = std::max(inc.ncols, colmap->map[d + e*colmap->dim] + 1);
+      }
+    }
+  }
+  for ( int n = 0; n < nrows; ++n ) {
+    inc.offsets[n+1] += inc.offsets[n];
+  }
+  inc.elems.resize(inc.offsets[nrows]);
+  inc.maps.resize(inc.offsets[nrows]);
+  std::vector<int> pos(inc.offsets.begin(), inc.offsets.end() - 1);
+  for ( int m = 0; m < nmaps; m++ ) {
+    op_map rowmap = rowmaps[m];
+    int rsize = rowmap->from->size + (halo ? rowmap->from->exec_size : 0);
+    for ( int e = 0; e < rsize; ++e ) {
+      for ( int i = 0; i < rowmap->dim; ++i ) {
+        int n = rowmap->map[i + e*rowmap->dim];
+        if ( n < nrows ) {
+          inc.elems[pos[n]] = e;
+          inc.maps[pos[n]++] = m;
+        }
+      }
+    }
+  }
+}
+
+// Collect the distinct column nodes coupled to row node n into cols,
+// marker holds the last row node each column node was collected for
+void gather_cols ( const incidence & inc, op_map * colmaps, int n,
+                   std::vector<int> & marker, std::vector<int> & cols )
+{
+  cols.clear();
+  for ( int j = inc.offsets[n]; j < inc.offsets[n+1]; ++j ) {
+    op_map colmap = colmaps[inc.maps[j]];
+    int e = inc.elems[j];
+    for ( int d = 0; d < colmap->dim; d++ ) {
+      int c = colmap->map[d + e*colmap->dim];
+      if ( marker[c] != n ) {
+        marker[c] = n;
+        cols.push_back(c);
+      }
+    }
+  }
+}
+
+}
+
+void build_sparsity_rowptr_seq ( int rmult, int cmult, int nrows, int nmaps,
+                                 op_map * rowmaps, op_map * colmaps,
+                                 int * nnz, int * rowptr )
+{
+  // All rows of a row node share the column nodes of the elements incident
+  // to it, so the number of nonzeros is counted per row node
+  incidence inc;
+  build_incidence(nrows, nmaps, rowmaps, colmaps, false, inc);
+
+  #pragma omp parallel
+  {
+    std::vector<int> marker(inc.ncols, -1), cols;
+    #pragma omp for schedule(static)
+    for ( int n = 0; n < nrows; ++n ) {
+      gather_cols(inc, colmaps, n, marker, cols);
+      for ( int r = 0; r < rmult; r++ ) {
+        nnz[rmult * n + r] = cols.size() * cmult;
+      }
+    }
+  }
+
+  rowptr[0] = 0;
+  for ( int row = 0; row < nrows*rmult; ++row ) {
+    rowptr[row+1] = rowptr[row] + nnz[row];
+  }
+}
+
+void build_sparsity_colidx_seq ( int rmult, int cmult, int nrows, int nmaps,
+                                 op_map * rowmaps, op_map * colmaps,
+                                 const int * rowptr, int * colidx )
+{
+  incidence inc;
+  build_incidence(nrows, nmaps, rowmaps, colmaps, false, inc);
+
+  #pragma omp parallel
+  {
+    std::vector<int> marker(inc.ncols, -1), cols;
+    #pragma omp for schedule(static)
+    for ( int n = 0; n < nrows; ++n ) {
+      gather_cols(inc, colmaps, n, marker, cols);
+      std::sort(cols.begin(), cols.end());
+      for ( int r = 0; r < rmult; r++ ) {
+        int * out = colidx + rowptr[rmult * n + r];
+        for ( size_t k = 0; k < cols.size(); ++k ) {
+          for ( int c = 0; c < cmult; c++ ) {
+            *out++ = cmult * cols[k] + c;
+          }
+        }
+      }
+    }
+  }
+}
+
+void build_sparsity_nnz_mpi ( int rmult, int cmult, int nrows, int nmaps,
+                              op_map * rowmaps, op_map * colmaps,
+                              int * d_nnz, int * o_nnz,
+                              int * _d_nz, int * _o_nz )
+{
+  int lsize = nrows*rmult;
+  int d_nz = 0, o_nz = 0;
+  incidence inc;
+  build_incidence(nrows, nmaps, rowmaps, colmaps, true, inc);
+
+  #pragma omp parallel
+  {
+    std::vector<int> marker(inc.ncols, -1), cols;
+    #pragma omp for schedule(static) reduction(+:d_nz,o_nz)
+    for ( int n = 0; n < nrows; ++n ) {
+      gather_cols(inc, colmaps, n, marker, cols);
+      int dn = 0, on = 0;
+      for ( size_t k = 0; k < cols.size(); ++k ) {
+        for ( int c = 0; c < cmult; c++ ) {
+          if ( cmult * cols[k] + c < lsize ) {
+            dn++;
+          } else {
+            on++;
+          }
+        }
+      }
+      for ( int r = 0; r < rmult; r++ ) {
+        d_nnz[rmult * n + r] = dn;
+        o_nnz[rmult * n + r] = on;
+      }
+      d_nz += rmult * dn;
+      o_nz += rmult * on;
+    }
+  }
+  *_d_nz = d_nz;
+  *_o_nz = o_nz;
+}
@@ -17,6 +17,19 @@ void build_sparsity_pattern_mpi ( int rmult, int cmult, int nrows, int nmaps,
                                   int ** d_nnz, int ** o_nnz,
                                   int * d_nz, int * o_nz );
 
+void build_sparsity_rowptr_seq ( int rmult, int cmult, int nrows, int nmaps,
+                                 op_map * rowmaps, op_map * colmaps,
+                                 int * nnz, int * rowptr );
+
+void build_sparsity_colidx_seq ( int rmult, int cmult, int nrows, int nmaps,
+                                 op_map * rowmaps, op_map * colmaps,
+                                 const int * rowptr, int * colidx );
+
+void build_sparsity_nnz_mpi ( int rmult, int cmult, int nrows, int nmaps,
+                              op_map * rowmaps, op_map * colmaps,
+                              int * d_nnz, int * o_nnz,
+                              int * d_nz, int * o_nz );
+
 #ifdef __cplusplus
 }
 #endif
@@ -220,6 +220,15 @@ def parser(description=None, group=False):
     g.add_argument('--legacy-plan', dest='python_plan', action='store_false',
                    default=argparse.SUPPRESS,
                    help='use the legacy plan' if group else 'set pyop2 to use the legacy plan')
+    g.add_argument('--lazy', dest='lazy_evaluation', action='store_true',
+                   default=argparse.SUPPRESS,
+                   help='use lazy evaluation' if group else 'set pyop2 to delay par_loop execution')
+    g.add_argument('--loop-fusion', dest='loop_fusion', action='store_true',
+                   default=argparse.SUPPRESS,
+                   help='fuse direct loops' if group else 'set pyop2 to fuse consecutive direct par_loops')
+    g.add_argument('--compiler-profile', dest='compiler_profile',
+                   default=argparse.SUPPRESS,
+                   help='select compiler profile' if group else 'select pyop2 compiler profile for generated code')
 
     return parser
 
@@ -61,6 +61,10 @@ class Mat(object):
     def __init__(self, *args, **kwargs):
         raise RuntimeError("Please call op2.init to select a backend")
 
+class MatrixFree(object):
+    def __init__(self, *args, **kwargs):
+        raise RuntimeError("Please call op2.init to select a backend")
+
 class Const(object):
     def __init__(self, *args, **kwargs):
         raise RuntimeError("Please call op2.init to select a backend")
@@ -81,8 +85,15 @@ class Solver(object):
     def __init__(self, *args, **kwargs):
         raise RuntimeError("Please call op2.init to select a backend")
 
+class LoopChain(object):
+    def __init__(self, *args, **kwargs):
+        raise RuntimeError("Please call op2.init to select a backend")
+
 def par_loop(*args, **kwargs):
     raise RuntimeError("Please call op2.init to select a backend")
 
+def prepare_par_loop(*args, **kwargs):
+    raise RuntimeError("Please call op2.init to select a backend")
+
 def solve(*args, **kwargs):
     raise RuntimeError("Please call op2.init to select a backend")
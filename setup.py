@@ -35,9 +35,12 @@
 
 from setuptools import setup
 from distutils.extension import Extension
+from distutils import ccompiler, sysconfig
+from distutils.errors import CompileError, LinkError
 from glob import glob
+from subprocess import Popen, PIPE
 import numpy
-import os, sys
+import os, shutil, sys, tempfile
 
 # Find OP2 include and library directories
 execfile('pyop2/find_op2.py')
@@ -54,6 +57,38 @@ except ImportError:
     cmdclass = {}
     op_lib_core_sources = ['pyop2/op_lib_core.c', 'pyop2/sparsity_utils.cxx']
 
+def openmp_flags():
+    """Compile and link flags building the plan colouring with OpenMP, taken
+    from OMP_CXX_FLAGS and OMP_LIBS if set like for the openmp backend, else
+    detected from the compiler. Empty if the compiler does not support
+    OpenMP, in which case the plan is coloured on a single thread."""
+    if os.environ.get('OMP_CXX_FLAGS'):
+        libs = os.environ.get('OMP_LIBS')
+        return [os.environ['OMP_CXX_FLAGS']], ['-l' + libs] if libs else []
+    compiler = ccompiler.new_compiler()
+    sysconfig.customize_compiler(compiler)
+    try:
+        version = Popen(compiler.compiler[:1] + ['--version'], stdout=PIPE,
+                        stderr=PIPE).communicate()[0]
+    except OSError:
+        version = ''
+    flag = '-openmp' if 'Intel Corporation' in version else '-fopenmp'
+    tmpdir = tempfile.mkdtemp()
+    try:
+        src = os.path.join(tmpdir, 'omp.c')
+        with open(src, 'w') as f:
+            f.write('#include <omp.h>\nint main(void) { return omp_get_max_threads() < 1; }\n')
+        objs = compiler.compile([src], output_dir=tmpdir, extra_postargs=[flag])
+        compiler.link_executable(objs, os.path.join(tmpdir, 'omp'), extra_postargs=[flag])
+    except (CompileError, LinkError):
+        print "OpenMP not supported by the compiler, building without it"
+        return [], []
+    finally:
+        shutil.rmtree(tmpdir)
+    return [flag], [flag]
+
+omp_compile_args, omp_link_args = openmp_flags()
+
 setup_requires = [
         'numpy>=1.6',
         ]
@@ -89,11 +124,14 @@ setup(name='PyOP2',
       install_requires=install_requires,
       packages=['pyop2','pyop2_utils'],
       package_dir={'pyop2':'pyop2','pyop2_utils':'pyop2_utils'},
-      package_data={'pyop2': ['assets/*', 'mat_utils.*', 'sparsity_utils.*', '*.pyx', '*.pxd']},
+      package_data={'pyop2': ['assets/*', 'mat_utils.*', 'sparsity_utils.*', 'omp_compat.h',
+                               '*.pyx', '*.pxd']},
       scripts=glob('scripts/*'),
       cmdclass=cmdclass,
       ext_modules=[Extension('pyop2.op_lib_core', op_lib_core_sources,
                              include_dirs=['pyop2', OP2_INC, numpy.get_include()],
                              library_dirs=[OP2_LIB],
                              runtime_library_dirs=[OP2_LIB],
-                             libraries=["op2_seq"])])
+                             libraries=["op2_seq"],
+                             extra_compile_args=omp_compile_args,
+                             extra_link_args=omp_link_args)])
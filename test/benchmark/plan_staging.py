@@ -0,0 +1,85 @@
+# This file is part of PyOP2
+#
+# PyOP2 is Copyright (c) 2012, Imperial College London and
+# others. Please see the AUTHORS file in the main source directory for
+# a full list of copyright holders.  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * The name of Imperial College London or that of other
+#       contributors may not be used to endorse or promote products
+#       derived from this software without specific prior written
+#       permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTERS
+# ''AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Benchmark the plan staging construction against the Python reference
+implementation on a random unstructured mesh.
+
+Usage: python plan_staging.py [-n NELEMS] [-p PARTITION_SIZE]"""
+
+import os
+import sys
+from time import time
+
+import numpy
+
+from pyop2 import op2, device, utils
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'unit'))
+from test_plan import reference_staging
+
+
+def main(nelems, partition_size):
+    cells = op2.Set(nelems, 1, "cells")
+    nodes = op2.Set(nelems / 2, 1, "nodes")
+    cell2node = op2.Map(cells, nodes, 3,
+                        numpy.random.randint(0, nelems / 2, 3 * nelems), "cell2node")
+    x = op2.Dat(nodes, numpy.zeros(nelems / 2), numpy.float64, "x")
+    args = [x(cell2node[i], op2.INC) for i in range(3)]
+    kernel = op2.Kernel("", "dummy")
+
+    t = time()
+    plan = device.Plan(kernel, cells, *args, partition_size=partition_size,
+                       thread_coloring=False, refresh_cache=True)
+    t_plan = time() - t
+
+    t = time()
+    ref = reference_staging(cells, partition_size, *args)
+    t_ref = time() - t
+
+    match = all((getattr(plan, k) == v).all() for k, v in ref.iteritems() if k != 'nshared')
+    print "%d elements, %d blocks" % (nelems, plan.nblocks)
+    print "plan (staging and coloring): %.3fs" % t_plan
+    print "python staging reference:    %.3fs" % t_ref
+    print "results match: %s" % match
+
+if __name__ == '__main__':
+    parser = utils.parser(group=True, description=__doc__)
+    parser.add_argument('-n', '--nelems', type=int, default=1000000,
+                        help='number of mesh elements')
+    parser.add_argument('-p', '--partition-size', type=int, default=128,
+                        help='plan partition size')
+    opt = vars(parser.parse_args())
+    nelems, ps = opt.pop('nelems'), opt.pop('partition_size')
+    op2.init(**opt)
+    main(nelems, ps)
@@ -0,0 +1,89 @@
+# This file is part of PyOP2
+#
+# PyOP2 is Copyright (c) 2012, Imperial College London and
+# others. Please see the AUTHORS file in the main source directory for
+# a full list of copyright holders.  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * The name of Imperial College London or that of other
+#       contributors may not be used to endorse or promote products
+#       derived from this software without specific prior written
+#       permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTERS
+# ''AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Benchmark the sparsity builder against the std::set based reference
+builder on a structured tetrahedral mesh of the unit cube.
+
+The number of threads used is controlled by OMP_NUM_THREADS.
+
+Usage: python sparsity_build.py [-n NODES_PER_SIDE] [--vector]"""
+
+from time import time
+
+import numpy
+
+from pyop2 import op2, utils
+from pyop2 import op_lib_core as core
+
+
+def tet_mesh(n):
+    """Cell to node connectivity of n^3 nodes, five tetrahedra per cube."""
+    i, j, k = numpy.mgrid[0:n-1, 0:n-1, 0:n-1]
+    corners = [((i + di) * n + (j + dj)) * n + (k + dk)
+               for di in (0, 1) for dj in (0, 1) for dk in (0, 1)]
+    tets = [(0, 1, 2, 4), (1, 2, 3, 7), (1, 4, 5, 7), (2, 4, 6, 7), (1, 2, 4, 7)]
+    return numpy.hstack([numpy.column_stack([corners[c].ravel() for c in t])
+                         for t in tets]).reshape(-1, 4)
+
+
+def main(n, dim):
+    cell2node = tet_mesh(n)
+    cells = op2.Set(len(cell2node), 1, "cells")
+    nodes = op2.Set(n ** 3, dim, "nodes")
+    m = op2.Map(cells, nodes, 4, cell2node, "cell2node")
+
+    t = time()
+    sparsity = op2.Sparsity((m, m), "sparsity")
+    t_new = time() - t
+
+    t = time()
+    nnz, onnz, rowptr, colidx = core.build_sparsity_reference(sparsity, False)
+    t_ref = time() - t
+
+    print "%d cells, %d rows, %d nonzeros" % (cells.size, len(sparsity.nnz),
+                                              sparsity.rowptr[-1])
+    print "sparsity builder:  %.3fs" % t_new
+    print "reference builder: %.3fs" % t_ref
+    print "results match: %s" % ((sparsity.rowptr == rowptr).all() and
+                                 (sparsity.colidx == colidx).all())
+
+if __name__ == '__main__':
+    parser = utils.parser(group=True, description=__doc__)
+    parser.add_argument('-n', '--nodes-per-side', type=int, default=60,
+                        help='number of mesh nodes per side of the cube')
+    parser.add_argument('--vector', action='store_true',
+                        help='build the sparsity of a 3-vector field')
+    opt = vars(parser.parse_args())
+    n, vector = opt.pop('nodes_per_side'), opt.pop('vector')
+    op2.init(**opt)
+    main(n, 3 if vector else 1)
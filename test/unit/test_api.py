@@ -295,6 +295,15 @@ class TestDatAPI:
         x[0] = -100
         assert (d.data_ro[0] == -100).all()
 
+    def test_dat_version(self, backend, set):
+        "Accessing the data for writing should increment the version."
+        d = op2.Dat(set, range(np.prod(set.dim) * set.size), dtype=np.int32)
+        version = d.version
+        d.data_ro
+        assert d.version == version
+        d.data
+        assert d.version > version
+
 class TestSparsityAPI:
     """
     Sparsity API unit tests
@@ -643,6 +652,16 @@ class TestMapAPI:
         assert m.iterset == iterset and m.dataset == dataset and m.dim == 2 \
                 and m.values.sum() == 2*iterset.size and m.name == 'bar'
 
+    def test_map_values_read_only(self, backend, iterset, dataset):
+        "Map values should only be modified by assigning to them."
+        m = op2.Map(iterset, dataset, 1, [0] * iterset.size, 'm')
+        with pytest.raises(ValueError):
+            m.values[0] = 1
+        h = m._content_hash
+        m.values = [1] * iterset.size
+        assert m.values.sum() == iterset.size
+        assert m._content_hash != h
+
     def test_map_indexing(self, backend, iterset, dataset):
         "Indexing a map should create an appropriate Arg"
         m = op2.Map(iterset, dataset, 2, [1] * 2 * iterset.size, 'm')
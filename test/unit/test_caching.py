@@ -31,6 +31,7 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
 # OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import os
 import pytest
 import numpy
 import random
@@ -307,6 +308,66 @@ void kernel_swap(unsigned int* x)
         assert len(self.cache) == 2
         assert plan1 is not plan2
 
+    def test_dat_aliasing_not_shared(self, backend, iterset, iter2ind1, iter2ind2, x, y):
+        self.cache.clear()
+        assert len(self.cache) == 0
+        k = op2.Kernel("""void dummy(unsigned int* x, unsigned int* y) {}""", "dummy")
+        op2.par_loop(k, iterset, x(iter2ind1[0], op2.INC), y(iter2ind2[0], op2.INC))
+        assert len(self.cache) == 1
+
+        # Both arguments increment the same Dat and race with each other
+        op2.par_loop(k, iterset, x(iter2ind1[0], op2.INC), x(iter2ind2[0], op2.INC))
+        assert len(self.cache) == 2
+
+    def test_equal_map_values_share_plan(self, backend, iterset, indset, iter2ind1, x):
+        self.cache.clear()
+        assert len(self.cache) == 0
+        k = op2.Kernel("""void dummy(unsigned int* x) {}""", "dummy")
+        op2.par_loop(k, iterset, x(iter2ind1[0], op2.INC))
+        assert len(self.cache) == 1
+
+        # A different Map with the same values, e.g. after reloading a mesh
+        m = op2.Map(iterset, indset, 1, iter2ind1.values.copy(), "iter2ind1_copy")
+        op2.par_loop(k, iterset, x(m[0], op2.INC))
+        assert len(self.cache) == 1
+
+    def test_differing_map_values_not_shared(self, backend, iterset, indset, iter2ind1, x):
+        self.cache.clear()
+        assert len(self.cache) == 0
+        k = op2.Kernel("""void dummy(unsigned int* x) {}""", "dummy")
+        op2.par_loop(k, iterset, x(iter2ind1[0], op2.INC))
+        assert len(self.cache) == 1
+
+        m = op2.Map(iterset, indset, 1, iter2ind1.values[::-1].copy(), "iter2ind1_rev")
+        op2.par_loop(k, iterset, x(m[0], op2.INC))
+        assert len(self.cache) == 2
+
+    def test_plan_stored_on_disk(self, backend, request, tmpdir, iterset, iter2ind1, x):
+        request.addfinalizer(op2.init)
+        op2.init(plan_cache_dir=str(tmpdir))
+        self.cache.clear()
+        k = op2.Kernel("""void dummy(unsigned int* x) {}""", "dummy")
+        op2.par_loop(k, iterset, x(iter2ind1[0], op2.INC))
+        assert len(tmpdir.listdir()) == 1
+        plan = self.cache.values()[0]
+
+        # Dropping the in-memory cache loads the plan back from disk
+        self.cache.clear()
+        op2.par_loop(k, iterset, x(iter2ind1[0], op2.INC))
+        assert len(tmpdir.listdir()) == 1
+        loaded = self.cache.values()[0]
+        assert loaded is not plan
+        assert loaded.nblocks == plan.nblocks
+        assert loaded.ncolors == plan.ncolors
+        assert loaded.nshared == plan.nshared
+        assert (loaded.blkmap == plan.blkmap).all()
+        # Without staging and thread colouring (openmp) these are not built
+        for attr in ['thrcol', 'ind_map', 'loc_map']:
+            if getattr(plan, attr) is None:
+                assert getattr(loaded, attr) is None
+            else:
+                assert (getattr(loaded, attr) == getattr(plan, attr)).all()
+
 class TestGeneratedCodeCache:
     """
     Generated Code Cache Tests.
@@ -579,6 +640,102 @@ class TestKernelCache:
         k2 = op2.Kernel("void l(void *x) {}", 'l')
         assert k1 is not k2 and len(self.cache) == 2
 
+class TestJITDiskCache:
+    """
+    On-disk cache of compiled modules tests.
+    """
+
+    backends = ['sequential', 'openmp']
+
+    @pytest.fixture
+    def cachedir(cls, tmpdir):
+        for i, name in enumerate(['a', 'b', 'c']):
+            d = tmpdir.mkdir(name)
+            d.join('module.so').write('x' * 512 * 1024)
+            os.utime(str(d), (i, i))
+        return str(tmpdir)
+
+    def modules(self, cachedir):
+        # Instant keeps a lock file next to every module
+        return sorted(n for n in os.listdir(cachedir)
+                      if os.path.isdir(os.path.join(cachedir, n)))
+
+    def test_prune_oldest(self, backend, cachedir):
+        from pyop2 import host
+        host._prune_disk_cache(cachedir, 1)
+        assert self.modules(cachedir) == ['b', 'c']
+
+    def test_prune_keeps_newest(self, backend, cachedir):
+        from pyop2 import host
+        host._prune_disk_cache(cachedir, 0)
+        assert self.modules(cachedir) == ['c']
+
+    def test_compiler_identity(self, backend):
+        from pyop2 import host
+        path, version = host._compiler_identity('mpicc')
+        assert os.path.isabs(path) and version
+        # Only determined once per process
+        assert host._compiler_identity('mpicc') is host._compiler_identity('mpicc')
+
+    def test_module_stored_on_disk(self, backend, tmpdir):
+        op2.init(jit_cache_dir=str(tmpdir))
+        s = op2.Set(4)
+        d = op2.Dat(s, numpy.zeros(4), numpy.float64)
+        op2.par_loop(op2.Kernel("void disk_cached(double *x) { *x = 1.0; }",
+                                "disk_cached"), s, d(op2.IdentityMap, op2.WRITE))
+        op2.init(jit_cache_dir=None)
+        assert all(d.data_ro == 1.0)
+        assert len(tmpdir.listdir()) > 0
+
+class TestCompilerProfiles:
+    """
+    Compiler profile tests.
+    """
+
+    backends = ['sequential', 'openmp']
+
+    @pytest.fixture
+    def reset_config(cls, request, backend):
+        request.addfinalizer(op2.init)
+
+    def test_default_profile(self, backend, reset_config):
+        from pyop2 import host
+        op2.init()
+        assert host._profile_flags('k') == ['-O2']
+
+    def test_production_profile(self, backend, reset_config):
+        from pyop2 import host
+        op2.init(compiler_profile='production')
+        flags = host._profile_flags('k')
+        assert '-O3' in flags and '-ffast-math' in flags and '-march=native' in flags
+
+    def test_kernel_override(self, backend, reset_config):
+        from pyop2 import host
+        op2.init(compiler_kernel_overrides={'k': 'debug', 'l': {'opt_level': 1}})
+        assert host._profile_flags('k') == ['-O0', '-g']
+        assert host._profile_flags('l') == ['-O1']
+        assert host._profile_flags('m') == ['-O2']
+
+    def test_unknown_profile(self, backend, reset_config):
+        from pyop2 import host
+        op2.init(compiler_profile='nonexistent')
+        with pytest.raises(ValueError):
+            host._profile_flags('k')
+
+    def test_profile_in_cache_key(self, backend, reset_config):
+        from pyop2 import host
+        s = op2.Set(4)
+        d = op2.Dat(s, numpy.zeros(4), numpy.float64)
+        k = op2.Kernel("void profiled(double *x) { *x += 1.0; }", "profiled")
+        cache = op2.base.JITModule._cache
+        cache.clear()
+        op2.par_loop(k, s, d(op2.IdentityMap, op2.RW))
+        op2.init(compiler_profile='production')
+        op2.par_loop(k, s, d(op2.IdentityMap, op2.RW))
+        assert len(cache) == 2
+        assert all(d.data_ro == 2.0)
+        assert '-O3' in host.compiler_flags()['profiled']
+
 class TestSparsityCache:
 
     @pytest.fixture
@@ -649,6 +806,45 @@ class TestSparsityCache:
         assert mat1._colidx is mat2._colidx
         assert mat1._rowptr is mat2._rowptr
 
+    def test_sparsities_same_map_values_share_pattern(self, backend, s1, s2, m1):
+        """Sparsities over distinct maps with the same values should share
+        the CSR pattern."""
+        m = op2.Map(s1, s2, 1, m1.values.copy())
+        sp1 = op2.Sparsity(m1)
+        sp2 = op2.Sparsity(m)
+        assert sp1 is not sp2
+        assert sp1._d_nnz is sp2._d_nnz
+        assert sp1._rowptr is sp2._rowptr
+
+    def test_sparsity_pattern_released(self, backend, s1, s2, m1):
+        """The shared CSR pattern should be dropped once no Sparsity uses
+        it anymore."""
+        import gc
+        op2.base.Sparsity._cache.clear()
+        sp = op2.Sparsity(m1)
+        key = sp._pattern_key()
+        assert key in op2.base.Sparsity._patterns
+        op2.base.Sparsity._cache.clear()
+        del sp
+        gc.collect()
+        assert key not in op2.base.Sparsity._patterns
+
+    def test_sparsity_pattern_stored_on_disk(self, backend, request, tmpdir, s1, s2, m1):
+        request.addfinalizer(op2.init)
+        op2.init(sparsity_cache_dir=str(tmpdir))
+        op2.base.Sparsity._patterns.clear()
+        sp1 = op2.Sparsity(m1)
+        assert len(tmpdir.listdir()) == 1
+
+        # Dropping the in-memory patterns loads the pattern from disk
+        op2.base.Sparsity._patterns.clear()
+        sp2 = op2.Sparsity(op2.Map(s1, s2, 1, m1.values.copy()))
+        assert isinstance(sp2._d_nnz, numpy.memmap)
+        assert (sp2._d_nnz == sp1._d_nnz).all()
+        assert (sp2._rowptr == sp1._rowptr).all()
+        assert (sp2._colidx == sp1._colidx).all()
+        assert sp2.nz == sp1.nz
+
 if __name__ == '__main__':
     import os
     pytest.main(os.path.abspath(__file__))
@@ -112,3 +112,28 @@ void dummy(double* mat[1][1], unsigned int* x, int i, int j)
                 assert (counter < 2).all()
 
             eidx += plan.nelems[p]
+
+    def test_parallel_block_coloring(self, backend, elements, elem_node, x):
+        if not cfg['python_plan']:
+            pytest.skip()
+
+        kernel = op2.Kernel("void dummy(unsigned int* x) {}", "dummy")
+        plan = device.Plan(kernel,
+                           elements,
+                           x(elem_node[0], op2.INC),
+                           x(elem_node[1], op2.INC),
+                           partition_size=2,
+                           block_coloring='parallel',
+                           refresh_cache=True)
+
+        # partitions of the same color must not touch the same nodes
+        start = numpy.concatenate(([0], numpy.cumsum(plan.nelems)[:-1]))
+        b = 0
+        for c in range(plan.ncolors):
+            counter = numpy.zeros(NUM_NODES, dtype=numpy.uint32)
+            for p in plan.blkmap[b:b + plan.ncolblk[c]]:
+                nodes = numpy.unique(elem_node.values[start[p]:start[p] + plan.nelems[p], :2])
+                counter[nodes] += 1
+            assert (counter < 2).all()
+            b += plan.ncolblk[c]
+        assert plan.coloring_stats['ncolors'] == plan.ncolors
@@ -212,6 +212,56 @@ void kernel_soa(unsigned int * x) { OP2_STRIDE(x, 0) = 42; OP2_STRIDE(x, 1) = 43
         y.zero()
         assert (y.data == 0).all()
 
+class TestPreparedDirectLoop:
+    """
+    Prepared direct loop tests
+    """
+
+    @pytest.fixture
+    def x(cls, elems):
+        return op2.Dat(elems, xarray(), numpy.uint32, "x")
+
+    @pytest.fixture
+    def g(cls):
+        return op2.Global(1, 0, numpy.uint32, "g")
+
+    def test_prepared_repeat(self, backend, elems, x):
+        kernel_inc = """
+void kernel_inc(unsigned int* x) { (*x) = (*x) + 1; }
+"""
+        inc = op2.prepare_par_loop(op2.Kernel(kernel_inc, "kernel_inc"), elems,
+                                   x(op2.IdentityMap, op2.RW))
+        for i in range(3):
+            inc()
+        assert all(x.data == xarray() + 3)
+
+    def test_prepared_sees_host_writes(self, backend, elems, x, g):
+        kernel_sum = """
+void kernel_sum(unsigned int* x, unsigned int* g) { (*g) += (*x); }
+"""
+        s = op2.prepare_par_loop(op2.Kernel(kernel_sum, "kernel_sum"), elems,
+                                 x(op2.IdentityMap, op2.READ), g(op2.INC))
+        s()
+        assert g.data[0] == nelems * (nelems - 1) / 2
+        x.data[:] = 1
+        g.data = 0
+        s()
+        assert g.data[0] == nelems
+
+    def test_prepared_sees_map_changes(self, backend, elems, x):
+        m = op2.Map(elems, elems, 1, numpy.zeros(nelems), "m")
+        kernel_inc = """
+void kernel_inc(unsigned int* x) { (*x) = (*x) + 1; }
+"""
+        inc = op2.prepare_par_loop(op2.Kernel(kernel_inc, "kernel_inc"), elems,
+                                   x(m[0], op2.INC))
+        inc()
+        assert x.data_ro[0] == nelems
+        m.values = numpy.ones(nelems)
+        inc()
+        assert x.data_ro[0] == nelems
+        assert x.data_ro[1] == nelems + 1
+
 if __name__ == '__main__':
     import os
     pytest.main(os.path.abspath(__file__))
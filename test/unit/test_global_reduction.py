@@ -398,3 +398,30 @@ void kernel_max(double* x, double* g)
                      g2(op2.INC))
         assert g2.data == d1.data.sum() + 10
 
+    def test_1d_inc_and_max_same_loop(self, backend, set, d1):
+        k = """
+        void k(unsigned int *x, unsigned int *g, unsigned int *h, unsigned int *m) {
+        *g += *x; *h += 2 * *x; if (*x > *m) *m = *x;
+        }
+        """
+        g = op2.Global(1, 0, dtype=numpy.uint32)
+        h = op2.Global(1, 1, dtype=numpy.uint32)
+        m = op2.Global(1, 0, dtype=numpy.uint32)
+        op2.par_loop(op2.Kernel(k, "k"), set,
+                     d1(op2.IdentityMap, op2.READ),
+                     g(op2.INC), h(op2.INC), m(op2.MAX))
+        assert g.data == d1.data.sum()
+        assert h.data == d1.data.sum()*2 + 1
+        assert m.data == nelems
+
+    def test_1d_inc_global_read_by_next_loop(self, backend, k1_inc_to_global,
+                                             k1_write_to_dat, set, d1):
+        g = op2.Global(1, 0, dtype=numpy.uint32)
+        d = op2.Dat(set, numpy.zeros(nelems), dtype=numpy.uint32)
+        op2.par_loop(k1_inc_to_global, set,
+                     d1(op2.IdentityMap, op2.READ),
+                     g(op2.INC))
+        op2.par_loop(k1_write_to_dat, set,
+                     d(op2.IdentityMap, op2.WRITE),
+                     g(op2.READ))
+        assert all(d.data == d1.data.sum())
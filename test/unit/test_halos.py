@@ -0,0 +1,148 @@
+# This file is part of PyOP2
+#
+# PyOP2 is Copyright (c) 2012, Imperial College London and
+# others. Please see the AUTHORS file in the main source directory for
+# a full list of copyright holders.  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * The name of Imperial College London or that of other
+#       contributors may not be used to endorse or promote products
+#       derived from this software without specific prior written
+#       permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTERS
+# ''AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Deep halo unit tests.
+"""
+
+import pytest
+import numpy
+
+from pyop2 import op2
+from pyop2 import halos
+
+backends = ['sequential']
+
+nelems = 8
+
+def _halo():
+    return op2.Halo([[]] * op2.MPI.comm.size, [[]] * op2.MPI.comm.size)
+
+@pytest.fixture
+def elements():
+    return op2.Set([nelems, nelems, nelems + 1, nelems + 2, nelems + 2], 1,
+                   "elements", halo=_halo())
+
+@pytest.fixture
+def nodes():
+    return op2.Set([nelems, nelems, nelems + 1, nelems + 2, nelems + 2], 1,
+                   "nodes", halo=_halo())
+
+@pytest.fixture
+def elem2node(elements, nodes):
+    return op2.Map(elements, nodes, 1, numpy.arange(nelems + 2), "elem2node")
+
+class TestDeepHalo:
+    """
+    Execution over layered execute halos.
+    """
+
+    def test_set_layers(self, backend, elements):
+        assert elements.layers == 2
+        assert elements.exec_size == nelems + 2
+        assert elements.sizes == (nelems, nelems, nelems + 2, nelems + 2)
+
+    def test_set_too_few_sizes(self, backend):
+        with pytest.raises(ValueError):
+            op2.Set([1, 2, 3], 1, "set")
+
+    def test_chain_shrinks_layers(self, backend, elements, nodes, elem2node):
+        kernel = op2.Kernel("void k(double *x, double *y) { *y += *x; }", "k")
+        x = op2.Dat(nodes, numpy.ones(nelems + 2), numpy.float64, "x")
+        y = op2.Dat(nodes, numpy.zeros(nelems + 2), numpy.float64, "y")
+        z = op2.Dat(nodes, numpy.zeros(nelems + 2), numpy.float64, "z")
+        x.needs_halo_update = True
+        first = op2.prepare_par_loop(kernel, elements,
+                                     x(elem2node[0], op2.READ), y(elem2node[0], op2.INC))
+        second = op2.prepare_par_loop(kernel, elements,
+                                      y(elem2node[0], op2.READ), z(elem2node[0], op2.INC))
+        first()
+        assert first._depth == 2
+        assert y._valid_depth() == 1
+        second()
+        assert second._depth == 1
+        assert z._valid_depth() == 0
+        assert all(z.data_ro[:nelems + 1] == 1)
+
+class TestBuild:
+    """
+    Building layered halos from maps.
+    """
+
+    def test_build_serial(self, backend):
+        values = numpy.array([(i, i + 1) for i in range(nelems)])
+        owner = numpy.zeros(nelems + 1) + op2.MPI.comm.rank
+        (iperm, isizes, ihalo), (dperm, dsizes, dhalo), new_values = \
+            halos.build(values, owner[:nelems], owner, numpy.arange(nelems),
+                        numpy.arange(nelems + 1), layers=2)
+        assert isizes == [nelems] * 5
+        assert dsizes == [nelems + 1] * 5
+        assert (new_values == values).all()
+        elements = op2.Set(isizes, 1, "elements", halo=ihalo)
+        nodes = op2.Set(dsizes, 1, "nodes", halo=dhalo)
+        assert elements.layers == nodes.layers == 2
+        offset = op2.MPI.comm.scan(nelems + 1) - (nelems + 1)
+        assert (dhalo.global_to_petsc_numbering ==
+                numpy.arange(nelems + 1) + offset).all()
+
+    def test_petsc_numbering(self, backend):
+        # Two ranks, each owning two entities and holding a copy of the
+        # first entity of the other
+        class Comm(object):
+            def __init__(self, rank):
+                self.rank = rank
+            def scan(self, size):
+                return size * (self.rank + 1)
+            def alltoall(self, sends):
+                return [numpy.array([2 - 2 * self.rank], dtype=numpy.int32)
+                        if r != self.rank else numpy.zeros(0, dtype=numpy.int32)
+                        for r in range(2)]
+        for rank in range(2):
+            sends = [[0] if r != rank else [] for r in range(2)]
+            receives = [[2] if r != rank else [] for r in range(2)]
+            numbering = halos._petsc_numbering(2, 3, sends, receives, Comm(rank))
+            assert list(numbering) == [2 * rank, 2 * rank + 1, 2 - 2 * rank]
+
+    def test_build_layers(self, backend):
+        # A chain of elements of which the last three are copies owned by
+        # another rank, in reverse order
+        values = numpy.array([(i, i + 1) for i in range(nelems)])
+        values[nelems - 3:] = values[nelems - 3:][::-1]
+        ilayer, dlayer = halos._layers(values, numpy.arange(nelems) < nelems - 3,
+                                       numpy.arange(nelems + 1) < nelems - 2, 2)
+        assert list(ilayer[nelems - 3:]) == [-1, 2, 1]
+        assert list(dlayer[nelems - 2:]) == [1, 2, -1]
+        perm, sizes = halos._order(ilayer, ilayer == 0, 2)
+        assert sizes == [nelems - 3, nelems - 3, nelems - 2, nelems - 1, nelems]
+        assert list(perm[nelems - 3:]) == [nelems - 1, nelems - 2, nelems - 3]
@@ -144,6 +144,65 @@ class TestIndirectLoop:
         expected = numpy.asarray(range(1, nedges * 2 + 1, 2)).reshape(nedges, 1)
         assert all(expected == edge_vals.data)
 
+class TestHaloRegions:
+    """
+    Region-aware halo dirtiness tests
+    """
+
+    skip_backends = ['opencl', 'cuda', 'openmp']
+
+    @pytest.fixture
+    def nodes(cls):
+        halo = op2.Halo([[]] * op2.MPI.comm.size, [[]] * op2.MPI.comm.size)
+        return op2.Set((nelems, nelems, nelems + 2, nelems + 4), 1, "nodes", halo=halo)
+
+    def test_read_owned_only_no_exchange(self, backend, iterset, nodes):
+        x = op2.Dat(nodes, numpy.ones(nelems + 4), numpy.uint32, "x")
+        g = op2.Global(1, 0, numpy.uint32, "g")
+        iter2nodes = op2.Map(iterset, nodes, 1, numpy.arange(nelems), "iter2nodes")
+        x.needs_halo_update = True
+        op2.par_loop(op2.Kernel("void k(unsigned int *x, unsigned int *g) { *g += *x; }", "k"),
+                     iterset, x(iter2nodes[0], op2.READ), g(op2.INC))
+        assert g.data[0] == nelems
+        assert x.needs_halo_update
+
+    def test_exchange_read_regions_only(self, backend, iterset, nodes):
+        x = op2.Dat(nodes, numpy.ones(nelems + 4), numpy.uint32, "x")
+        g = op2.Global(1, 0, numpy.uint32, "g")
+        iter2nodes = op2.Map(iterset, nodes, 1, numpy.arange(nelems) % (nelems + 2),
+                             "iter2nodes")
+        values = iter2nodes.values.copy()
+        values[0] = nelems + 1
+        iter2nodes.values = values
+        x.needs_halo_update = True
+        op2.par_loop(op2.Kernel("void k(unsigned int *x, unsigned int *g) { *g += *x; }", "k"),
+                     iterset, x(iter2nodes[0], op2.READ), g(op2.INC))
+        assert g.data[0] == nelems
+        assert x._stale_halo_regions() == (op2.Set.IMPORT_NON_EXEC_SIZE,)
+
+    def test_two_args_different_regions(self, backend, iterset, nodes):
+        x = op2.Dat(nodes, numpy.ones(nelems + 4), numpy.uint32, "x")
+        g = op2.Global(1, 0, numpy.uint32, "g")
+        values = numpy.arange(nelems)
+        values[0] = nelems + 1
+        to_exec = op2.Map(iterset, nodes, 1, values, "to_exec")
+        values[0] = nelems + 3
+        to_non_exec = op2.Map(iterset, nodes, 1, values, "to_non_exec")
+        x.needs_halo_update = True
+        k = "void k(unsigned int *a, unsigned int *b, unsigned int *g) { *g += *a + *b; }"
+        op2.par_loop(op2.Kernel(k, "k"), iterset, x(to_exec[0], op2.READ),
+                     x(to_non_exec[0], op2.READ), g(op2.INC))
+        assert g.data[0] == 2 * nelems
+        assert not x.needs_halo_update
+
+    def test_core_write_keeps_halo(self, backend, iterset, nodes):
+        x = op2.Dat(nodes, numpy.zeros(nelems + 4), numpy.uint32, "x")
+        iter2nodes = op2.Map(iterset, nodes, 1, numpy.zeros(nelems), "iter2nodes")
+        op2.par_loop(op2.Kernel("void k(unsigned int *x) { *x += 1; }", "k"),
+                     iterset, x(iter2nodes[0], op2.INC))
+        assert not x.needs_halo_update
+        assert x.data_ro[0] == nelems
+
 if __name__ == '__main__':
     import os
     pytest.main(os.path.abspath(__file__))
@@ -0,0 +1,277 @@
+# This file is part of PyOP2
+#
+# PyOP2 is Copyright (c) 2012, Imperial College London and
+# others. Please see the AUTHORS file in the main source directory for
+# a full list of copyright holders.  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * The name of Imperial College London or that of other
+#       contributors may not be used to endorse or promote products
+#       derived from this software without specific prior written
+#       permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTERS
+# ''AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Lazy evaluation unit tests.
+"""
+
+import pytest
+import numpy
+
+from pyop2 import op2
+from pyop2 import base
+
+backends = ['sequential', 'openmp']
+
+nelems = 42
+
+@pytest.fixture
+def lazy(request, backend):
+    op2.init(lazy_evaluation=True)
+    def fin():
+        base._trace.evaluate_all()
+        op2.init(lazy_evaluation=False)
+    request.addfinalizer(fin)
+
+@pytest.fixture
+def iterset():
+    return op2.Set(nelems, 1, "iterset")
+
+class TestLaziness:
+    """
+    Lazy evaluation tests.
+    """
+
+    def test_stable(self, backend, lazy, iterset):
+        a = op2.Global(1, 0, numpy.uint32, "a")
+
+        kernel = """
+void
+count(unsigned int* x)
+{
+  (*x) += 1;
+}
+"""
+        op2.par_loop(op2.Kernel(kernel, "count"), iterset, a(op2.INC))
+
+        assert len(base._trace) == 1
+        assert a.data[0] == nelems
+        assert len(base._trace) == 0
+        assert a.data[0] == nelems
+
+    def test_reorder(self, backend, lazy, iterset):
+        a = op2.Global(1, 0, numpy.uint32, "a")
+        b = op2.Global(1, 0, numpy.uint32, "b")
+
+        kernel = """
+void
+count(unsigned int* x)
+{
+  (*x) += 1;
+}
+"""
+        op2.par_loop(op2.Kernel(kernel, "count"), iterset, a(op2.INC))
+        op2.par_loop(op2.Kernel(kernel, "count"), iterset, b(op2.INC))
+
+        assert len(base._trace) == 2
+        assert b.data[0] == nelems
+        assert len(base._trace) == 1
+        assert a.data[0] == nelems
+        assert len(base._trace) == 0
+
+    def test_chain(self, backend, lazy, iterset):
+        a = op2.Global(1, 0, numpy.uint32, "a")
+        x = op2.Dat(iterset, numpy.zeros(nelems), numpy.uint32, "x")
+        y = op2.Dat(iterset, numpy.zeros(nelems), numpy.uint32, "y")
+
+        kernel_add_one = """
+void
+add_one(unsigned int* x)
+{
+  (*x) += 1;
+}
+"""
+        kernel_copy = """
+void
+copy(unsigned int* dst, unsigned int* src)
+{
+  (*dst) = (*src);
+}
+"""
+        kernel_sum = """
+void
+sum(unsigned int* sum, unsigned int* x)
+{
+  (*sum) += (*x);
+}
+"""
+
+        op2.par_loop(op2.Kernel(kernel_add_one, "add_one"), iterset,
+                     x(op2.IdentityMap, op2.RW))
+        op2.par_loop(op2.Kernel(kernel_copy, "copy"), iterset,
+                     y(op2.IdentityMap, op2.WRITE), x(op2.IdentityMap, op2.READ))
+        op2.par_loop(op2.Kernel(kernel_add_one, "add_one"), iterset,
+                     x(op2.IdentityMap, op2.RW))
+        op2.par_loop(op2.Kernel(kernel_sum, "sum"), iterset,
+                     a(op2.INC), x(op2.IdentityMap, op2.READ))
+
+        assert len(base._trace) == 4
+        # Reading y only requires the first two loops
+        assert sum(y.data_ro) == nelems
+        assert len(base._trace) == 2
+        assert a.data[0] == 2 * nelems
+        assert len(base._trace) == 0
+
+    def test_write_after_read(self, backend, lazy, iterset):
+        a = op2.Global(1, 0, numpy.uint32, "a")
+        x = op2.Dat(iterset, numpy.ones(nelems), numpy.uint32, "x")
+
+        kernel_sum = """
+void
+sum(unsigned int* sum, unsigned int* x)
+{
+  (*sum) += (*x);
+}
+"""
+        op2.par_loop(op2.Kernel(kernel_sum, "sum"), iterset,
+                     a(op2.INC), x(op2.IdentityMap, op2.READ))
+
+        # Writing x has to run the pending loop reading it first
+        x.data[:] = 2
+        assert len(base._trace) == 0
+        assert a.data[0] == nelems
+
+class TestLoopFusion:
+    """
+    Loop fusion tests.
+    """
+
+    @pytest.fixture
+    def fusion(cls, request, backend):
+        op2.init(lazy_evaluation=True, loop_fusion=True)
+        def fin():
+            base._trace.evaluate_all()
+            op2.init(lazy_evaluation=False, loop_fusion=False)
+        request.addfinalizer(fin)
+
+    def test_fuse_direct_loops(self, backend, fusion, iterset):
+        x = op2.Dat(iterset, numpy.arange(nelems), numpy.uint32, "x")
+        y = op2.Dat(iterset, numpy.zeros(nelems), numpy.uint32, "y")
+        g = op2.Global(1, 0, numpy.uint32, "g")
+
+        kernel_save = "void save(unsigned int* y, unsigned int* x) { *y = *x; }"
+        kernel_double = "void twice(unsigned int* x) { *x *= 2; }"
+        kernel_sum = "void sum(unsigned int* g, unsigned int* y) { *g += *y; }"
+
+        op2.par_loop(op2.Kernel(kernel_save, "save"), iterset,
+                     y(op2.IdentityMap, op2.WRITE), x(op2.IdentityMap, op2.READ))
+        op2.par_loop(op2.Kernel(kernel_double, "twice"), iterset,
+                     x(op2.IdentityMap, op2.RW))
+        op2.par_loop(op2.Kernel(kernel_sum, "sum"), iterset,
+                     g(op2.INC), y(op2.IdentityMap, op2.READ))
+
+        assert len(base._trace) == 3
+        assert g.data[0] == sum(range(nelems))
+        assert all(x.data_ro == 2 * numpy.arange(nelems))
+        assert all(y.data_ro == numpy.arange(nelems))
+        assert any(k.name == 'fused_save_twice_sum' for k in base.Kernel._cache.values())
+
+    def test_no_fusion_of_reduced_global(self, backend, fusion, iterset):
+        x = op2.Dat(iterset, numpy.zeros(nelems), numpy.uint32, "x")
+        g = op2.Global(1, 0, numpy.uint32, "g")
+
+        kernel_count = "void count(unsigned int* g) { *g += 1; }"
+        kernel_set = "void setg(unsigned int* x, unsigned int* g) { *x = *g; }"
+
+        op2.par_loop(op2.Kernel(kernel_count, "count"), iterset, g(op2.INC))
+        op2.par_loop(op2.Kernel(kernel_set, "setg"), iterset,
+                     x(op2.IdentityMap, op2.WRITE), g(op2.READ))
+
+        assert all(x.data_ro == nelems)
+
+class TestHaloExchangeAggregate:
+    """
+    Aggregated halo exchange tests.
+    """
+
+    @pytest.fixture
+    def aggregate(cls, request, backend):
+        op2.init(lazy_evaluation=True, halo_exchange_aggregate=True)
+        def fin():
+            base._trace.evaluate_all()
+            op2.init(lazy_evaluation=False, halo_exchange_aggregate=False)
+        request.addfinalizer(fin)
+
+    def test_aggregated_indirect_loops(self, backend, aggregate, iterset):
+        halo = op2.Halo([[]] * op2.MPI.comm.size, [[]] * op2.MPI.comm.size)
+        nodes = op2.Set(nelems, 1, "nodes", halo=halo)
+        iter2nodes = op2.Map(iterset, nodes, 1, numpy.arange(nelems), "iter2nodes")
+        x = op2.Dat(nodes, numpy.ones(nelems), numpy.uint32, "x")
+        x.needs_halo_update = True
+        g = op2.Global(1, 0, numpy.uint32, "g")
+        h = op2.Global(1, 0, numpy.uint32, "h")
+
+        kernel_sum = "void sum(unsigned int* g, unsigned int* x) { *g += *x; }"
+        kernel_double = "void twice(unsigned int* x) { *x *= 2; }"
+
+        op2.par_loop(op2.Kernel(kernel_sum, "sum"), iterset,
+                     g(op2.INC), x(iter2nodes[0], op2.READ))
+        op2.par_loop(op2.Kernel(kernel_double, "twice"), iterset,
+                     x(iter2nodes[0], op2.RW))
+        op2.par_loop(op2.Kernel(kernel_sum, "sum"), iterset,
+                     h(op2.INC), x(iter2nodes[0], op2.READ))
+
+        assert len(base._trace) == 3
+        assert g.data[0] == nelems
+        assert h.data[0] == 2 * nelems
+
+    def test_packed_round_trip(self, backend):
+        s1 = op2.Set(nelems, 1, "s1")
+        s2 = op2.Set(nelems, 2, "s2")
+        x = op2.Dat(s1, numpy.arange(nelems), numpy.uint32, "x")
+        y = op2.Dat(s2, numpy.arange(2 * nelems), numpy.float64, "y")
+        ex = numpy.array([5, 1, 7], dtype=numpy.int32)
+        ey = numpy.array([3, 0], dtype=numpy.int32)
+        buf, segments = base._HaloExchange._packed([x, y], [ex, ey])
+        # 3 uint32 values padded to 16 bytes, then 2 pairs of float64
+        assert buf.nbytes == 16 + 32
+        offsets = [view.ctypes.data - buf.ctypes.data for _, _, view in segments]
+        assert offsets == [0, 16]
+        assert segments[1][2].shape == (2, 2)
+        for dat, ele, view in segments:
+            numpy.take(dat()._data, ele, axis=0, out=view)
+
+        x2 = op2.Dat(s1, numpy.zeros(nelems), numpy.uint32, "x2")
+        y2 = op2.Dat(s2, numpy.zeros(2 * nelems), numpy.float64, "y2")
+        _, received = base._HaloExchange._packed([x2, y2], [ex, ey])
+        for (_, _, view), (dat, ele, recv) in zip(segments, received):
+            recv[:] = view
+            dat()._data[ele] = recv
+        assert (x2.data_ro[ex] == x.data_ro[ex]).all()
+        assert (y2.data_ro[ey] == y.data_ro[ey]).all()
+        assert (x2.data_ro[[0, 2]] == 0).all()
+
+if __name__ == '__main__':
+    import os
+    pytest.main(os.path.abspath(__file__))
@@ -36,7 +36,7 @@ import numpy
 from numpy.testing import assert_allclose
 
 from pyop2 import op2
-from pyop2.exceptions import MapValueError
+from pyop2.exceptions import MapValueError, ModeValueError
 
 # Data type
 valuetype = numpy.float64
@@ -61,6 +61,19 @@ class TestSparsity:
         assert all(sparsity._colidx == [ 0, 1, 3, 4, 0, 1, 2, 4, 1, 2, \
                                          3, 4, 0, 2, 3, 4, 0, 1, 2, 3, 4 ])
 
+    def test_build_sparsity_matches_reference(self, backend):
+        from pyop2 import op_lib_core as core
+        elements = op2.Set(200)
+        nodes = op2.Set(60, 2)
+        numpy.random.seed(0)
+        m1 = op2.Map(elements, nodes, 3, numpy.random.randint(0, 60, 600))
+        m2 = op2.Map(elements, nodes, 2, numpy.random.randint(0, 60, 400))
+        sparsity = op2.Sparsity([(m1, m2), (m2, m1)])
+        nnz, onnz, rowptr, colidx = core.build_sparsity_reference(sparsity, False)
+        assert (sparsity.nnz == nnz).all()
+        assert (sparsity.rowptr == rowptr).all()
+        assert (sparsity.colidx == colidx).all()
+
     def test_sparsity_null_maps(self, backend):
         s=op2.Set(5)
         with pytest.raises(MapValueError):
@@ -649,6 +662,158 @@ void zero_mat(double local_mat[1][1], int i, int j)
         eps = 1.e-8
         assert_allclose(x.data, f.data, eps)
 
+    def test_solve_nonzero_initial_guess(self, backend, mat, b, x, f, skip_cuda):
+        """Test a solve starting from the solution needs no iterations."""
+        solver = op2.Solver(nonzero_initial_guess=True)
+        x.data[:] = f.data_ro
+        solver.solve(mat, x, b)
+        assert solver.getIterationNumber() == 0
+        assert_allclose(x.data, f.data, 1.e-8)
+
+    def test_solver_parameters_reapplied(self, backend, mat, b, x, f, skip_cuda):
+        """Test parameters changed between solves with the same solver are
+        applied."""
+        solver = op2.Solver(linear_solver='cg')
+        solver.solve(mat, x, b)
+        assert solver.getType() == 'cg'
+        solver.update_parameters({'linear_solver': 'gmres'})
+        x.zero()
+        solver.solve(mat, x, b)
+        assert solver.getType() == 'gmres'
+        assert_allclose(x.data, f.data, 1.e-8)
+
+    def test_assemble_solve_lma(self, backend, mass, coords, elements, elem_node,
+                                elem_vnode, expected_matrix, b, x, f,
+                                skip_cuda, skip_opencl):
+        """Test a matrix in LMA format assembles the same values as an
+        assembled matrix and solves to the same solution."""
+        sparsity = op2.Sparsity((elem_node, elem_node), "sparsity")
+        lma = op2.Mat(sparsity, valuetype, "lma", format='lma')
+        op2.par_loop(mass, elements(3,3),
+                     lma((elem_node[op2.i[0]], elem_node[op2.i[1]]), op2.INC),
+                     coords(elem_vnode, op2.READ))
+        assert_allclose(lma.values, expected_matrix, 1.e-5)
+        op2.solve(lma, x, b)
+        assert_allclose(x.data, f.data, 1.e-8)
+
+    def test_lma_rejects_write(self, backend, elem_node, skip_cuda, skip_opencl):
+        sparsity = op2.Sparsity((elem_node, elem_node), "sparsity")
+        lma = op2.Mat(sparsity, valuetype, "lma", format='lma')
+        with pytest.raises(ModeValueError):
+            lma((elem_node[op2.i[0]], elem_node[op2.i[1]]), op2.WRITE)
+
+    def test_reassemble_unchanged_skipped(self, backend, mass, coords, elements,
+                                          elem_node, elem_vnode, expected_matrix,
+                                          skip_cuda, skip_opencl):
+        """Test assembling into a zeroed matrix again with unchanged inputs is
+        skipped and reassembles once the inputs have changed."""
+        sparsity = op2.Sparsity((elem_node, elem_node), "sparsity")
+        mat = op2.Mat(sparsity, valuetype, "mat")
+        def assemble():
+            mat.zero()
+            op2.par_loop(mass, elements(3,3),
+                         mat((elem_node[op2.i[0]], elem_node[op2.i[1]]), op2.INC),
+                         coords(elem_vnode, op2.READ))
+        assemble()
+        version = mat.version
+        assemble()
+        assert mat.version == version
+        assert_allclose(mat.values, expected_matrix, 1.e-5)
+        # Doubling the coordinates quadruples the element areas
+        coords.data[:] *= 2
+        assemble()
+        assert mat.version > version
+        assert_allclose(mat.values, 4 * expected_matrix, 1.e-5)
+
+    def test_reassemble_skipped_with_const(self, backend, request, mass, coords,
+                                           elements, elem_node, elem_vnode,
+                                           skip_cuda, skip_opencl):
+        """Test a defined Const read by every loop does not prevent skipping
+        an unchanged reassembly."""
+        c = op2.Const(1, 1.0, "reassembly_const", dtype=valuetype)
+        request.addfinalizer(c.remove_from_namespace)
+        sparsity = op2.Sparsity((elem_node, elem_node), "sparsity")
+        mat = op2.Mat(sparsity, valuetype, "mat")
+        def assemble():
+            mat.zero()
+            op2.par_loop(mass, elements(3,3),
+                         mat((elem_node[op2.i[0]], elem_node[op2.i[1]]), op2.INC),
+                         coords(elem_vnode, op2.READ))
+        assemble()
+        version = mat.version
+        assemble()
+        assert mat.version == version
+
+    def test_reassemble_after_inplace_op(self, backend, mass, coords, elements,
+                                         elem_node, elem_vnode, expected_matrix,
+                                         skip_cuda, skip_opencl):
+        """Test modifying the input of an assembly with an in-place operator
+        causes the assembly to be carried out again."""
+        sparsity = op2.Sparsity((elem_node, elem_node), "sparsity")
+        mat = op2.Mat(sparsity, valuetype, "mat")
+        def assemble():
+            mat.zero()
+            op2.par_loop(mass, elements(3,3),
+                         mat((elem_node[op2.i[0]], elem_node[op2.i[1]]), op2.INC),
+                         coords(elem_vnode, op2.READ))
+        assemble()
+        coords += coords
+        assemble()
+        assert_allclose(mat.values, 4 * expected_matrix, 1.e-5)
+
+    def test_solver_sees_reassembly(self, backend, mass, coords, elements,
+                                    elem_node, elem_vnode, nodes, skip_cuda):
+        """Test solving again with the same solver after reassembling the
+        matrix with different values uses the new values, also with a direct
+        solve relying on the factorisation being recomputed."""
+        sparsity = op2.Sparsity((elem_node, elem_node), "sparsity")
+        mat = op2.Mat(sparsity, valuetype, "mat")
+        def assemble():
+            mat.zero()
+            op2.par_loop(mass, elements(3,3),
+                         mat((elem_node[op2.i[0]], elem_node[op2.i[1]]), op2.INC),
+                         coords(elem_vnode, op2.READ))
+        assemble()
+        rhs = op2.Dat(nodes, numpy.dot(mat.values, numpy.ones(NUM_NODES)),
+                      valuetype, "rhs")
+        sol = op2.Dat(nodes, numpy.zeros(NUM_NODES), valuetype, "sol")
+        solver = op2.Solver(linear_solver='preonly', preconditioner='lu')
+        solver.solve(mat, sol, rhs)
+        assert_allclose(sol.data, numpy.ones(NUM_NODES), 1.e-8)
+        # Doubling the coordinates quadruples the matrix
+        coords.data[:] *= 2
+        assemble()
+        sol.zero()
+        solver.solve(mat, sol, rhs)
+        assert_allclose(sol.data, 0.25 * numpy.ones(NUM_NODES), 1.e-8)
+
+    def test_solver_reuses_skipped_reassembly(self, backend, mass, coords,
+                                              elements, elem_node, elem_vnode,
+                                              nodes, skip_cuda, skip_opencl):
+        """Test a reassembly skipped since its inputs are unchanged keeps the
+        operator and preconditioner the solver was set up with."""
+        sparsity = op2.Sparsity((elem_node, elem_node), "sparsity")
+        mat = op2.Mat(sparsity, valuetype, "mat")
+        def assemble():
+            mat.zero()
+            op2.par_loop(mass, elements(3,3),
+                         mat((elem_node[op2.i[0]], elem_node[op2.i[1]]), op2.INC),
+                         coords(elem_vnode, op2.READ))
+        assemble()
+        rhs = op2.Dat(nodes, numpy.dot(mat.values, numpy.ones(NUM_NODES)),
+                      valuetype, "rhs")
+        sol = op2.Dat(nodes, numpy.zeros(NUM_NODES), valuetype, "sol")
+        solver = op2.Solver()
+        solver.solve(mat, sol, rhs)
+        operator = solver._operator
+        version = mat.version
+        assemble()
+        assert mat.version == version
+        sol.zero()
+        solver.solve(mat, sol, rhs)
+        assert solver._operator is operator
+        assert_allclose(sol.data, numpy.ones(NUM_NODES), 1.e-8)
+
     def test_zero_matrix(self, backend, mat):
         """Test that the matrix is zeroed correctly."""
         mat.zero()
@@ -690,6 +855,26 @@ void zero_mat(double local_mat[1][1], int i, int j)
         assert_allclose(vecmat.array, numpy.ones_like(vecmat.array))
         vecmat.zero()
 
+    def test_vector_matrix_is_blocked(self, backend, vecmat, vnodes,
+                                      skip_cuda, skip_opencl):
+        """Test a vector matrix is a blocked matrix with a sparsity holding
+        one entry per block, whose values are a read-only copy."""
+        assert vecmat.sparsity.block_sparse
+        assert len(vecmat.sparsity.rowptr) == vnodes.size + 1
+        assert vecmat.handle.getBlockSize() == 2
+        assert not vecmat.array.flags.writeable
+
+    def test_element_offsets(self, backend, mat, elements, elem_node,
+                             skip_cuda, skip_opencl):
+        """Test the offsets of the entries each element assembles into point
+        at the rows and columns given by the maps."""
+        sparsity = mat.sparsity
+        offsets = sparsity._element_offsets(elem_node, elem_node)[..., 0, 0]
+        rows = numpy.searchsorted(sparsity.rowptr, offsets, side='right') - 1
+        assert offsets.shape == (elements.size, 3, 3)
+        assert (rows == elem_node.values[:, :, None]).all()
+        assert (sparsity.colidx[offsets] == elem_node.values[:, None, :]).all()
+
     def test_zero_rhs(self, backend, b, zero_dat, nodes):
         """Test that the RHS is zeroed correctly."""
         op2.par_loop(zero_dat, nodes,
@@ -789,6 +974,58 @@ void zero_mat(double local_mat[1][1], int i, int j)
         eps=1.e-14
         assert_allclose(vecmat.values, expected_matrix, eps)
 
+class TestMatrixFree:
+    """
+    Matrix-free operator tests
+    """
+
+    backends = ['sequential', 'openmp']
+
+    @pytest.fixture
+    def nodes(cls):
+        return op2.Set(10, 1, "nodes")
+
+    @pytest.fixture
+    def edges(cls):
+        return op2.Set(9, 1, "edges")
+
+    @pytest.fixture
+    def edge_node(cls, edges, nodes):
+        return op2.Map(edges, nodes, 2,
+                       numpy.array([(i, i+1) for i in range(9)], dtype=numpy.uint32),
+                       "edge_node")
+
+    @pytest.fixture
+    def operator(cls, nodes, edges, edge_node):
+        """Operator assembled from the element matrix [[2, -1], [-1, 2]]."""
+        action = """
+void action(double *x[1], double *y[1]) {
+  y[0][0] += 2*x[0][0] - x[1][0];
+  y[1][0] += -x[0][0] + 2*x[1][0];
+}"""
+        u = op2.Dat(nodes, numpy.zeros(nodes.size), valuetype, "u")
+        v = op2.Dat(nodes, numpy.zeros(nodes.size), valuetype, "v")
+        return op2.MatrixFree(op2.Kernel(action, "action"), edges,
+                              u(edge_node, op2.READ), v(edge_node, op2.INC))
+
+    def test_matrix_free_solve(self, backend, nodes, operator):
+        """Test solving with a matrix-free operator gives the same solution as
+        the assembled matrix."""
+        A = 4 * numpy.eye(nodes.size) - numpy.eye(nodes.size, k=1) \
+            - numpy.eye(nodes.size, k=-1)
+        A[0, 0] = A[-1, -1] = 2
+        expected = numpy.arange(nodes.size, dtype=valuetype)
+        b = op2.Dat(nodes, A.dot(expected), valuetype, "b")
+        x = op2.Dat(nodes, numpy.zeros(nodes.size), valuetype, "x")
+        op2.Solver(linear_solver='cg', relative_tolerance=1e-12).solve(operator, x, b)
+        assert_allclose(x.data, expected, atol=1e-8)
+
+    def test_matrix_free_result_must_inc(self, backend, nodes, edges, edge_node):
+        u = op2.Dat(nodes, numpy.zeros(nodes.size), valuetype, "u")
+        k = op2.Kernel("void k(double *x[1], double *y[1]) {}", "k")
+        with pytest.raises(ModeValueError):
+            op2.MatrixFree(k, edges, u(edge_node, op2.READ), u(edge_node, op2.WRITE))
+
 if __name__ == '__main__':
     import os
     pytest.main(os.path.abspath(__file__))
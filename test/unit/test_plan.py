@@ -47,6 +47,61 @@ def _seed():
 # thread per element in device backends
 nelems = 4096
 
+def reference_staging(iset, ps, *args):
+    """Python construction of the plan staging information, which the
+    Cython plan has to reproduce exactly."""
+    from collections import OrderedDict
+    from pyop2.utils import align
+
+    nblocks = (iset.size + ps - 1) / ps
+    nelems = [min(ps, iset.size - i * ps) for i in range(nblocks)]
+
+    def indices(dat, map):
+        return [arg.idx for arg in args if arg.data == dat and arg.map == map]
+
+    d = OrderedDict()
+    for arg in args:
+        if not arg._is_mat and arg._is_indirect:
+            d.setdefault((arg.data, arg.map), None)
+
+    inds, locs, sizes = {}, {}, {}
+    for pi in range(nblocks):
+        start = pi * ps
+        end = start + nelems[pi]
+        for dat, map in d:
+            ii = indices(dat, map)
+            l = len(ii)
+            inds[(dat, map, pi)], inv = numpy.unique(map.values[start:end, ii], return_inverse=True)
+            sizes[(dat, map, pi)] = len(inds[(dat, map, pi)])
+            for i, ind in enumerate(sorted(ii)):
+                locs[(dat, map, ind, pi)] = inv[i::l]
+
+    ind_map = []
+    for dat, map in d:
+        n = 0
+        for pi in range(nblocks):
+            n += len(inds[(dat, map, pi)])
+            ind_map.append(inds[(dat, map, pi)])
+        ind_map.append(-numpy.ones(len(indices(dat, map)) * iset.size - n, dtype=numpy.int32))
+
+    offs = dict((k, 0) for k in d)
+    ind_offs = []
+    for pi in range(nblocks):
+        for k in d:
+            ind_offs.append(offs[k])
+            offs[k] += sizes[k + (pi,)]
+
+    return {'ind_map': numpy.concatenate(ind_map) if ind_map else numpy.array([], dtype=numpy.int32),
+            'loc_map': numpy.concatenate([locs[(dat, map, i, pi)].astype(numpy.int16)
+                                          for dat, map in d for i in indices(dat, map)
+                                          for pi in range(nblocks)]),
+            'ind_sizes': numpy.array([sizes[k + (pi,)] for pi in range(nblocks) for k in d]),
+            'ind_offs': numpy.array(ind_offs),
+            'nindirect': numpy.array([sum(sizes[k + (pi,)] for pi in range(nblocks)) for k in d]),
+            'offset': numpy.cumsum([0] + nelems[:-1]),
+            'nshared': max(sum(align(sizes[(dat, map, pi)] * dat.dtype.itemsize * dat.cdim)
+                               for dat, map in d) for pi in range(nblocks))}
+
 class TestPlan:
     """
     Plan Construction Tests
@@ -141,6 +196,46 @@ class TestPlan:
                              matrix_coloring=False,
                              partition_size=2)
 
+    def test_staging_matches_reference(self, backend, iterset, indset, x):
+        e_map = numpy.array(range(nelems) * 3, dtype=numpy.uint32)
+        random.shuffle(e_map, _seed)
+        iter2ind = op2.Map(iterset, indset, 3, e_map, "iter2ind")
+        y = op2.Dat(indset, numpy.zeros(nelems), numpy.float64, "y")
+        args = (x(iter2ind[2], op2.INC),
+                x(iter2ind[0], op2.INC),
+                y(iter2ind[1], op2.READ),
+                y(iter2ind[0], op2.READ))
+        kernel = op2.Kernel("", "dummy")
+        plan = device.Plan(kernel, iterset, *args, partition_size=96,
+                           refresh_cache=True)
+        ref = reference_staging(iterset, 96, *args)
+        for k in ['ind_map', 'loc_map', 'ind_sizes', 'ind_offs', 'nindirect', 'offset']:
+            assert (getattr(plan, k) == ref[k]).all()
+        assert plan.loc_map.dtype == ref['loc_map'].dtype
+        assert plan.nshared == ref['nshared']
+
+    def test_compact_plan(self, backend, iterset, indset, x, iterset2indset):
+        kernel = op2.Kernel("", "dummy")
+        args = (x(iterset2indset[0], op2.INC),)
+        plan = device.Plan(kernel, iterset, *args, partition_size=128,
+                           refresh_cache=True)
+        compact = device.Plan(kernel, iterset, *args, partition_size=128,
+                              compact=True, refresh_cache=True)
+        assert (compact.ind_map == plan.ind_map[:plan.nindirect[0]]).all()
+        assert (compact.thrcol == plan.thrcol).all()
+        assert compact.thrcol.itemsize == 1
+        assert compact.nbytes < plan.nbytes
+
+    def test_no_thread_coloring_no_thrcol(self, backend, iterset, indset, x, iterset2indset):
+        kernel = op2.Kernel("", "dummy")
+        plan = device.Plan(kernel, iterset, x(iterset2indset[0], op2.INC),
+                           partition_size=128, staging=False,
+                           thread_coloring=False, compact=True,
+                           refresh_cache=True)
+        assert plan.thrcol is None
+        assert plan.memory_usage()['thrcol'] == 0
+        assert plan.nbytes == sum(a.nbytes for a in (plan.nelems, plan.blkmap, plan.ncolblk))
+
 
 if __name__ == '__main__':
     import os
@@ -0,0 +1,141 @@
+# This file is part of PyOP2
+#
+# PyOP2 is Copyright (c) 2012, Imperial College London and
+# others. Please see the AUTHORS file in the main source directory for
+# a full list of copyright holders.  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * The name of Imperial College London or that of other
+#       contributors may not be used to endorse or promote products
+#       derived from this software without specific prior written
+#       permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTERS
+# ''AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Mesh renumbering unit tests.
+"""
+
+import pytest
+import numpy
+import random
+
+from pyop2 import op2
+from pyop2 import renumbering
+from pyop2 import exceptions
+
+backends = ['sequential', 'openmp']
+
+def _seed():
+    return 0.02041724
+
+nnodes = 32
+
+@pytest.fixture
+def nodes():
+    return op2.Set(nnodes, 1, "nodes")
+
+@pytest.fixture
+def vnodes():
+    return op2.Set(nnodes, 2, "vnodes")
+
+@pytest.fixture
+def edges():
+    return op2.Set(nnodes - 1, 1, "edges")
+
+@pytest.fixture
+def numbering():
+    # A random numbering of the nodes of a chain
+    n = range(nnodes)
+    random.shuffle(n, _seed)
+    return numpy.array(n, dtype=numpy.int32)
+
+@pytest.fixture
+def edge2node(edges, nodes, numbering):
+    values = numpy.array([(numbering[i], numbering[i+1]) for i in range(nnodes - 1)])
+    return op2.Map(edges, nodes, 2, values, "edge2node")
+
+@pytest.fixture
+def edge2vnode(edges, vnodes, edge2node):
+    return op2.Map(edges, vnodes, 2, edge2node.values.copy(), "edge2vnode")
+
+@pytest.fixture
+def coords(vnodes, numbering):
+    values = numpy.zeros((nnodes, 2))
+    values[numbering, 0] = numpy.arange(nnodes)
+    return op2.Dat(vnodes, values, numpy.float64, "coords")
+
+def bandwidth(map):
+    return abs(map.values[:, 0] - map.values[:, 1]).max()
+
+class TestRenumbering:
+    """
+    Renumbering tests.
+    """
+
+    def test_rcm_reduces_bandwidth(self, backend, edge2node):
+        assert bandwidth(edge2node) > 1
+        perm = renumbering.rcm(edge2node)
+        renumbering.renumber(perm, edge2node.dataset, maps=edge2node)
+        assert bandwidth(edge2node) == 1
+
+    def test_morton_sorts_chain(self, backend, coords):
+        perm = renumbering.morton(coords)
+        renumbering.renumber(perm, coords.dataset, dats=coords)
+        assert (numpy.diff(coords.data_ro[:, 0]) > 0).all()
+
+    def test_renumber_consistent(self, backend, nodes, vnodes, edges,
+                                 edge2node, edge2vnode, coords):
+        before = coords.data_ro[edge2vnode.values][:, :, 0].copy()
+        perm = renumbering.rcm(edge2node)
+        renumbering.renumber(perm, (nodes, vnodes), maps=(edge2node, edge2vnode),
+                             dats=coords)
+        assert (coords.data_ro[edge2vnode.values][:, :, 0] == before).all()
+        assert (edge2node.values == edge2vnode.values).all()
+
+        eperm = renumbering.iterset_order(edge2node)
+        renumbering.renumber(eperm, edges, maps=(edge2node, edge2vnode))
+        assert (coords.data_ro[edge2vnode.values][:, :, 0] == before[eperm]).all()
+        assert (numpy.diff(edge2node.values.min(axis=1)) >= 0).all()
+
+    def test_par_loop_after_renumbering(self, backend, nodes, edges, edge2node):
+        x = op2.Dat(nodes, numpy.zeros(nnodes), numpy.float64, "x")
+        kernel = "void count(double** x) { *x[0] += 1.0; *x[1] += 1.0; }"
+        renumbering.renumber(renumbering.rcm(edge2node), nodes, maps=edge2node)
+        op2.par_loop(op2.Kernel(kernel, "count"), edges, x(edge2node, op2.INC))
+        # The two ends of the chain are at the ends of the numbering
+        assert x.data_ro[0] == 1.0 and x.data_ro[-1] == 1.0
+        assert (x.data_ro[1:-1] == 2.0).all()
+
+    def test_not_a_permutation(self, backend, nodes):
+        with pytest.raises(ValueError):
+            renumbering.renumber(numpy.zeros(nnodes), nodes)
+
+    def test_map_not_on_sets(self, backend, nodes, edges):
+        m = op2.Map(edges, edges, 1, range(nnodes - 1), "self")
+        with pytest.raises(exceptions.MapValueError):
+            renumbering.renumber(numpy.arange(nnodes), nodes, maps=m)
+
+if __name__ == '__main__':
+    import os
+    pytest.main(os.path.abspath(__file__))
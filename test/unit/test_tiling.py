@@ -0,0 +1,155 @@
+# This file is part of PyOP2
+#
+# PyOP2 is Copyright (c) 2012, Imperial College London and
+# others. Please see the AUTHORS file in the main source directory for
+# a full list of copyright holders.  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * The name of Imperial College London or that of other
+#       contributors may not be used to endorse or promote products
+#       derived from this software without specific prior written
+#       permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTERS
+# ''AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Sparse tiling unit tests.
+"""
+
+import pytest
+import numpy
+import random
+
+from pyop2 import op2
+
+backends = ['sequential', 'openmp']
+
+def _seed():
+    return 0.02041724
+
+nnodes = 42
+nedges = 84
+
+@pytest.fixture
+def nodes():
+    return op2.Set(nnodes, 1, "nodes")
+
+@pytest.fixture
+def edges():
+    return op2.Set(nedges, 1, "edges")
+
+@pytest.fixture
+def edge2node(edges, nodes):
+    u_map = numpy.array(range(nnodes) * 4, dtype=numpy.uint32)
+    random.shuffle(u_map, _seed)
+    return op2.Map(edges, nodes, 2, u_map, "edge2node")
+
+kernel_scale = """
+void scale(double* y, double* x) { *y = 2.0 * (*x); }
+"""
+
+kernel_gather = """
+void gather(double* e, double** y) { *e = y[0][0] - 0.5 * y[1][0]; }
+"""
+
+kernel_shift = """
+void shift(double* z, double* y) { *z = *y + 1.0; }
+"""
+
+kernel_combine = """
+void combine(double* f, double* e, double** z) { *f = *e * z[0][0] + z[1][0]; }
+"""
+
+kernel_sum = """
+void sum(double* g, double* f) { *g += *f; }
+"""
+
+class TestSparseTiling:
+    """
+    Sparse tiling tests.
+    """
+
+    def _chain(self, nodes, edges, edge2node, tile_size=None):
+        x = op2.Dat(nodes, numpy.arange(nnodes, dtype=numpy.float64), numpy.float64, "x")
+        y = op2.Dat(nodes, numpy.zeros(nnodes), numpy.float64, "y")
+        z = op2.Dat(nodes, numpy.zeros(nnodes), numpy.float64, "z")
+        e = op2.Dat(edges, numpy.zeros(nedges), numpy.float64, "e")
+        f = op2.Dat(edges, numpy.zeros(nedges), numpy.float64, "f")
+        g = op2.Global(1, 0.0, numpy.float64, "g")
+
+        def loops():
+            op2.par_loop(op2.Kernel(kernel_scale, "scale"), nodes,
+                         y(op2.IdentityMap, op2.WRITE), x(op2.IdentityMap, op2.READ))
+            op2.par_loop(op2.Kernel(kernel_gather, "gather"), edges,
+                         e(op2.IdentityMap, op2.WRITE), y(edge2node, op2.READ))
+            op2.par_loop(op2.Kernel(kernel_shift, "shift"), nodes,
+                         z(op2.IdentityMap, op2.WRITE), y(op2.IdentityMap, op2.READ))
+            op2.par_loop(op2.Kernel(kernel_combine, "combine"), edges,
+                         f(op2.IdentityMap, op2.WRITE), e(op2.IdentityMap, op2.READ),
+                         z(edge2node, op2.READ))
+            op2.par_loop(op2.Kernel(kernel_sum, "sum"), edges,
+                         g(op2.INC), f(op2.IdentityMap, op2.READ))
+
+        if tile_size:
+            with op2.LoopChain(tile_size):
+                loops()
+        else:
+            loops()
+        return e.data_ro, f.data_ro, g.data[0]
+
+    @pytest.mark.parametrize("tile_size", [1, 4, 16, nnodes, 100])
+    def test_tiled_matches_untiled(self, backend, nodes, edges, edge2node, tile_size):
+        e, f, g = self._chain(nodes, edges, edge2node)
+        te, tf, tg = self._chain(nodes, edges, edge2node, tile_size)
+        assert (e == te).all()
+        assert (f == tf).all()
+        assert abs(g - tg) < 1e-12 * abs(g)
+
+    def test_tiling_follows_map_changes(self, backend, nodes, edges, edge2node):
+        e, f, g = self._chain(nodes, edges, edge2node)
+        te, tf, tg = self._chain(nodes, edges, edge2node, 4)
+        assert (f == tf).all()
+        edge2node.values = edge2node.values[::-1].copy()
+        e, f, g = self._chain(nodes, edges, edge2node)
+        te, tf, tg = self._chain(nodes, edges, edge2node, 4)
+        assert (e == te).all()
+        assert (f == tf).all()
+
+    def test_access_inside_chain(self, backend, nodes):
+        x = op2.Dat(nodes, numpy.zeros(nnodes), numpy.float64, "x")
+        y = op2.Dat(nodes, numpy.zeros(nnodes), numpy.float64, "y")
+        with pytest.raises(RuntimeError):
+            with op2.LoopChain(4):
+                op2.par_loop(op2.Kernel(kernel_scale, "scale"), nodes,
+                             y(op2.IdentityMap, op2.WRITE), x(op2.IdentityMap, op2.READ))
+                y.data
+
+    def test_nested_chain(self, backend):
+        with pytest.raises(RuntimeError):
+            with op2.LoopChain(4):
+                with op2.LoopChain(4):
+                    pass
+
+if __name__ == '__main__':
+    import os
+    pytest.main(os.path.abspath(__file__))